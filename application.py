@@ -37,13 +37,14 @@ from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 from botocore.client import Config
 
-from settings import S3_BUCKET, AWS_REGION, SERVE_LOCAL, SAMPLING_RATE, AUDIO_MARGIN, TEMP_STORAGE
-from audioexplorer.features import get, FEATURES
+from settings import S3_BUCKET, AWS_REGION, SERVE_LOCAL, SAMPLING_RATE, AUDIO_MARGIN, TEMP_STORAGE, FEATURE_JOBS
+from audioexplorer.features import FEATURES
 from audioexplorer.embedding import get_embeddings, EMBEDDINGS
 from audioexplorer import audio_io
 from audioexplorer import visualize
 from audioexplorer import session_log
-from audioexplorer import filters
+from audioexplorer import cache
+from audioexplorer.windowing import gather_ranges
 
 if SERVE_LOCAL: # Play audio from the local machine
     import simpleaudio as sa
@@ -434,10 +435,10 @@ def plot_embeddings(filename, n_clicks, embedding_type, fftsize, bandpass, onset
         filepath = TEMP_STORAGE + filename
         lowpass, highpass = bandpass
         min_duration = sample_len - 0.05
-        fs, X = audio_io.read_wave_local(filepath, as_float=True)
-        features = get(X, fs, n_jobs=1, selected_features=selected_features, lowcut=lowpass, highcut=highpass,
-                       block_size=fftsize, onset_detector_type='hfc', onset_silence_threshold=-90,
-                       onset_threshold=onset_threshold, min_duration_s=min_duration, sample_len=sample_len)
+        features = cache.get_features(filepath, n_jobs=FEATURE_JOBS, selected_features=selected_features,
+                                      lowcut=lowpass, highcut=highpass, block_size=fftsize, onset_detector_type='hfc',
+                                      onset_silence_threshold=-90, onset_threshold=onset_threshold,
+                                      min_duration_s=min_duration, sample_len=sample_len)
 
         params = map_parameters(embedding_type, neighbours)
 
@@ -512,12 +513,8 @@ def display_click_image(click_data, select_data, n_clicks, url, bandpass, fft_si
         lowcut, higcut = bandpass
         if click_data is not None and event_triggered('embedding-graph.clickData'):
             start, end = click_data['points'][0]['customdata']
-            wav = audio_io.read_wav_part_from_local(
-                path=TEMP_STORAGE + url,
-                start_s=start - AUDIO_MARGIN,
-                end_s=end + AUDIO_MARGIN
-            )
-            wav = filters.frequency_filter(wav, fs=SAMPLING_RATE, lowcut=lowcut, highcut=higcut)
+            fs, y = cache.filtered_signal(TEMP_STORAGE + url, lowcut=lowcut, highcut=higcut)
+            wav = y[max(int((start - AUDIO_MARGIN) * fs), 0):int((end + AUDIO_MARGIN) * fs)]
             im = visualize.specgram_base64(y=wav, fs=SAMPLING_RATE, start=start, end=end, margin=AUDIO_MARGIN)
 
             return html.Img(
@@ -529,16 +526,19 @@ def display_click_image(click_data, select_data, n_clicks, url, bandpass, fft_si
                 }
             )
         else:
+            fs, y = cache.filtered_signal(TEMP_STORAGE + url, lowcut=lowcut, highcut=higcut)
             if select_data is not None:
                 onsets = [point['customdata'] for point in select_data['points']]
                 if onsets:
-                    wavs = audio_io.read_wav_parts_from_local(path=TEMP_STORAGE + url, onsets=onsets, as_float=True)
+                    # parts are cut from the filtered recording, so filter transients at the seams of concatenated
+                    # parts no longer show in the spectrum. Parts keep their recorded level, as before caching
+                    bounds = (np.array(onsets) * fs).astype(int)
+                    wavs, _ = gather_ranges(y, bounds[:, 0], bounds[:, 1])
                 else:
                     raise PreventUpdate
             else:
-                fs, wavs = audio_io.read_wave_local(TEMP_STORAGE + url, as_float=True)
+                wavs = y
 
-            wavs = filters.frequency_filter(wavs, fs=SAMPLING_RATE, lowcut=lowcut, highcut=higcut)
             fig = visualize.power_spectrum(wavs, fs=SAMPLING_RATE, block_size=fft_size, scaling='spectrum', cutoff=-90)
             return dcc.Graph(id='spectrum', figure=fig)
     else:
@@ -578,9 +578,8 @@ def full_spectrogram_graph(select_data, url, selection, n_clicks, bandpass, feat
             time = np.load(time_path)
             fig = visualize.spectrogram_shaded(S=Sxx, time=time, fs=SAMPLING_RATE)
         else:
-            fs, y = audio_io.read_wave_local(TEMP_STORAGE + url)
             lowcut, higcut = bandpass
-            y = filters.frequency_filter(y, fs=SAMPLING_RATE, lowcut=lowcut, highcut=higcut)
+            fs, y = cache.filtered_signal(TEMP_STORAGE + url, lowcut=lowcut, highcut=higcut)
             freq, time, Sxx = visualize.calculate_spectrogram(y, fs, backend='yaafe')
             np.save(spectrum_path, Sxx)
             np.save(time_path, time)
@@ -607,8 +606,8 @@ def reduce_noise(click, url, select_data):
     if url is not None and select_data is not None:
         fs, y = audio_io.read_wave_local(TEMP_STORAGE + url, as_float=True)
         onsets = [point['customdata'] for point in select_data['points']]
-        noises = [y[int(start_s * fs): int(end_s * fs)] for start_s, end_s in onsets]
-        noises = np.concatenate(noises)
+        bounds = (np.array(onsets) * fs).astype(int)
+        noises, _ = gather_ranges(y, bounds[:, 0], bounds[:, 1])
         y = nr.reduce_noise(audio_clip=y, noise_clip=noises)
         audio_io.save_wav(y, fs, path=TEMP_STORAGE + url)
         return 1
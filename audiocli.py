@@ -29,7 +29,11 @@ import configparser
 import logging
 import pandas as pd
 from joblib import Parallel, delayed
-from audioexplorer import features, embedding
+from settings import SAMPLING_RATE
+from audioexplorer import features, embedding, audio_io, feature_io
+from audioexplorer.filters import frequency_filter
+
+ONSET_INDEX_KEY = 'onset_index'
 
 
 @click.group()
@@ -60,13 +64,23 @@ def cli(quiet):
 @click.option("--format", "-f", type=click.Choice(['fixed', 'table'], case_sensitive=False), default='fixed',
               help='HDF5 format. Table is slightly slower and requires pytables (will not work outside Python), '
                    'but allows to read specific columns.')
-def process(input, output, jobs, config, multi, format):
+@click.option('--stream', "-s", is_flag=True, help='Read audio in blocks and append features to the output as they '
+              'are computed, so that memory use does not depend on file length. Requires 16 kHz, 16-bit WAV. '
+              'Implies table format.')
+@click.option("--block", "-b", type=click.FLOAT, default=60, show_default=True,
+              help='Duration of a block read at a time in the streaming mode [s].')
+@click.option("--onsets", "-o", type=click.Path(exists=True), default=None,
+              help='Onset store created with the onsets command. Onset detection is skipped for files found in the '
+                   'store and files without onsets are not read at all.')
+def process(input, output, jobs, config, multi, format, stream, block, onsets):
     start_time = time.time()
     extractor_config = configparser.ConfigParser()
     extractor_config.read(config)
     audio_files = glob.glob(input + '/*.wav', recursive=False)
     if not audio_files:
         logging.error(f'No wave files on {input}')
+    if onsets:
+        check_onset_params(onsets, get_params(extractor_config))
 
     outdir = os.path.dirname(output)
     if outdir:
@@ -82,7 +96,10 @@ def process(input, output, jobs, config, multi, format):
             output_path=output,
             hdf_format=format,
             multi=multi,
-            jobs=1) for wav_path in audio_files)
+            jobs=1,
+            stream=stream,
+            block_s=block,
+            onsets_path=onsets) for wav_path in audio_files)
     else:
         if os.path.isdir(output):
             logging.error(f'Supplied path {output} is a directory. Please supply a file name.')
@@ -93,69 +110,156 @@ def process(input, output, jobs, config, multi, format):
                          output_path=output,
                          hdf_format=format,
                          multi=multi,
-                         jobs=jobs)
+                         jobs=jobs,
+                         stream=stream,
+                         block_s=block,
+                         onsets_path=onsets)
     logging.info(f'Completed processing in {time.time() - start_time:.2f}s')
 
 
-def process_path(input_path, config, output_path, hdf_format, multi, jobs):
+def get_key(path: str) -> str:
+    filename_noext = os.path.splitext(os.path.basename(path))[0]
+    return filename_noext.replace('-', '_')
+
+
+def get_params(config) -> dict:
+    return {
+        'lowcut': config.getint('BANDPASS', 'lowcut'),
+        'highcut': config.getint('BANDPASS', 'highcut'),
+        'block_size': config.getint('FFT', 'block_size'),
+        'step_size': config.getint('FFT', 'step_size'),
+        'onset_detector_type': config.get('ONSET', 'detector_type'),
+        'onset_threshold': config.getfloat('ONSET', 'threshold'),
+        'onset_silence_threshold': config.getfloat('ONSET', 'silence_threshold'),
+        'min_duration_s': config.getfloat('ONSET', 'min_duration_s'),
+        'sample_len': config.getfloat('ONSET', 'sample_len')
+    }
+
+
+def process_path(input_path, config, output_path, hdf_format, multi, jobs, stream=False, block_s=60,
+                 onsets_path=None):
     logging.info(f'Processing {input_path}')
-    y, sr = librosa.load(input_path, sr=16000)
     filename_noext = os.path.splitext(os.path.basename(input_path))[0]
-    key = filename_noext.replace('-', '_')
-
-    lowcut = config.getint('BANDPASS','lowcut')
-    highcut = config.getint('BANDPASS','highcut')
-    block_size = config.getint('FFT', 'block_size')
-    step_size = config.getint('FFT', 'step_size')
-    onset_detector_type = config.get('ONSET', 'detector_type')
-    onset_threshold = config.getfloat('ONSET', 'threshold')
-    onset_silence_threshold = config.getfloat('ONSET', 'silence_threshold')
-    min_duration_s = config.getfloat('ONSET', 'min_duration_s')
-    sample_len = config.getfloat('ONSET', 'sample_len')
+    key = get_key(input_path)
+    params = get_params(config)
+
+    onsets = read_onsets(onsets_path, key) if onsets_path else None
+    if onsets_path and onsets is None:
+        logging.warning(f'{key} not found in {onsets_path}, detecting onsets')
 
     if multi:
         mode = 'w'
-        feats = features.get(y, sr, n_jobs=1,
-                             lowcut=lowcut,
-                             highcut=highcut,
-                             block_size=block_size,
-                             step_size=step_size,
-                             onset_detector_type=onset_detector_type,
-                             onset_threshold=onset_threshold,
-                             onset_silence_threshold=onset_silence_threshold,
-                             min_duration_s=min_duration_s,
-                             sample_len=sample_len)
+        n_jobs = 1
         output_file = os.path.join(output_path, filename_noext + '.h5')
     else:
         mode = 'a'
-        feats = features.get(y, sr, n_jobs=jobs,
-                             lowcut=lowcut,
-                             highcut=highcut,
-                             block_size=block_size,
-                             step_size=step_size,
-                             onset_detector_type=onset_detector_type,
-                             onset_threshold=onset_threshold,
-                             onset_silence_threshold=onset_silence_threshold,
-                             min_duration_s=min_duration_s,
-                             sample_len=sample_len)
+        n_jobs = jobs
         output_file = output_path
 
-    if not feats.empty:
-        feats.to_hdf(output_file, key=key, mode=mode, format=hdf_format)
+    no_onsets = onsets is not None and len(onsets) == 0
+    if stream and not no_onsets:
+        try:
+            sr, blocks = audio_io.read_wave_blocks(input_path, block_s=block_s)
+        except NotImplementedError as e:
+            logging.warning(f'{e}. Loading the whole file instead.')
+            stream = False
+        else:
+            if sr != SAMPLING_RATE:
+                logging.warning(f'{input_path} is sampled at {sr} Hz, streaming requires {SAMPLING_RATE} Hz. '
+                                f'Loading the whole file instead.')
+                stream = False
+
+    if no_onsets:
+        empty = True
+    elif stream:
+        n_rows = 0
+        with pd.HDFStore(output_file, mode=mode) as store:
+            if key in store:
+                store.remove(key)
+            for feats in features.get_stream(blocks, sr, n_jobs=n_jobs, onsets=onsets, **params):
+                feats.index += n_rows
+                store.append(key, feats, format='table', index=False)
+                n_rows += len(feats)
+        empty = n_rows == 0
     else:
+        y, sr = librosa.load(input_path, sr=SAMPLING_RATE)
+        feats = features.get(y, sr, n_jobs=n_jobs, onsets=onsets, **params)
+        if not feats.empty:
+            feats.to_hdf(output_file, key=key, mode=mode, format=hdf_format)
+        empty = feats.empty
+
+    if empty:
         logging.warning(f'No onsets found in {input_path}')
         outdir = os.path.dirname(output_path)
         with open(os.path.join(outdir, 'empty.log'), 'a') as f:
             f.write(input_path + '\n')
 
 
-def read_selected_features_from_hdf(selection, paths: list) -> pd.DataFrame:
-    if selection == 'all':
-        df = [pd.read_hdf(path) for path in paths]
-    else:
-        df = [pd.read_hdf(path, columns=selection) for path in paths]
-    df = pd.concat(df)
-    return df
+@cli.command('onsets', help='Audio to HDF5 onset index')
+@click.option("--input", "-in", type=click.STRING, required=True, help="Path to audio in WAV format.")
+@click.option("--output", "-out", type=click.STRING, default='onsets.h5', show_default=True,
+              help="Output HDF5 file with onsets of every input file and an index table.")
+@click.option("--jobs", "-j", type=click.INT, default=-1, help="Number of jobs to run. Defaults to all cores",
+              show_default=True)
+@click.option("--config", "-c", type=click.Path(exists=True), default='audioexplorer/algo_config.ini',
+              help="Feature extractor config. Only bandpass, FFT and onset settings are used.")
+def detect(input, output, jobs, config):
+    start_time = time.time()
+    extractor_config = configparser.ConfigParser()
+    extractor_config.read(config)
+    params = get_params(extractor_config)
+    audio_files = glob.glob(input + '/*.wav', recursive=False)
+    if not audio_files:
+        logging.error(f'No wave files on {input}')
+        sys.exit(1)
+    outdir = os.path.dirname(output)
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+
+    results = Parallel(n_jobs=jobs, backend='multiprocessing')(delayed(detect_path)(
+        input_path=wav_path,
+        params=params) for wav_path in audio_files)
+
+    index = []
+    with pd.HDFStore(output, mode='w') as store:
+        for key, path, onsets, duration_s in results:
+            store.put(key, pd.Series(onsets, name='onset'), format='fixed')
+            index.append({'key': key, 'path': path, 'n_onsets': len(onsets), 'duration_s': duration_s})
+        store.put(ONSET_INDEX_KEY, pd.DataFrame(index), format='table', data_columns=True)
+        store.get_storer(ONSET_INDEX_KEY).attrs.params = features.parse_params(params)
+    n_with_onsets = sum(1 for entry in index if entry['n_onsets'])
+    logging.info(f'{n_with_onsets} out of {len(index)} files have onsets. '
+                 f'Completed processing in {time.time() - start_time:.2f}s')
+
+
+def detect_path(input_path, params) -> tuple:
+    logging.info(f'Detecting onsets in {input_path}')
+    y, sr = librosa.load(input_path, sr=SAMPLING_RATE)
+    X = frequency_filter(y, sr, lowcut=params['lowcut'], highcut=params['highcut'])
+    onsets = features.detect_onsets(X, sr, **params)
+    return get_key(input_path), input_path, onsets, len(y) / sr
+
+
+def read_onsets(path: str, key: str):
+    """
+    Read onsets of a file from the store created by the onsets command
+    :param path: path to the onset store
+    :param key: file key, see get_key
+    :return: onsets [s] or None if the file is not in the store
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        if key not in store:
+            return None
+        return store[key].values
+
+
+def check_onset_params(path: str, params: dict):
+    with pd.HDFStore(path, mode='r') as store:
+        stored = store.get_storer(ONSET_INDEX_KEY).attrs.params
+    current = features.parse_params(params)
+    diff = [name for name in stored if name != 'sample_len' and stored[name] != current.get(name)]
+    if diff:
+        logging.warning(f'Onsets in {path} were detected with different {", ".join(diff)}')
 
 
 def get_selected_features(selection: str):
@@ -195,7 +299,8 @@ def feature_selection_to_columns(selection, all_columns):
 
 
 @cli.command('f2m', help='Features to embedding model')
-@click.option("--input", "-in", type=click.STRING, help='Path to h5 features', required=True)
+@click.option("--input", "-in", type=click.STRING, help='Path to h5 or parquet features, file or directory',
+              required=True)
 @click.option("--output", "-out", type=click.STRING, help='Output directory')
 @click.option("--jobs", "-j", type=click.INT, default=-1, help='Number of jobs to run', show_default=True)
 @click.option("--algo", "-a", type=click.Choice(list(embedding.EMBEDDINGS.keys()), case_sensitive=False), default='umap', help='Embedding to use')
@@ -204,35 +309,22 @@ def feature_selection_to_columns(selection, all_columns):
     'Chroma,SpectralRolloff,SpectralCrestFactorPerBand,pitch,LPC,freq,OBSI,SpectralFlatness,MFCC,SpectralFlux,LSF'
     'Supply the features names after comma like this: "pitch,LPC". Default (all) takes all features'                                                                   
     'Check the docs for more info: https://tracek.github.io/audio-explorer/audio_embedding/')
-def h5_to_embedding(input, output, jobs, algo, grid, select: str):
+@click.option("--memmap", "-m", type=click.STRING, default=None,
+              help='Load features into a memory-mapped file at this path instead of memory')
+def h5_to_embedding(input, output, jobs, algo, grid, select: str, memmap: str):
     start_time = time.time()
     select = get_selected_features(selection=select)
-    if os.path.isfile(input):
-        with pd.HDFStore(input) as hdf_store:
-            hdf_keys = hdf_store.keys()
-            columns = hdf_store.get_storer(hdf_keys[0]).non_index_axes[0][1]
-        select = feature_selection_to_columns(selection=select, all_columns=columns)
-        logging.info(f'Loading {len(hdf_keys)} from {input}...')
-        df = read_selected_features_from_hdf(selection=select, paths=hdf_keys)
-        if not output:
-            output = os.path.splitext(input)[0]
-    elif os.path.isdir(input):
-        input = os.path.normpath(input)
-        h5_features = glob.glob(input + '/*.h5', recursive=False)
-        if not h5_features:
-            raise Exception(f'No hdf5 files found in {input}')
-        logging.info(f'Loading {len(h5_features)} data files...')
-        with pd.HDFStore(h5_features[0]) as hdf_store:
-            key = hdf_store.keys()[0]
-            columns = hdf_store.get_storer(key).non_index_axes[0][1]
-        select = feature_selection_to_columns(selection=select, all_columns=columns)
-        df = read_selected_features_from_hdf(selection=select, paths=h5_features)
-        if not output:
-            output = input
-    else:
-        raise Exception(f'Input {input} not recognised as file or directory.')
+    sources = feature_io.list_sources(input)
+    if not sources:
+        raise Exception(f'No hdf5 files found in {input}')
+    columns = feature_io.table_columns(*sources[0])
+    select = feature_selection_to_columns(selection=select, all_columns=columns)
+    logging.info(f'Loading {len(sources)} feature tables from {input}...')
+    data = feature_io.load_features(sources, columns=select, memmap_path=memmap, n_jobs=jobs)
+    if not output:
+        output = os.path.splitext(input)[0] if os.path.isfile(input) else os.path.normpath(input)
     logging.info('Feature files loaded. Building model...')
-    embedding.fit_and_save_with_grid(df.values, type=algo, output_dir=output, n_jobs=jobs, grid_path=grid)
+    embedding.fit_and_save_with_grid(data, type=algo, output_dir=output, n_jobs=jobs, grid_path=grid)
     logging.info(f'Completed in {time.time() - start_time:.2f}s')
 
 
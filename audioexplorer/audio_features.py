@@ -1,3 +1,11 @@
+import sys
+import math
+import numpy as np
+from functools import lru_cache
+from scipy.fftpack import dct
+from scipy.signal import lfilter
+from audioexplorer.windowing import frame, sample_windows
+
 eps = sys.float_info.epsilon
 
 
@@ -178,6 +186,7 @@ def harmonic(frame, sampling_rate):
     return hr, f0
 
 
+@lru_cache(maxsize=32)
 def mfcc_filter_banks(sampling_rate, num_fft, lowfreq=133.33, linc=200 / 3,
                       logsc=1.0711703, num_lin_filt=13, num_log_filt=27):
     """
@@ -185,6 +194,7 @@ def mfcc_filter_banks(sampling_rate, num_fft, lowfreq=133.33, linc=200 / 3,
     (used in the stFeatureExtraction function before the stMFCC function call)
     This function is taken from the scikits.talkbox library (MIT Licence):
     https://pypi.python.org/pypi/scikits.talkbox
+    Results are cached per arguments and returned read-only.
     """
 
     if sampling_rate < 8000:
@@ -211,15 +221,17 @@ def mfcc_filter_banks(sampling_rate, num_fft, lowfreq=133.33, linc=200 / 3,
 
         lid = np.arange(np.floor(low_freqs * num_fft / sampling_rate) + 1,
                         np.floor(cent_freqs * num_fft / sampling_rate) + 1,
-                        dtype=np.int)
+                        dtype=int)
         lslope = heights[i] / (cent_freqs - low_freqs)
         rid = np.arange(np.floor(cent_freqs * num_fft / sampling_rate) + 1,
                         np.floor(high_freqs * num_fft / sampling_rate) + 1,
-                        dtype=np.int)
+                        dtype=int)
         rslope = heights[i] / (high_freqs - cent_freqs)
         fbank[i][lid] = lslope * (nfreqs[lid] - low_freqs)
         fbank[i][rid] = rslope * (high_freqs - nfreqs[rid])
 
+    fbank.flags.writeable = False
+    frequencies.flags.writeable = False
     return fbank, frequencies
 
 
@@ -242,10 +254,11 @@ def mfcc(fft_magnitude, fbank, num_mfcc_feats):
     return ceps
 
 
+@lru_cache(maxsize=32)
 def chroma_features_init(num_fft, sampling_rate):
     """
     This function initializes the chroma matrices used in the calculation
-    of the chroma features
+    of the chroma features. Results are cached and returned read-only.
     """
     freqs = np.array([((f + 1) * sampling_rate) /
                       (2 * num_fft) for f in range(num_fft)])
@@ -259,52 +272,17 @@ def chroma_features_init(num_fft, sampling_rate):
         idx = np.nonzero(num_chroma == u)
         num_freqs_per_chroma[idx] = idx[0].shape
 
+    num_chroma.flags.writeable = False
+    num_freqs_per_chroma.flags.writeable = False
     return num_chroma, num_freqs_per_chroma
 
 
 def chroma_features(signal, sampling_rate, num_fft):
-    # TODO: 1 complexity
-    # TODO: 2 bug with large windows
 
-    num_chroma, num_freqs_per_chroma = \
-        chroma_features_init(num_fft, sampling_rate)
     chroma_names = ['A', 'A#', 'B', 'C', 'C#', 'D',
                     'D#', 'E', 'F', 'F#', 'G', 'G#']
-    spec = signal ** 2
-    if num_chroma.max() < num_chroma.shape[0]:
-        C = np.zeros((num_chroma.shape[0],))
-        C[num_chroma] = spec
-        C /= num_freqs_per_chroma[num_chroma]
-    else:
-        I = np.nonzero(num_chroma > num_chroma.shape[0])[0][0]
-        C = np.zeros((num_chroma.shape[0],))
-        C[num_chroma[0:I - 1]] = spec
-        C /= num_freqs_per_chroma
-    final_matrix = np.zeros((12, 1))
-    newD = int(np.ceil(C.shape[0] / 12.0) * 12)
-    C2 = np.zeros((newD,))
-    C2[0:C.shape[0]] = C
-    C2 = C2.reshape(int(C2.shape[0] / 12), 12)
-    # for i in range(12):
-    #    finalC[i] = np.sum(C[i:C.shape[0]:12])
-    final_matrix = np.matrix(np.sum(C2, axis=0)).T
-
-    spec_sum = spec.sum()
-    if spec_sum == 0:
-        final_matrix /= eps
-    else:
-        final_matrix /= spec_sum
-
-    #    ax = plt.gca()
-    #    plt.hold(False)
-    #    plt.plot(finalC)
-    #    ax.set_xticks(range(len(chromaNames)))
-    #    ax.set_xticklabels(chromaNames)
-    #    xaxis = np.arange(0, 0.02, 0.01);
-    #    ax.set_yticks(range(len(xaxis)))
-    #    ax.set_yticklabels(xaxis)
-    #    plt.show(block=False)
-    #    plt.draw()
+    chroma = chroma_power(signal[np.newaxis] ** 2, sampling_rate, num_fft)
+    final_matrix = np.matrix(chroma).T
 
     return chroma_names, final_matrix
 
@@ -330,26 +308,22 @@ def chromagram(signal, sampling_rate, window, step, plot=False,
     signal = dc_normalize(signal)
 
     num_samples = len(signal)  # total number of signals
-    count_fr = 0
     num_fft = int(window / 2)
     chromogram = np.zeros((int((num_samples-step-window) / step) + 1, 12),
                           dtype=np.float64)
-    for cur_p in tqdm(range(window, num_samples - step, step),
-                      disable=not show_progress):
-        count_fr += 1
-        x = signal[cur_p:cur_p + window]
-        X = abs(fft(x))
-        X = X[0:num_fft]
-        X = X / len(X)
-        chroma_names, chroma_feature_matrix = chroma_features(X, sampling_rate,
-                                                              num_fft)
-        chroma_feature_matrix = chroma_feature_matrix[:, 0]
-        chromogram[count_fr-1, :] = chroma_feature_matrix.T
+    starts = np.arange(window, num_samples - step, step)
+    count_fr = len(starts)
+    frames = sample_windows(signal, starts, window)
+    X = np.abs(np.fft.rfft(frames, axis=1))[:, :num_fft] / num_fft
+    chromogram[:count_fr] = chroma_power(X ** 2, sampling_rate, num_fft)
+    chroma_names = ['A', 'A#', 'B', 'C', 'C#', 'D',
+                    'D#', 'E', 'F', 'F#', 'G', 'G#']
     freq_axis = chroma_names
     time_axis = [(t * step) / sampling_rate
                  for t in range(chromogram.shape[0])]
 
     if plot:
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         chromogram_plot = chromogram.transpose()[::-1, :]
         ratio = int(chromogram_plot.shape[1] / (3 * chromogram_plot.shape[0]))
@@ -400,11 +374,14 @@ def spectrogram(signal, sampling_rate, window, step, plot=False,
     num_fft = int(window / 2)
     specgram = np.zeros((int((num_samples-step-window) / step) + 1, num_fft),
                         dtype=np.float64)
-    for cur_p in tqdm(range(window, num_samples - step, step),
-                      disable=not show_progress):
+    positions = range(window, num_samples - step, step)
+    if show_progress:
+        from tqdm import tqdm  # optional, only for progress bars
+        positions = tqdm(positions)
+    for cur_p in positions:
         count_fr += 1
         x = signal[cur_p:cur_p + window]
-        X = abs(fft(x))
+        X = np.abs(np.fft.fft(x))
         X = X[0:num_fft]
         X = X / len(X)
         specgram[count_fr-1, :] = X
@@ -415,6 +392,7 @@ def spectrogram(signal, sampling_rate, window, step, plot=False,
                  for t in range(specgram.shape[0])]
 
     if plot:
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         imgplot = plt.imshow(specgram.transpose()[::-1, :])
         fstep = int(num_fft / 5.0)
@@ -477,7 +455,7 @@ def speed_feature(signal, sampling_rate, window, step):
         count_fr += 1
         x = signal[cur_p:cur_p + window]
         cur_p = cur_p + step
-        fft_magnitude = abs(fft(x))
+        fft_magnitude = np.abs(np.fft.fft(x))
         fft_magnitude = fft_magnitude[0:num_fft]
         fft_magnitude = fft_magnitude / len(fft_magnitude)
         Ex = 0.0
@@ -500,6 +478,7 @@ def speed_feature(signal, sampling_rate, window, step):
 
 
 def phormants(x, sampling_rate):
+    from scikits.talkbox import lpc  # optional, as in pyAudioAnalysis
     N = len(x)
     w = np.hamming(N)
 
@@ -528,11 +507,51 @@ def phormants(x, sampling_rate):
 """ Windowing and feature extraction """
 
 
+@lru_cache(maxsize=32)
+def chroma_matrix(num_fft, sampling_rate):
+    """
+    Projection of a power spectrum onto the 12 chroma bins:
+        chroma = chroma_matrix(num_fft, sampling_rate) @ spec / spec.sum()
+    Bins mapped past the last chroma position are dropped. Results are
+    cached per (num_fft, sampling_rate) and returned read-only.
+    """
+    num_chroma, num_freqs_per_chroma = \
+        chroma_features_init(num_fft, sampling_rate)
+    num_bins = num_chroma.shape[0]
+    valid = (num_chroma >= -num_bins) & (num_chroma < num_bins)
+    # bin feeding each chroma position, last one wins as in C[num_chroma] = spec
+    source = np.full(num_bins, -1)
+    source[num_chroma[valid]] = np.arange(num_bins)[valid]
+    divisor = num_freqs_per_chroma[num_chroma]
+    positions = np.nonzero(source >= 0)[0]
+    projection = np.zeros((12, num_bins))
+    np.add.at(projection, (positions % 12, source[positions]),
+              1.0 / divisor[positions])
+    projection.flags.writeable = False
+    return projection
+
+
+def chroma_power(power, sampling_rate, num_fft):
+    """
+    Chroma vectors of many frames with one matrix multiply
+    ARGUMENTS
+        power:          power spectra (n_frames x num_fft)
+        sampling_rate:  the sampling freq (in Hz)
+        num_fft:        number of fft bins
+    RETURNS
+        chroma:         normalized chroma (n_frames x 12)
+    """
+    spec_sum = power.sum(axis=1, keepdims=True)
+    chroma = power @ chroma_matrix(num_fft, sampling_rate).T
+    return chroma / np.where(spec_sum == 0, eps, spec_sum)
+
+
 def feature_extraction(signal, sampling_rate, window, step, deltas=True):
     """
     This function implements the shor-term windowing process.
     For each short-term window a set of features is extracted.
     This results to a sequence of feature vectors, stored in a np matrix.
+    All windows are processed at once as a frame matrix.
     ARGUMENTS
         signal:         the input signal samples
         sampling_rate:  the sampling freq (in Hz)
@@ -556,22 +575,14 @@ def feature_extraction(signal, sampling_rate, window, step, deltas=True):
 
     signal = dc_normalize(signal)
 
-    number_of_samples = len(signal)  # total number of samples
-    current_position = 0
-    count_fr = 0
     num_fft = int(window / 2)
+    n_short_blocks = 10
 
-    # compute the triangular filter banks used in the mfcc calculation
+    # constant matrices used in the mfcc and chroma calculation
     fbank, freqs = mfcc_filter_banks(sampling_rate, num_fft)
 
-    n_time_spectral_feats = 8
-    n_harmonic_feats = 0
     n_mfcc_feats = 13
     n_chroma_feats = 13
-    n_total_feats = n_time_spectral_feats + n_mfcc_feats + n_harmonic_feats + \
-                    n_chroma_feats
-    #    n_total_feats = n_time_spectral_feats + n_mfcc_feats +
-    #    n_harmonic_feats
 
     # define list of feature names
     feature_names = ["zcr", "energy", "energy_entropy"]
@@ -590,83 +601,75 @@ def feature_extraction(signal, sampling_rate, window, step, deltas=True):
         feature_names_2 = feature_names + ["delta " + f for f in feature_names]
         feature_names = feature_names_2
 
-    features = []
-    # for each short-term window to end of signal
-    while current_position + window - 1 < number_of_samples:
-        count_fr += 1
-        # get current window
-        x = signal[current_position:current_position + window]
+    # frames: [n_frames x window]
+    frames = frame(signal, window, step)
+
+    # normalized fft magnitude: [n_frames x num_fft]
+    fft_magnitude = np.abs(np.fft.rfft(frames, axis=1))[:, :num_fft]
+    fft_magnitude = fft_magnitude / num_fft
+    power = fft_magnitude ** 2
+
+    # zero crossing rate
+    zcr = np.sum(np.abs(np.diff(np.sign(frames), axis=1)), axis=1) / 2
+    zcr = zcr / np.float64(window - 1.0)
+
+    # short-term energy
+    frame_energy = np.sum(frames ** 2, axis=1)
+    st_energy = frame_energy / np.float64(window)
+
+    # short-term entropy of energy and spectral entropy
+    st_energy_entropy = _entropy_of_sub_blocks(frames, frame_energy,
+                                               n_short_blocks)
+    sp_entropy = _entropy_of_sub_blocks(fft_magnitude, power.sum(axis=1),
+                                        n_short_blocks)
+
+    # sp centroid/spread
+    ind = (np.arange(1, num_fft + 1)) * (sampling_rate / (2.0 * num_fft))
+    mag_max = fft_magnitude.max(axis=1, keepdims=True)
+    Xt = fft_magnitude / np.where(mag_max == 0, eps, mag_max)
+    NUM = Xt @ ind
+    DEN = np.sum(Xt, axis=1) + eps
+    centroid = NUM / DEN
+    spread = np.sqrt(np.sum(((ind - centroid[:, None]) ** 2) * Xt, axis=1)
+                     / DEN)
+    centroid = centroid / (sampling_rate / 2.0)
+    spread = spread / (sampling_rate / 2.0)
 
-        # update window position
-        current_position = current_position + step
+    # spectral flux, first frame is compared with itself
+    fft_sum = np.sum(fft_magnitude + eps, axis=1, keepdims=True)
+    normalized_magnitude = fft_magnitude / fft_sum
+    previous_magnitude = np.concatenate((normalized_magnitude[:1],
+                                         normalized_magnitude[:-1]))
+    sp_flux = np.sum((normalized_magnitude - previous_magnitude) ** 2, axis=1)
+
+    # spectral rolloff
+    threshold = 0.90 * power.sum(axis=1, keepdims=True)
+    above = (np.cumsum(power, axis=1) + eps) > threshold
+    sp_rolloff = np.where(above.any(axis=1),
+                          np.argmax(above, axis=1) / float(num_fft), 0.0)
+
+    # MFCCs
+    mspec = np.log10(fft_magnitude @ fbank.T + eps)
+    mfccs = dct(mspec, type=2, norm='ortho', axis=-1)[:, :n_mfcc_feats]
+
+    # chroma features
+    chroma = chroma_power(power, sampling_rate, num_fft)
+    chroma_std = chroma.std(axis=1)
+
+    features = np.column_stack((zcr, st_energy, st_energy_entropy,
+                                centroid, spread, sp_entropy, sp_flux,
+                                sp_rolloff, mfccs, chroma, chroma_std))
+    if deltas:
+        delta = np.diff(features, axis=0, prepend=features[:1])
+        features = np.concatenate((features, delta), axis=1)
 
-        # get fft magnitude
-        fft_magnitude = abs(fft(x))
+    return features.T, feature_names
 
-        # normalize fft
-        fft_magnitude = fft_magnitude[0:num_fft]
-        fft_magnitude = fft_magnitude / len(fft_magnitude)
 
-        # keep previous fft mag (used in spectral flux)
-        if count_fr == 1:
-            fft_magnitude_previous = fft_magnitude.copy()
-        feature_vector = np.zeros((n_total_feats, 1))
-
-        # zero crossing rate
-        feature_vector[0] = zero_crossing_rate(x)
-
-        # short-term energy
-        feature_vector[1] = energy(x)
-
-        # short-term entropy of energy
-        feature_vector[2] = energy_entropy(x)
-
-        # sp centroid/spread
-        [feature_vector[3], feature_vector[4]] = \
-            spectral_centroid_spread(fft_magnitude,
-                                     sampling_rate)
-
-        # spectral entropy
-        feature_vector[5] = \
-            spectral_entropy(fft_magnitude)
-
-        # spectral flux
-        feature_vector[6] = \
-            spectral_flux(fft_magnitude,
-                          fft_magnitude_previous)
-
-        # spectral rolloff
-        feature_vector[7] = \
-            spectral_rolloff(fft_magnitude, 0.90)
-
-        # MFCCs
-        mffc_feats_end = n_time_spectral_feats + n_mfcc_feats
-        feature_vector[n_time_spectral_feats:mffc_feats_end, 0] = \
-            mfcc(fft_magnitude, fbank, n_mfcc_feats).copy()
-
-        # chroma features
-        chroma_names, chroma_feature_matrix = \
-            chroma_features(fft_magnitude, sampling_rate, num_fft)
-        chroma_features_end = n_time_spectral_feats + n_mfcc_feats + \
-                              n_chroma_feats - 1
-        feature_vector[mffc_feats_end:chroma_features_end] = \
-            chroma_feature_matrix
-        feature_vector[chroma_features_end] = chroma_feature_matrix.std()
-        if not deltas:
-            features.append(feature_vector)
-        else:
-            # delta features
-            if count_fr > 1:
-                delta = feature_vector - feature_vector_prev
-                feature_vector_2 = np.concatenate((feature_vector, delta))
-            else:
-                feature_vector_2 = np.concatenate((feature_vector,
-                                                   np.zeros(feature_vector.
-                                                            shape)))
-            feature_vector_prev = feature_vector
-            features.append(feature_vector_2)
-
-        fft_magnitude_previous = fft_magnitude.copy()
-
-    features = np.concatenate(features, 1)
-    return features, feature_names
+def _entropy_of_sub_blocks(frames, total_energy, n_short_blocks):
+    """Entropy of energy of sub-blocks, computed for all frames at once"""
+    sub_win_len = int(np.floor(frames.shape[1] / n_short_blocks))
+    sub_wins = frames[:, :sub_win_len * n_short_blocks]
+    sub_wins = sub_wins.reshape(len(frames), n_short_blocks, sub_win_len)
+    s = np.sum(sub_wins ** 2, axis=2) / (total_energy[:, None] + eps)
+    return -np.sum(s * np.log2(s + eps), axis=1)
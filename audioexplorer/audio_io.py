@@ -16,16 +16,41 @@
 #      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
-import wave
+import uuid
+import struct
 import numpy as np
 import boto3
-import sox
 import logging
-from settings import AUDIO_DB
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterator
+from botocore.client import Config
+from botocore.exceptions import ClientError
+from settings import AUDIO_DB, AWS_REGION, S3_CACHE_MB, SAMPLING_RATE
+from audioexplorer.windowing import gather_ranges
+from scipy import signal
 from scipy.io import wavfile
 
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
 
 def is_conversion_required(filepath: str) -> bool:
+    if soundfile is not None:
+        try:
+            info = soundfile.info(filepath)
+        except RuntimeError:  # format not known to libsndfile, let sox tell
+            pass
+        else:
+            conformant = info.samplerate == SAMPLING_RATE and info.channels == 1 and info.format == 'WAV' \
+                and info.subtype == 'PCM_16'
+            return not conformant
+
+    import sox
     sample_rate_16khz = int(sox.file_info.sample_rate(filepath)) == 16000
     mono = sox.file_info.channels(filepath) == 1
     wav = sox.file_info.file_type(filepath) == 'wav'
@@ -49,46 +74,318 @@ def normalise_wav(wav: np.ndarray, db: float) -> np.ndarray:
     :param db: power ratio expressed in db
     :return: wav
     """
+    # float32 factor keeps int16 input from being promoted to float64
+    wav = wav * np.float32(normalisation_factor(wav.max(), wav.dtype, db))
+    return wav
+
 
-    max_wav = wav.max()
-    if wav.dtype == np.int16:
+def normalisation_factor(max_wav, dtype: np.dtype, db: float) -> float:
+    """
+    Factor that brings the peak of a wav to given level, see normalise_wav
+    :param max_wav: peak of the wav
+    :param dtype: data type of the wav
+    :param db: power ratio expressed in db
+    :return: scale factor
+    """
+    if dtype == np.int16:
         max_val = 2 ** 15 - 1
-    elif wav.dtype == np.float and max_wav <= 1:
+    elif np.issubdtype(dtype, np.floating) and max_wav <= 1:
         max_val = 1
     else:
-        raise NotImplemented(f'Wave normalisation not implemented for {wav.dtype}')
+        raise NotImplementedError(f'Wave normalisation not implemented for {dtype}')
     ratio = max_wav / max_val
     target_volume = db_to_float(db)
     scale_factor = target_volume / ratio
-    wav = wav * scale_factor
-    return wav
+    return scale_factor
 
 
 def convert_to_wav(input_path: str, output_path: str, convert_always=False):
+    """
+    Convert audio to 16-bit mono wave file at SAMPLING_RATE, with peak normalised to AUDIO_DB. Decoding, resampling
+    and normalisation run in-process and in blocks; sox is used only for formats that libsndfile cannot read. Input
+    that is already conformant is moved as it is, also when convert_always is set, if its peak is at AUDIO_DB.
+    :param input_path: path to the audio
+    :param output_path: path to the converted wave file
+    :param convert_always: normalise also input that does not need to be converted
+    """
     logging.info(f'Entering convert_to_wav with input: {input_path} to {output_path}')
     if not os.path.isfile(input_path):
         raise Exception(f'Input path {input_path} is not there!')
-    if convert_always or is_conversion_required(input_path):
-        tfm = sox.Transformer()
-        tfm.set_globals(dither=True)
-        tfm.rate(samplerate=16000)
-        tfm.norm(db_level=AUDIO_DB)
-        tfm.channels(1)
-        tfm.build(input_filepath=input_path, output_filepath=output_path)
-    else:
+    required = is_conversion_required(input_path)
+    if not required and (not convert_always or _is_normalised(input_path, AUDIO_DB)):
         os.rename(input_path, output_path)
+        return
 
+    try:
+        sound = soundfile.SoundFile(input_path) if soundfile is not None else None
+    except RuntimeError:
+        sound = None
+    if sound is None:
+        _convert_with_sox(input_path, output_path)
+        return
+    with sound:
+        _convert_with_soundfile(sound, output_path)
 
-def read_wave_local(path: str, normalise_db: float = None, as_float=False) -> (int, np.ndarray):
-    fs, signal = wavfile.read(path)
-    if normalise_db:
-        signal = normalise_wav(signal, db=normalise_db)
 
+def _is_normalised(path: str, db: float, tolerance_db: float = 0.1) -> bool:
+    pcm = open_wav(path).pcm
+    if len(pcm) == 0:
+        return False
+    peak = max(int(pcm.max()), -int(pcm.min()))
+    return peak > 0 and abs(20 * np.log10(peak / (2 ** 15 - 1)) - db) <= tolerance_db
+
+
+def _convert_with_sox(input_path: str, output_path: str):
+    import sox
+
+    tfm = sox.Transformer()
+    tfm.set_globals(dither=True)
+    tfm.rate(samplerate=16000)
+    tfm.norm(db_level=AUDIO_DB)
+    tfm.channels(1)
+    tfm.build(input_filepath=input_path, output_filepath=output_path)
+
+
+def _resample_blocks(blocks: Iterator[np.ndarray], up: int, down: int, block_len: int) -> Iterator[np.ndarray]:
+    """
+    Polyphase resampling of a stream, block by block. Every block is resampled with enough context on both sides to
+    cover the filter, so the result equals resample_poly of the whole signal. block_len must be a multiple of down.
+    """
+    if up == down:
+        yield from blocks
+        return
+    half_len = 10 * max(up, down)  # filter half length used by resample_poly
+    context = -(-(half_len // up + 2) // down) * down  # whole number of output samples
+    context_out = context * up // down
+    buffer = np.zeros(context, dtype='float32')  # zeros before the start, as resample_poly assumes
+    n_in = 0
+    n_out = 0
+    for block in blocks:
+        buffer = np.concatenate((buffer, block))
+        n_in += len(block)
+        while len(buffer) >= block_len + 2 * context:
+            resampled = signal.resample_poly(buffer[:block_len + 2 * context], up, down)
+            yield resampled[context_out:context_out + block_len * up // down].astype('float32')
+            n_out += block_len * up // down
+            buffer = buffer[block_len:]
+    remaining = -(-n_in * up // down) - n_out
+    if remaining > 0:
+        resampled = signal.resample_poly(np.concatenate((buffer, np.zeros(context, dtype='float32'))), up, down)
+        yield resampled[context_out:context_out + remaining].astype('float32')
+
+
+def _convert_with_soundfile(sound, output_path: str, block_s: float = 60.0):
+    fs = sound.samplerate
+    gcd = np.gcd(fs, SAMPLING_RATE)
+    up, down = SAMPLING_RATE // gcd, fs // gcd
+    block_len = max(1, int(block_s * fs) // down) * down
+
+    def mono_blocks():
+        for block in sound.blocks(blocksize=block_len, dtype='float32', always_2d=True):
+            yield block.mean(axis=1, dtype='float32') if block.shape[1] > 1 else block[:, 0]
+
+    # first pass: decode, downmix and resample into a scratch file, tracking the peak
+    directory = os.path.dirname(os.path.abspath(output_path))
+    scratch_path = os.path.join(directory, f'.{uuid.uuid4().hex}.f32')
+    tmp_path = os.path.join(directory, f'.{uuid.uuid4().hex}.wav')
+    peak = 0.0
+    try:
+        with open(scratch_path, 'wb') as scratch:
+            for block in _resample_blocks(mono_blocks(), up, down, block_len):
+                if len(block):
+                    peak = max(peak, float(np.abs(block).max()))
+                block.tofile(scratch)
+        resampled = np.memmap(scratch_path, dtype='float32', mode='r') if os.path.getsize(scratch_path) else \
+            np.zeros(0, dtype='float32')
+
+        # second pass: normalise, dither and quantise
+        scale = (2 ** 15 - 1) * db_to_float(AUDIO_DB) / peak if peak > 0 else 0.0
+        rng = np.random.RandomState(0)
+        out_block = int(block_s * SAMPLING_RATE)
+        with soundfile.SoundFile(tmp_path, 'w', samplerate=SAMPLING_RATE, channels=1, format='WAV',
+                                 subtype='PCM_16') as out:
+            for start in range(0, len(resampled), out_block):
+                block = resampled[start:start + out_block] * scale
+                block += rng.random_sample(len(block)) - rng.random_sample(len(block))  # TPDF dither, 1 LSB
+                np.clip(np.round(block), -2 ** 15, 2 ** 15 - 1, out=block)
+                out.write(block.astype('int16'))
+        del resampled
+        os.replace(tmp_path, output_path)
+    finally:
+        for path in (scratch_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+PCM_SCALE = 1 / (2 ** 15 - 1)  # int16 samples to float in range [-1, 1]
+LIBROSA_PCM_SCALE = 1 / 2 ** 15  # int16 samples to float as librosa.load, which audiocli uses to load whole files
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_IEEE_FLOAT = 3
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+_PCM_DTYPES = {
+    (_WAVE_FORMAT_PCM, 1): 'u1',
+    (_WAVE_FORMAT_PCM, 2): '<i2',
+    (_WAVE_FORMAT_PCM, 4): '<i4',
+    (_WAVE_FORMAT_IEEE_FLOAT, 4): '<f4',
+    (_WAVE_FORMAT_IEEE_FLOAT, 8): '<f8'
+}
+
+
+class WavReader(object):
+    """
+    Wave file mapped into memory. The header is parsed once and the samples are exposed as a read-only memmap, so that
+    slicing by time does not read or copy anything until the samples are used.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+            if riff != b'RIFF' or wave_id != b'WAVE':
+                raise ValueError(f'{path} is not a RIFF wave file')
+            file_size = os.fstat(f.fileno()).st_size
+            fmt = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    raise ValueError(f'No data chunk in {path}')
+                chunk_id, chunk_size = struct.unpack('<4sI', header)
+                if chunk_id == b'fmt ':
+                    fmt = f.read(chunk_size)
+                    f.seek(chunk_size % 2, os.SEEK_CUR)  # chunks are word aligned
+                elif chunk_id == b'data':
+                    data_offset = f.tell()
+                    data_size = min(chunk_size, file_size - data_offset)
+                    break
+                else:
+                    f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+        if fmt is None:
+            raise ValueError(f'No format chunk in {path}')
+
+        format_tag, self.n_channels, self.fs = struct.unpack('<HHI', fmt[:8])
+        self.sampwidth = struct.unpack('<H', fmt[14:16])[0] // 8
+        if format_tag == _WAVE_FORMAT_EXTENSIBLE:
+            format_tag = struct.unpack('<H', fmt[24:26])[0]
+        dtype = _PCM_DTYPES.get((format_tag, self.sampwidth))
+        if format_tag == _WAVE_FORMAT_PCM and self.sampwidth == 3:
+            # no numpy type maps 3-byte samples, uploads are converted to 16-bit by convert_to_wav
+            raise NotImplementedError(f'24-bit PCM is not supported, convert {path} to 16-bit PCM first')
+        if dtype is None:
+            raise NotImplementedError(f'Wave format {format_tag} with {8 * self.sampwidth} bits is not supported')
+
+        self.dtype = np.dtype(dtype)
+        self.n_frames = data_size // (self.sampwidth * self.n_channels)
+        shape = (self.n_frames,) if self.n_channels == 1 else (self.n_frames, self.n_channels)
+        if self.n_frames:
+            self.pcm = np.memmap(path, dtype=self.dtype, mode='r', offset=data_offset, shape=shape)
+        else:
+            self.pcm = np.empty(shape, dtype=self.dtype)
+
+    def __len__(self):
+        return self.n_frames
+
+    @property
+    def duration(self) -> float:
+        return self.n_frames / self.fs
+
+    def index(self, time_s: float) -> int:
+        """
+        Sample index of a point in time, clipped to the file
+        :param time_s: time [s]
+        :return: index [samples]
+        """
+        return min(max(int(time_s * self.fs), 0), self.n_frames)
+
+    def slice(self, start_s: float = 0, end_s: float = None) -> np.ndarray:
+        """
+        Samples between start and end, without copying
+        :param start_s: start [s]
+        :param end_s: end [s]. None for the end of the file
+        :return: read-only view of the samples
+        """
+        end = self.n_frames if end_s is None else self.index(end_s)
+        return self.pcm[self.index(start_s):end]
+
+    def read(self, start_s: float = 0, end_s: float = None, as_float=False, normalise_db: float = None) -> np.ndarray:
+        """
+        Samples between start and end. Conversion to float or normalisation is done in one pass into a single float32
+        buffer; plain int16 samples are returned as a view.
+        :param start_s: start [s]
+        :param end_s: end [s]. None for the end of the file
+        :param as_float: scale samples to range [-1, 1]
+        :param normalise_db: normalise peak to this value [dB]
+        :return: samples
+        """
+        return to_samples(self.slice(start_s, end_s), as_float=as_float, normalise_db=normalise_db)
+
+    def float_blocks(self, block_s: float = 60.0, scale: float = PCM_SCALE) -> Iterator[np.ndarray]:
+        """
+        Samples as float32 in range [-1, 1], block by block, so that the whole file is never converted at once.
+        Multi-channel audio is downmixed.
+        :param block_s: duration of a block [s]
+        :param scale: factor applied to the raw samples
+        :return: generator of float32 blocks
+        """
+        block_len = max(1, int(block_s * self.fs))
+        for start in range(0, self.n_frames, block_len):
+            block = np.multiply(self.pcm[start:start + block_len], scale, dtype='float32')
+            if block.ndim > 1:
+                block = block.mean(axis=1, dtype='float32')
+            yield block
+
+
+def to_samples(wav: np.ndarray, as_float=False, normalise_db: float = None) -> np.ndarray:
+    """
+    Scale raw samples as the readers in this module do
+    :param wav: raw samples
+    :param as_float: scale to range [-1, 1] as float32
+    :param normalise_db: normalise peak to this value [dB]
+    :return: samples
+    """
     if as_float:
-        signal = signal / (2**15-1)
-    else:
-        signal = signal.astype('int16')
-    return fs, signal
+        scale = PCM_SCALE
+        if normalise_db and len(wav):
+            scale *= normalisation_factor(wav.max(), wav.dtype, normalise_db)
+        samples = np.empty(wav.shape, dtype='float32')
+        np.multiply(wav, scale, out=samples, dtype='float32')
+        return samples
+    if normalise_db:
+        wav = normalise_wav(wav, db=normalise_db)
+    if wav.dtype != np.int16:
+        wav = wav.astype('int16')
+    return wav
+
+
+@lru_cache(maxsize=16)
+def _open_wav(path: str, inode: int, mtime: float, size: int) -> WavReader:
+    return WavReader(path)
+
+
+def open_wav(path: str) -> WavReader:
+    """
+    Open a wave file, reusing the reader while the file is not modified or replaced
+    :param path: path to the wave file
+    :return: WavReader
+    """
+    stat = os.stat(path)
+    return _open_wav(path, stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+def read_wave_local(path: str, normalise_db: float = None, as_float=False) -> (int, np.ndarray):
+    """
+    Read a whole wave file into memory. Use open_wav to map it without reading instead.
+    :param path: path to the wave file
+    :param normalise_db: normalise peak to this value [dB]
+    :param as_float: scale samples to range [-1, 1] as float32
+    :return: sampling rate and writable samples
+    """
+    reader = open_wav(path)
+    return reader.fs, _writable(reader.read(as_float=as_float, normalise_db=normalise_db))
+
+
+def _writable(samples: np.ndarray) -> np.ndarray:
+    # plain int16 reads are views on the read-only map, callers of the read functions get their own copy
+    return samples if samples.flags.writeable else np.array(samples)
 
 
 def seconds_to_wav_bytes(time, fs, dtype, wav_header_size: int=44):
@@ -108,6 +405,179 @@ def get_range_bytes(start, end, dtype, fs):
     return range_bytes
 
 
+@lru_cache(maxsize=1)
+def get_s3_client(max_pool_connections: int = 16):
+    """
+    S3 client shared across calls and threads, so that connections are pooled and kept alive
+    :param max_pool_connections: size of the connection pool
+    :return: boto3 S3 client
+    """
+    return boto3.client('s3', region_name=AWS_REGION, config=Config(max_pool_connections=max_pool_connections))
+
+
+class S3SegmentReader(object):
+    """
+    Reads byte ranges of objects in a bucket. The object is split into fixed-size blocks; missing blocks of all
+    requested ranges are merged into runs (bridging gaps of up to max_gap_blocks) that are fetched concurrently, one
+    GET each. Fetched blocks are kept in a least recently used cache of bounded size, keyed by the ETag of the object,
+    which is checked with a HEAD before every read so that an overwritten object is never served from stale blocks.
+    """
+
+    def __init__(self, bucket: str, client=None, block_size: int = 256 * 1024, max_gap_blocks: int = 1,
+                 max_workers: int = 8, cache_mb: float = S3_CACHE_MB):
+        """
+        :param bucket: bucket name
+        :param client: S3 client, e.g. a stand-in for testing. Defaults to the shared boto3 client
+        :param block_size: size of a cached block [bytes]
+        :param max_gap_blocks: missing runs separated by this many blocks or less are fetched with one GET
+        :param max_workers: number of concurrent GETs
+        :param cache_mb: size cap of the block cache
+        """
+        self.bucket = bucket
+        self.client = client if client is not None else get_s3_client()
+        self.block_size = block_size
+        self.max_gap_blocks = max_gap_blocks
+        self.max_cache_bytes = int(cache_mb * 1024 * 1024)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._blocks = OrderedDict()
+        self._cache_bytes = 0
+        self._etags = {}  # key: ETag of the cached blocks
+        self._lock = threading.Lock()
+
+    def _etag(self, key: str) -> str:
+        etag = self.client.head_object(Bucket=self.bucket, Key=key)['ETag']
+        with self._lock:
+            if self._etags.get(key, etag) != etag:
+                logging.debug(f'{key} was overwritten, dropping its cached blocks')
+                for cached in [cached for cached in self._blocks if cached[0] == key]:
+                    self._cache_bytes -= len(self._blocks.pop(cached))
+            self._etags[key] = etag
+        return etag
+
+    def _cached(self, key: str, etag: str, blocks: list) -> dict:
+        found = {}
+        with self._lock:
+            for block in blocks:
+                data = self._blocks.get((key, etag, block))
+                if data is not None:
+                    self._blocks.move_to_end((key, etag, block))
+                    found[block] = data
+        return found
+
+    def _store(self, key: str, etag: str, blocks: dict):
+        with self._lock:
+            for block, data in blocks.items():
+                if (key, etag, block) in self._blocks:
+                    continue
+                self._blocks[(key, etag, block)] = data
+                self._cache_bytes += len(data)
+            while self._cache_bytes > self.max_cache_bytes and self._blocks:
+                _, evicted = self._blocks.popitem(last=False)
+                self._cache_bytes -= len(evicted)
+
+    def _runs(self, blocks: list) -> list:
+        runs = []
+        for block in blocks:
+            if runs and block - runs[-1][1] <= self.max_gap_blocks + 1:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+        return runs
+
+    def _fetch(self, key: str, etag: str, first: int, last: int) -> dict:
+        start = first * self.block_size
+        end = (last + 1) * self.block_size - 1
+        try:
+            # fails with PreconditionFailed if the object was overwritten since the HEAD
+            o = self.client.get_object(Bucket=self.bucket, Key=key, Range=f'bytes={start}-{end}', IfMatch=etag)
+            data = o['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+                raise
+            data = b''  # range starts past the end of the object
+        return {block: data[idx * self.block_size:(idx + 1) * self.block_size]
+                for idx, block in enumerate(range(first, last + 1))}
+
+    def read_ranges(self, key: str, ranges: list) -> list:
+        """
+        Read byte ranges of an object
+        :param key: path in the bucket
+        :param ranges: list of (start, end) byte offsets, end exclusive
+        :return: list of bytes, one per range. Ranges past the end of the object are cut short
+        """
+        needed = sorted({block for start, end in ranges if end > start
+                         for block in range(start // self.block_size, (end - 1) // self.block_size + 1)})
+        for attempt in range(2):
+            try:
+                blocks = self._read_blocks(key, needed)
+                break
+            except ClientError as e:
+                # overwritten between the HEAD and a GET, read again from the new version
+                if attempt or e.response.get('Error', {}).get('Code') != 'PreconditionFailed':
+                    raise
+
+        parts = []
+        for start, end in ranges:
+            if end <= start:
+                parts.append(b'')
+                continue
+            first = start // self.block_size
+            last = (end - 1) // self.block_size
+            data = b''.join(blocks[block] for block in range(first, last + 1))
+            offset = start - first * self.block_size
+            parts.append(data[offset:offset + end - start])
+        return parts
+
+    def _read_blocks(self, key: str, blocks: list) -> dict:
+        etag = self._etag(key)
+        found = self._cached(key, etag, blocks)
+        missing = [block for block in blocks if block not in found]
+        if missing:
+            runs = self._runs(missing)
+            logging.debug(f'Fetching {len(missing)} blocks of {key} with {len(runs)} requests')
+            futures = [self.executor.submit(self._fetch, key, etag, first, last) for first, last in runs]
+            fetched = {}
+            for future in futures:
+                fetched.update(future.result())
+            self._store(key, etag, fetched)
+            found.update(fetched)
+        return found
+
+    def read_segments(self, key: str, fs: int, segments: list, dtype: np.dtype = np.int16,
+                      wav_header_size: int = 44) -> list:
+        """
+        Read segments of a mono wave file
+        :param key: path in the bucket
+        :param fs: frequency [Hz]
+        :param segments: list of (start, end) of audio of interest [s]
+        :param dtype: data type of the samples
+        :param wav_header_size: size of the header in front of the samples [bytes]
+        :return: list of arrays, one per segment
+        """
+        itemsize = np.dtype(dtype).itemsize
+        ranges = [(wav_header_size + int(start * fs) * itemsize, wav_header_size + int(end * fs) * itemsize)
+                  for start, end in segments]
+        parts = self.read_ranges(key, ranges)
+        return [np.frombuffer(part[:len(part) - len(part) % itemsize], dtype=dtype) for part in parts]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+_s3_readers = {}
+
+
+def get_s3_reader(bucket: str) -> S3SegmentReader:
+    """
+    Get process-wide segment reader of a bucket, so that the pooled client and block cache are reused across calls
+    :param bucket: bucket name
+    :return: S3SegmentReader
+    """
+    if bucket not in _s3_readers:
+        _s3_readers[bucket] = S3SegmentReader(bucket)
+    return _s3_readers[bucket]
+
+
 def read_wave_part_from_s3(bucket: str, path: str, fs: int, start: int, end: int, dtype: np.dtype = np.int16) -> np.ndarray:
     """
     Read part of a wavefile from S3
@@ -119,63 +589,97 @@ def read_wave_part_from_s3(bucket: str, path: str, fs: int, start: int, end: int
     :param dsize: data type size (e.g. int16 = 2 bytes)
     :return: wavefile of interest
     """
-    client = boto3.client('s3')
-    range_bytes = get_range_bytes(start, end, dtype, fs)
-    o = client.get_object(Bucket=bucket, Key=path, Range=range_bytes)
-    result = o['Body'].read()
-    wav = np.frombuffer(result, dtype=dtype)
-    return wav
+    return get_s3_reader(bucket).read_segments(path, fs, [(start, end)], dtype=dtype)[0]
 
 
-def read_wav_parts_from_local(path: str, onsets: list, dtype = 'int16', as_float=False, normalise_db=None):
-    wavs = []
-    with wave.open(path, mode='rb') as wavread:
-        fs = wavread.getframerate()
-        for start_s, end_s in onsets:
-            start = int(start_s * fs)
-            end = int(end_s * fs)
-            sample_len = end - start
-            wavread.setpos(start)
-            wav_bytes = wavread.readframes(sample_len)
-            wav_array = np.frombuffer(wav_bytes, dtype=dtype)
-            if normalise_db:
-                wav_array = normalise_wav(wav_array, normalise_db)
-            wavs.append(wav_array)
+def read_wave_parts_from_s3(bucket: str, path: str, fs: int, segments: list, dtype: np.dtype = np.int16) -> list:
+    """
+    Read many parts of a wavefile from S3, with nearby parts fetched together and concurrently
+    :param bucket: bucket name
+    :param path: path in the bucket
+    :param fs: frequency [Hz]
+    :param segments: list of (start, end) of audio of interest [s]
+    :param dtype: data type of the samples
+    :return: list of wavefiles of interest
+    """
+    return get_s3_reader(bucket).read_segments(path, fs, segments, dtype=dtype)
 
-    wavs = np.concatenate(wavs)
 
-    if as_float:
-        wavs = wavs / (2**15-1)
-    else:
-        wavs = wavs.astype('int16')
+def read_wave_blocks(path: str, block_s: float = 60.0) -> (int, Iterator[np.ndarray]):
+    """
+    Read 16-bit PCM wave file block by block, without loading it into memory. Multi-channel audio is downmixed.
+    Samples are scaled as librosa.load does, so that streaming gives the same features as loading the whole file.
+    :param path: path to the wave file
+    :param block_s: duration of a block [s]
+    :return: sampling rate and generator of float32 blocks in range [-1, 1]
+    """
+    reader = open_wav(path)
+    if reader.dtype != np.int16:
+        raise NotImplementedError(f'Streaming is implemented only for 16-bit PCM, {path} is not')
+    return reader.fs, reader.float_blocks(block_s, scale=LIBROSA_PCM_SCALE)
 
-    return wavs
 
+def read_wav_parts_from_local(path: str, onsets: list, dtype = 'int16', as_float=False, normalise_db=None,
+                              return_offsets=False):
+    """
+    Read and concatenate parts of a wave file. Parts are gathered from the mapped file in one pass, see
+    gather_ranges, and every part is normalised to its own peak.
+    :param path: path to the wave file
+    :param onsets: list of (start, end) of each part [s]
+    :param dtype: kept for compatibility, the data type is read from the header
+    :param as_float: scale samples to range [-1, 1] as float32
+    :param normalise_db: normalise peak of every part to this value [dB]
+    :param return_offsets: also return offsets of the parts in the result, of length len(onsets) + 1
+    :return: concatenated parts and optionally the offsets
+    """
+    reader = open_wav(path)
+    fs = reader.fs
+    bounds = np.asarray(onsets, dtype=float).reshape(-1, 2)
+    wavs, offsets = gather_ranges(reader.pcm, (bounds[:, 0] * fs).astype(int), (bounds[:, 1] * fs).astype(int))
+    lengths = np.diff(offsets)
+    if wavs.ndim > 1:
+        # channels stay interleaved, as read from the file
+        offsets = offsets * wavs.shape[1]
+        lengths = lengths * wavs.shape[1]
+        wavs = wavs.reshape(-1)
 
-def read_wav_part_from_local(path: str, start_s: float, end_s: float, dtype = 'int16', as_float=False,
-                             normalise_db=None) -> np.ndarray:
-    with wave.open(path, mode='rb') as wavread:
-        fs = wavread.getframerate()
-        start = int(start_s * fs)
-        end = int(end_s * fs)
-        sample_len = end - start
-        wavread.setpos(start)
-        wav_bytes = wavread.readframes(sample_len)
-        wav_array = np.frombuffer(wav_bytes, dtype=dtype)
-        if normalise_db:
-            wav_array = normalise_wav(wav_array, db=normalise_db)
+    if normalise_db:
+        used = np.flatnonzero(lengths)
+        factors = np.zeros(len(lengths))
+        peaks = np.maximum.reduceat(wavs, offsets[used]) if len(used) else []
+        factors[used] = [normalisation_factor(peak, wavs.dtype, normalise_db) for peak in peaks]
+        scale = np.repeat(factors.astype('float32'), lengths)
+    else:
+        scale = None
 
     if as_float:
-        wav_array = wav_array / (2**15-1)
+        result = np.empty(wavs.shape, dtype='float32')
+        np.multiply(wavs, PCM_SCALE if scale is None else scale * np.float32(PCM_SCALE), out=result, dtype='float32')
+        wavs = result
+    elif scale is not None:
+        wavs = (wavs * scale).astype('int16')
     else:
-        wav_array = wav_array.astype('int16')
+        wavs = wavs.astype('int16', copy=False)
 
+    if return_offsets:
+        return wavs, offsets
+    return wavs
 
-    return wav_array
+
+def read_wav_part_from_local(path: str, start_s: float, end_s: float, dtype = 'int16', as_float=False,
+                             normalise_db=None) -> np.ndarray:
+    return _writable(open_wav(path).read(start_s, end_s, as_float=as_float, normalise_db=normalise_db).reshape(-1))
 
 
 def save_wav(y: np.ndarray, fs: int, path: str):
+    pcm = np.empty(y.shape, dtype='int16')
     if y.max() < 1:
-        y = y * (2 ** 15 - 1)
-    wavfile.write(path, fs, y.astype('int16'))
+        # scaled into the int16 buffer, without a full-size float copy
+        np.multiply(y, 2 ** 15 - 1, out=pcm, casting='unsafe')
+    else:
+        pcm[:] = y
+    # write next to the target and swap, so that readers mapping the old file keep valid data
+    tmp_path = os.path.join(os.path.dirname(path), f'.{uuid.uuid4().hex}.wav')
+    wavfile.write(tmp_path, fs, pcm)
+    os.replace(tmp_path, path)
 
@@ -0,0 +1,268 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import uuid
+import weakref
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from settings import TEMP_STORAGE, FEATURE_CACHE_MB
+from audioexplorer import features, audio_io
+from audioexplorer.filters import StreamingFilter, design_sos
+
+
+@lru_cache(maxsize=256)
+def _file_hash(path: str, mtime: float, size: int) -> str:
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """
+    Content hash of a file. Memoised per path, modification time and size.
+    :param path: path to the file
+    :return: hex digest
+    """
+    stat = os.stat(path)
+    return _file_hash(path, stat.st_mtime, stat.st_size)
+
+
+def make_key(*parts) -> str:
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+class FeatureCache(object):
+    """
+    Disk-backed cache of onsets and features stored as npz files. Least recently used entries are evicted once the
+    cache grows over the size cap, except entries just written and signals whose memmaps are still open.
+    """
+
+    def __init__(self, root: str = os.path.join(TEMP_STORAGE, 'feature_cache'), max_mb: float = FEATURE_CACHE_MB):
+        self.root = root
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._in_use = {}  # file name of an open signal memmap: number of open memmaps
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, kind: str, key: str) -> str:
+        return os.path.join(self.root, f'{kind}_{key}.npz')
+
+    def load(self, kind: str, key: str):
+        path = self._path(kind, key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return arrays
+
+    def save(self, kind: str, key: str, protected=(), **arrays):
+        """
+        Store arrays under a key
+        :param kind: kind of the entry, e.g. 'onsets' or 'features'
+        :param key: cache key
+        :param protected: paths of other entries that must not be evicted to make room, e.g. the signal being processed
+        :param arrays: arrays to store
+        """
+        path = self._path(kind, key)
+        tmp_path = os.path.join(self.root, f'.{uuid.uuid4().hex}.npz')
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict(protected=[path, *protected])
+
+    def _signal_path(self, key: str) -> str:
+        return os.path.join(self.root, f'signal_{key}.f32')
+
+    def load_signal(self, key: str):
+        path = self._signal_path(key)
+        try:
+            signal = np.memmap(path, dtype='float32', mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return self._open(signal)
+
+    def _open(self, signal: np.memmap) -> np.memmap:
+        # the entry is not evicted until the memmap and all views on it are garbage collected
+        name = os.path.basename(signal.filename)
+        self._in_use[name] = self._in_use.get(name, 0) + 1
+        weakref.finalize(signal, self._close, name)
+        return signal
+
+    def _close(self, name: str):
+        self._in_use[name] -= 1
+        if not self._in_use[name]:
+            del self._in_use[name]
+
+    def save_signal(self, key: str, signal: np.ndarray) -> np.memmap:
+        return self.save_signal_blocks(key, [signal])
+
+    def save_signal_blocks(self, key: str, blocks) -> np.memmap:
+        """
+        Store a signal written block by block, so that it never has to be in memory as a whole. A signal larger than
+        the size cap is not cached, it is returned as a memmap of a temporary file removed once the memmap is closed.
+        :param key: cache key
+        :param blocks: iterable of consecutive 1-d blocks
+        :return: read-only float32 memmap of the stored signal
+        """
+        path = self._signal_path(key)
+        tmp_path = os.path.join(self.root, f'.{uuid.uuid4().hex}.f32')
+        with open(tmp_path, 'wb') as f:
+            for block in blocks:
+                np.asarray(block, dtype='float32').tofile(f)
+        size = os.path.getsize(tmp_path)
+        if size == 0:
+            os.remove(tmp_path)
+            return np.zeros(0, dtype='float32')
+        if size > self.max_bytes:
+            logging.debug(f'Signal of {size / 2 ** 20:.0f} MB does not fit in the cache, it is not cached')
+            signal = np.memmap(tmp_path, dtype='float32', mode='r')
+            weakref.finalize(signal, os.remove, tmp_path)
+            return signal
+        os.replace(tmp_path, path)
+        signal = self._open(np.memmap(path, dtype='float32', mode='r'))
+        self.evict()
+        return signal
+
+    def evict(self, protected=()):
+        """
+        Remove least recently used entries until the cache fits in the size cap
+        :param protected: paths of entries that must be kept, on top of signals with open memmaps
+        """
+        keep = set(self._in_use).union(os.path.basename(path) for path in protected)
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(('.npz', '.f32')) and not name.startswith('.'):
+                try:
+                    stat = os.stat(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if name in keep:
+                continue
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_cache = None
+
+
+def get_cache() -> FeatureCache:
+    global _cache
+    if _cache is None:
+        _cache = FeatureCache()
+    return _cache
+
+
+def filtered_signal(path: str, lowcut: int = None, highcut: int = None, order: int = 6,
+                    cache: FeatureCache = None) -> (int, np.memmap):
+    """
+    Band-pass filtered wave file as a float32 memmap in the cache, so that repeated reads with the same bandpass only
+    slice the map. Keyed by path, modification time, size and filter, so a rewritten file is filtered again. The int16
+    samples are converted and filtered block by block straight into the cache file. Without a band to filter, the
+    file is read into memory and nothing is cached.
+    :param path: path to the wave file
+    :param lowcut: cut everything below this frequency [Hz]. None for no filtering
+    :param highcut: cut everything above this frequency [Hz]. None for no filtering
+    :param order: order of the Butterworth filter
+    :param cache: cache to use. Defaults to a process-wide cache in TEMP_STORAGE
+    :return: sampling rate and float32 signal in range [-1, 1], not to be modified
+    """
+    reader = audio_io.open_wav(path)
+    if design_sos(reader.fs, lowcut, highcut, order) is None:
+        return reader.fs, reader.read(as_float=True)
+    if cache is None:
+        cache = get_cache()
+    stat = os.stat(path)
+    key = make_key(path, stat.st_mtime, stat.st_size, lowcut, highcut, order)
+    signal = cache.load_signal(key)
+    if signal is None:
+        logging.debug(f'Filtering {path} with bandpass {lowcut}-{highcut} Hz')
+        stream_filter = StreamingFilter(reader.fs, lowcut=lowcut, highcut=highcut, order=order)
+        signal = cache.save_signal_blocks(key, (stream_filter(block) for block in reader.float_blocks()))
+    return reader.fs, signal
+
+
+def get_features(path: str, n_jobs: int = 1, selected_features='all', cache: FeatureCache = None,
+                 **params) -> pd.DataFrame:
+    """
+    Cached equivalent of features.get for a wave file. Onsets are keyed by file content and filter and onset
+    parameters. Every feature group (freq, pitch and each YAAFE feature) is cached as a separate column block keyed by
+    the onsets and the backend computing the group, so that a new selection computes only the groups that are missing.
+    Audio is read and filtered only when something has to be computed.
+    :param path: path to the wave file
+    :param n_jobs: number of workers, as in features.get
+    :param selected_features: features to extract, as in FeatureExtractor
+    :param cache: cache to use. Defaults to a process-wide cache in TEMP_STORAGE
+    :param params: filter, onset and FFT parameters
+    :return: features with onset and offset columns
+    """
+    if cache is None:
+        cache = get_cache()
+    if selected_features == 'all':
+        selected_features = list(features.FEATURES.keys())
+    groups = [group for group in features.FEATURES if group in selected_features]
+    content_hash = file_hash(path)
+    onset_key = make_key(content_hash, sorted(features.parse_params(params).items()))
+    sample_len = float(params.get('sample_len'))
+
+    block_keys = {group: make_key(onset_key, group, features.feature_backend(group)) for group in groups}
+    blocks = {group: cache.load('features', block_keys[group]) for group in groups}
+    missing = [group for group, block in blocks.items() if block is None]
+    cached_onsets = cache.load('onsets', onset_key)
+
+    if missing or cached_onsets is None:
+        fs, X = filtered_signal(path, lowcut=int(params.get('lowcut')), highcut=int(params.get('highcut')),
+                                cache=cache)
+        if cached_onsets is not None:
+            onsets = cached_onsets['onsets']
+        else:
+            onsets = features.detect_onsets(X, fs, n_jobs=n_jobs, **params)
+            cache.save('onsets', onset_key, onsets=onsets)
+        if missing:
+            logging.debug(f'Computing {", ".join(missing)} for {path}')
+            feature_matrix, columns = features.extract(X, fs, onsets, n_jobs=n_jobs, selected_features=missing,
+                                                       **params)
+            column_groups = np.array([features.feature_group(column) for column in columns])
+            for group in missing:
+                idx = np.flatnonzero(column_groups == group)
+                block = {'features': feature_matrix[:, idx], 'columns': np.array(columns)[idx]}
+                cache.save('features', block_keys[group], **block)
+                blocks[group] = block
+    else:
+        onsets = cached_onsets['onsets']
+
+    if groups:
+        feature_matrix = np.concatenate([blocks[group]['features'] for group in groups], axis=1)
+        columns = [column for group in groups for column in blocks[group]['columns']]
+    else:
+        feature_matrix = np.empty((len(onsets), 0), dtype='float32')
+        columns = []
+    return features.to_dataframe(feature_matrix, columns, onsets, sample_len)
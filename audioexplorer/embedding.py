@@ -46,7 +46,8 @@ EMBEDDINGS = {'umap': 'Uniform Manifold Approximation and Projection',
 
 def fit_and_save_with_grid(data: Union[np.ndarray, pd.DataFrame], grid_path: str, type: str='umap', output_dir: str='.', n_jobs: int=-1):
     type = type.lower()
-    scaler = StandardScaler()
+    # scaled in place, data is not needed unscaled
+    scaler = StandardScaler(copy=False)
     data = scaler.fit_transform(data)
     os.makedirs(output_dir, exist_ok=True)
     joblib.dump(scaler, filename=os.path.join(output_dir, 'scaler.joblib'))
@@ -59,18 +60,18 @@ def fit_and_save_with_grid(data: Union[np.ndarray, pd.DataFrame], grid_path: str
             n_jobs = len(param_grid)
         if n_jobs == 1:
             for params in param_grid:
-                fit_and_save(data=data, output_dir=output_dir, n_jobs=1, **params)
+                fit_and_save(data=data, output_dir=output_dir, type=type, n_jobs=1, **params)
         else:
             Parallel(n_jobs=n_jobs, backend='multiprocessing')(delayed(fit_and_save)(
                 data=data, output_dir=output_dir, type=type, n_jobs=1, **params) for params in param_grid)
     else:
-        fit_and_save(data=data, output_dir=output_dir, n_jobs=n_jobs)
+        fit_and_save(data=data, output_dir=output_dir, type=type, n_jobs=n_jobs)
 
 
 def fit_and_save(data: Union[np.ndarray, pd.DataFrame], output_dir: str, type: str='umap', n_jobs=1, **kwargs):
     params_string = '-'.join(['{}_{}'.format(k, v) for k, v in kwargs.items()])
     logging.info(f'Running {type} with {params_string}')
-    embedding, algo, warning = get_embeddings(data=data, type=type, n_jobs=n_jobs, **kwargs)
+    embedding, algo, warning = get_embeddings(data=data, type=type, n_jobs=n_jobs, copy=False, **kwargs)
     model_output_path = os.path.join(output_dir, type + '_' + params_string + '.joblib')
     embedding_output_path = os.path.join(output_dir, type + '_' + params_string + '_data.joblib')
     logging.info(f'Model built successfully. Saving model to {model_output_path}...')
@@ -87,7 +88,8 @@ def load_and_transform(data: np.ndarray, name: str) -> np.ndarray:
     return embedding
 
 
-def get_embeddings(data: Union[np.ndarray, pd.DataFrame] , type: str='umap', n_jobs: int=1, **kwargs):
+def get_embeddings(data: Union[np.ndarray, pd.DataFrame] , type: str='umap', n_jobs: int=1, copy: bool=True,
+                   **kwargs):
     """
     Following embedding types are available
      'umap': 'Uniform Manifold Approximation and Projection',
@@ -101,13 +103,14 @@ def get_embeddings(data: Union[np.ndarray, pd.DataFrame] , type: str='umap', n_j
      'loclin': 'Locally Linear Embedding',
     :param data: numpy 2d array compatible
     :param type: One of the following: 'umap', 'tsne', 'pca', 'kpca', 'fa', 'ica'
+    :param copy: scale a copy of the data. False scales an array in place
     :param kwargs: params to pass to the embedding algorithm
     :return:
     """
     warning_msg = None
     if data.shape[0] < 10:
         warning_msg = f'The input data consisted of {data.shape[0]} points. Consider reducing onset detection threshold.'
-    data = StandardScaler().fit_transform(data)
+    data = StandardScaler(copy=copy).fit_transform(data)
     type = type.lower()
     random_state = 42
     if type == 'umap':
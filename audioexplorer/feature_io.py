@@ -0,0 +1,170 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+# PyTables is not thread-safe, HDF5 reads are serialised. Copying into the buffer and Parquet reads run in parallel.
+_hdf_lock = threading.Lock()
+
+
+def is_parquet(path: str) -> bool:
+    return path.lower().endswith(PARQUET_EXTENSIONS)
+
+
+def list_sources(path: str) -> list:
+    """
+    Feature tables in a file or directory: every key of an HDF5 file and every HDF5 or Parquet file in a directory
+    :param path: path to a file or directory
+    :return: list of (path, key) tuples, key is None for Parquet files
+    """
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(path, name) for name in os.listdir(path)
+                       if name.lower().endswith(('.h5',) + PARQUET_EXTENSIONS))
+    elif os.path.isfile(path):
+        paths = [path]
+    else:
+        raise FileNotFoundError(f'Input {path} not recognised as file or directory.')
+
+    sources = []
+    for source_path in paths:
+        if is_parquet(source_path):
+            sources.append((source_path, None))
+        else:
+            with _hdf_lock, pd.HDFStore(source_path, mode='r') as store:
+                sources.extend((source_path, key) for key in store.keys())
+    return sources
+
+
+def _parquet_file(path: str):
+    if pq is None:
+        raise ImportError(f'Reading {path} requires pyarrow')
+    return pq.ParquetFile(path)
+
+
+def table_columns(path: str, key: str = None) -> list:
+    """
+    Columns of a feature table
+    :param path: path to HDF5 or Parquet file
+    :param key: key in the HDF5 file
+    :return: list of column names
+    """
+    if key is None:
+        return [name for name in _parquet_file(path).schema.names if not name.startswith('__index_level_')]
+    with _hdf_lock, pd.HDFStore(path, mode='r') as store:
+        return list(store.select(key, start=0, stop=1).columns)
+
+
+def table_rows(path: str, key: str = None) -> int:
+    """
+    Number of rows of a feature table, read from metadata only
+    :param path: path to HDF5 or Parquet file
+    :param key: key in the HDF5 file
+    :return: number of rows
+    """
+    if key is None:
+        return _parquet_file(path).metadata.num_rows
+    with _hdf_lock, pd.HDFStore(path, mode='r') as store:
+        storer = store.get_storer(key)
+        return int(storer.nrows) if storer.is_table else int(storer.group.axis1.shape[0])
+
+
+def iter_chunks(path: str, key: str = None, columns: list = None, chunk_rows: int = 100000) -> Iterator[np.ndarray]:
+    """
+    Read selected columns of a feature table chunk by chunk. Table-format HDF5 and Parquet read only the selected
+    columns; fixed-format HDF5 cannot select columns, so every chunk is read whole and then narrowed.
+    :param path: path to HDF5 or Parquet file
+    :param key: key in the HDF5 file. None for Parquet
+    :param columns: columns to read, in this order. None for all
+    :param chunk_rows: number of rows per chunk
+    :return: generator of 2-d arrays
+    """
+    if key is None:
+        parquet = _parquet_file(path)
+        for group in range(parquet.num_row_groups):
+            table = parquet.read_row_group(group, columns=columns)
+            yield np.column_stack([table.column(name).to_numpy() for name in table.column_names]) \
+                if table.num_columns else np.empty((table.num_rows, 0))
+        return
+
+    with _hdf_lock, pd.HDFStore(path, mode='r') as store:
+        storer = store.get_storer(key)
+        n_rows = int(storer.nrows) if storer.is_table else int(storer.group.axis1.shape[0])
+        is_table = storer.is_table
+    for start in range(0, n_rows, chunk_rows):
+        with _hdf_lock, pd.HDFStore(path, mode='r') as store:
+            if is_table:
+                chunk = store.select(key, columns=columns, start=start, stop=start + chunk_rows)
+            else:
+                chunk = store.select(key, start=start, stop=start + chunk_rows)
+        if columns is not None:
+            chunk = chunk[columns]
+        yield chunk.to_numpy()
+
+
+def load_features(sources: list, columns: list = None, memmap_path: str = None, chunk_rows: int = 100000,
+                  n_jobs: int = 1, dtype='float32') -> np.ndarray:
+    """
+    Load selected columns of many feature tables into one preallocated array, chunk by chunk, without concatenating
+    data frames. Row counts come from metadata, so every table is copied straight into its own slice of the buffer.
+    :param sources: list of (path, key) tuples, see list_sources
+    :param columns: columns to read. None for all columns of the first table
+    :param memmap_path: if given, the buffer is a writable memmap at this path instead of an in-memory array
+    :param chunk_rows: number of rows read at once from a table
+    :param n_jobs: number of tables read concurrently
+    :param dtype: data type of the buffer
+    :return: array of shape (total rows, len(columns)), rows in the order of sources
+    """
+    if columns is None:
+        columns = table_columns(*sources[0])
+    rows = [table_rows(path, key) for path, key in sources]
+    offsets = np.concatenate(([0], np.cumsum(rows))).astype(int)
+    shape = (int(offsets[-1]), len(columns))
+    if memmap_path is not None and shape[0] > 0:
+        out = np.memmap(memmap_path, dtype=dtype, mode='w+', shape=shape)
+    else:
+        out = np.empty(shape, dtype=dtype)
+    logging.info(f'Loading {shape[0]} rows of {shape[1]} features from {len(sources)} tables')
+
+    def load(idx: int):
+        path, key = sources[idx]
+        position = offsets[idx]
+        for chunk in iter_chunks(path, key, columns=columns, chunk_rows=chunk_rows):
+            out[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        if position != offsets[idx + 1]:
+            raise ValueError(f'{path} {key or ""} has {position - offsets[idx]} rows, metadata says {rows[idx]}')
+
+    if n_jobs == 1 or len(sources) < 2:
+        for idx in range(len(sources)):
+            load(idx)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs if n_jobs > 0 else None) as executor:
+            list(executor.map(load, range(len(sources))))
+    return out
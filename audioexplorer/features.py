@@ -17,11 +17,14 @@
 
 import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed, cpu_count
+from typing import Iterable, Iterator
 from audioexplorer import specprop, pitchprop, melprop
-from audioexplorer.onsets import OnsetDetector
-from audioexplorer.filters import frequency_filter
-from audioexplorer.yaafe_wrapper import YaafeWrapper, YAAFE_FEATURES
+from audioexplorer.onsets import get_onset_detector
+from audioexplorer.filters import frequency_filter, StreamingFilter
+from audioexplorer.windowing import onset_windows, sample_windows, window_length
+from audioexplorer.workers import get_pool
+from audioexplorer.yaafe_wrapper import get_yaafe, yaafe_backend, YAAFE_FEATURES
+from settings import YAAFE_BACKEND, ONSET_BACKEND, PITCH_BACKEND
 
 
 FEATURES = {'freq': 'Frequency statistics',
@@ -29,97 +32,256 @@ FEATURES = {'freq': 'Frequency statistics',
 FEATURES.update(YAAFE_FEATURES)
 
 
+def feature_group(column: str) -> str:
+    """
+    Name of the feature group (key of FEATURES) that produced given column
+    :param column: feature column, e.g. freq_mean or yaafe_MFCC.3
+    :return: feature group, e.g. freq or MFCC
+    """
+    if column.startswith('yaafe_'):
+        return column[len('yaafe_'):].split('.')[0]
+    return column.split('_')[0]
+
+
+def feature_backend(group: str) -> str:
+    """
+    Backend that computes a feature group with the current settings, so that cached columns are tied to it
+    :param group: feature group, key of FEATURES
+    :return: backend name or None for groups with a single implementation
+    """
+    if group in YAAFE_FEATURES:
+        return yaafe_backend()
+    elif group == 'pitch':
+        return PITCH_BACKEND
+    return None
+
+
 class FeatureExtractor(object):
 
-    def __init__(self, fs: int, block_size: int=512, step_size: int=None, selected_features='all'):
+    def __init__(self, fs: int, block_size: int=512, step_size: int=None, selected_features='all',
+                 yaafe_backend: str=YAAFE_BACKEND):
         self.fs = fs
         self.block_size = block_size
         if selected_features == 'all':
             self.selected_features = list(FEATURES.keys())
         else:
             self.selected_features = selected_features
-        if not step_size:
-            self.step_size = block_size // 2
+        self.step_size = step_size if step_size else block_size // 2
 
         any_yaafe_feature = set(self.selected_features) & set(YAAFE_FEATURES.keys())
         if not any_yaafe_feature:
             self.yaafe = None
         else:
-            self.yaafe = YaafeWrapper(fs, block_size, step_size, selected_features=any_yaafe_feature)
-
+            self.yaafe = get_yaafe(fs, block_size, step_size, selected_features=any_yaafe_feature,
+                                   backend=yaafe_backend)
 
-    def get_features(self, sample: np.ndarray) -> pd.DataFrame:
-        computed_features = []
+        self.blocks = []
         if 'freq' in self.selected_features:
-            spectral_props = specprop.spectral_statistics_series(sample, self.fs)
-            computed_features.append(spectral_props)
+            self.blocks.append(('freq', specprop.SPECTRAL_STATISTICS))
         if 'pitch' in self.selected_features:
-            hop = self.step_size // 2
-            pitch_stats = pitchprop.get_pitch_stats_series(sample, self.fs, block_size=self.block_size, hop=hop,
-                                                           tolerance=0.4)
-            computed_features.append(pitch_stats)
+            self.blocks.append(('pitch', pitchprop.PITCH_STATISTICS))
         if self.yaafe:
-            yaafe_features = self.yaafe.get_mean_features_as_series(sample)
-            computed_features.append(yaafe_features)
-        r = pd.concat(computed_features)
-        return r
-
-
-def _extract_features(samples: np.ndarray, fs: int, block_size: int, selected_features):
-    extractor = FeatureExtractor(fs=fs, block_size=block_size, selected_features=selected_features)
-    features = []
-    for sample in samples:
-        f = extractor.get_features(sample)
-        features.append(f)
-    return pd.DataFrame(features)
-
-
-def _split_audio_into_chunks_by_onsets(X: np.ndarray, fs: int, onsets: np.ndarray, sample_len: float, split: int) -> np.ndarray:
-    samples = []
-    for onset in onsets:
-        start = int(onset * fs)
-        end = int((onset + sample_len) * fs)
-        samples.append(X[start: end])
-    samples = np.array(samples)
-    if split == -1:
-        split = cpu_count()
-    if split > 1:
-        samples = np.array_split(samples, split)
-    return samples
-
-
-def get(X, fs: int, n_jobs: int=1, selected_features='all', **params) -> pd.DataFrame:
-    lowcut = int(params.get('lowcut'))
-    highcut = int(params.get('highcut'))
+            self.blocks.append(('yaafe', self.yaafe.columns))
+        self.columns = [column for _, block_columns in self.blocks for column in block_columns]
+
+    def _compute_block(self, name: str, samples: np.ndarray, out: np.ndarray):
+        if name == 'freq':
+            specprop.spectral_statistics_batch(samples, self.fs, out=out)
+        elif name == 'pitch':
+            hop = self.step_size // 2
+            pitchprop.get_pitch_stats_batch(samples, self.fs, block_size=self.block_size, hop=hop, tolerance=0.4,
+                                            out=out)
+        elif name == 'yaafe':
+            self.yaafe.get_mean_features_batch(samples, out=out)
+
+    def get_features_batch(self, samples: np.ndarray) -> (np.ndarray, list):
+        """
+        Compute selected features for all samples at once
+        :param samples: 2-d array of shape (n_samples, sample_len)
+        :return: feature matrix (float32) of shape (n_samples, n_features) and list of column names
+        """
+        features = np.empty((len(samples), len(self.columns)), dtype='float32')
+        col = 0
+        for name, block_columns in self.blocks:
+            block = features[:, col:col + len(block_columns)]
+            if len(samples):
+                self._compute_block(name, samples, out=block)
+            col += len(block_columns)
+        return features, self.columns
+
+    def get_features(self, sample: np.ndarray) -> pd.Series:
+        features, columns = self.get_features_batch(sample[np.newaxis])
+        return pd.Series(features[0], index=columns)
+
+
+def _extract_features(samples: np.ndarray, fs: int, block_size: int, step_size: int,
+                      selected_features) -> (np.ndarray, list):
+    extractor = FeatureExtractor(fs=fs, block_size=block_size, step_size=step_size, selected_features=selected_features)
+    return extractor.get_features_batch(samples)
+
+
+def parse_params(params: dict) -> dict:
     block_size = int(params.get('block_size'))
-    step_size = int(params.get('step_size', block_size // 2))
-    onset_detector_type = params.get('onset_detector_type')
-    onset_threshold = float(params.get('onset_threshold'))
-    onset_silence_threshold = float(params.get('onset_silence_threshold'))
-    min_duration_s = float(params.get('min_duration_s'))
-    sample_len = float(params.get('sample_len'))
-
-    X = frequency_filter(X, fs, lowcut=lowcut, highcut=highcut)
-
-    if onset_threshold > 0:
-        onset_detector = OnsetDetector(fs, nfft=block_size, hop=step_size,
-                                       onset_detector_type=onset_detector_type,
-                                       onset_threshold=onset_threshold, onset_silence_threshold=onset_silence_threshold,
-                                       min_duration_s=min_duration_s)
-        onsets = onset_detector.get_all(X)
-    else:
-        onsets = np.arange(0, len(X) / fs, sample_len)
-    chunks = _split_audio_into_chunks_by_onsets(X, fs, onsets, sample_len, n_jobs)
-    if n_jobs == 1:
-        features = _extract_features(chunks, fs, block_size=block_size, selected_features=selected_features)
-    else:
-        features = Parallel(n_jobs=n_jobs, backend='multiprocessing')(
-            delayed(_extract_features)(samples=chunk, fs=fs, block_size=block_size, selected_features=selected_features)
-            for chunk in chunks)
-        features = pd.concat(features)
+    return {
+        'lowcut': int(params.get('lowcut')),
+        'highcut': int(params.get('highcut')),
+        'block_size': block_size,
+        'step_size': int(params.get('step_size', block_size // 2)),
+        'onset_detector_type': params.get('onset_detector_type'),
+        'onset_threshold': float(params.get('onset_threshold')),
+        'onset_silence_threshold': float(params.get('onset_silence_threshold')),
+        'min_duration_s': float(params.get('min_duration_s')),
+        'sample_len': float(params.get('sample_len')),
+        'onset_backend': params.get('onset_backend', ONSET_BACKEND)
+    }
+
+
+def _get_onset_detector(fs: int, p: dict):
+    return get_onset_detector(fs, nfft=p['block_size'], hop=p['step_size'],
+                              onset_detector_type=p['onset_detector_type'],
+                              onset_threshold=p['onset_threshold'],
+                              onset_silence_threshold=p['onset_silence_threshold'],
+                              min_duration_s=p['min_duration_s'], backend=p['onset_backend'])
 
+
+def to_dataframe(features: np.ndarray, columns: list, onsets: np.ndarray, sample_len: float) -> pd.DataFrame:
+    features = pd.DataFrame(features, columns=columns)
     features.insert(0, column='onset', value=onsets)
     features.insert(1, column='offset', value=onsets + sample_len)
-    features = features.reset_index(drop=True)
     return features
 
+
+def detect_onsets(X: np.ndarray, fs: int, n_jobs: int=1, **params) -> np.ndarray:
+    """
+    Detect onsets in a filtered signal. With onset threshold 0 the signal is split into consecutive windows.
+    :param X: filtered 1-d signal
+    :param fs: sampling rate [Hz]
+    :param n_jobs: number of workers. Anything other than 1 detects onsets in overlapping segments in the shared pool
+    :param params: onset and FFT parameters
+    :return: onsets [s]
+    """
+    p = parse_params(params)
+    if p['onset_threshold'] > 0:
+        if n_jobs == 1:
+            onsets = _get_onset_detector(fs, p).get_all(X)
+        else:
+            onsets = get_pool(n_jobs).detect_onsets(X, fs, p)
+    else:
+        onsets = np.arange(0, len(X) / fs, p['sample_len'])
+    return onsets
+
+
+def extract(X: np.ndarray, fs: int, onsets: np.ndarray, n_jobs: int=1, selected_features='all',
+            **params) -> (np.ndarray, list):
+    """
+    Extract features of windows starting at each onset
+    :param X: filtered 1-d signal
+    :param fs: sampling rate [Hz]
+    :param onsets: window starts [s]
+    :param n_jobs: number of workers. Anything other than 1 uses the shared feature pool (-1 for all cores)
+    :param selected_features: features to extract, as in FeatureExtractor
+    :param params: filter, onset and FFT parameters
+    :return: feature matrix (float32) and list of column names
+    """
+    p = parse_params(params)
+    if n_jobs == 1:
+        chunks = onset_windows(X, fs, onsets, p['sample_len'])
+        return _extract_features(chunks, fs, block_size=p['block_size'], step_size=p['step_size'],
+                                 selected_features=selected_features)
+    return get_pool(n_jobs).extract(X, fs, onsets, p['sample_len'], block_size=p['block_size'],
+                                    step_size=p['step_size'], selected_features=selected_features)
+
+
+def get(X, fs: int, n_jobs: int=1, selected_features='all', onsets: np.ndarray=None, **params) -> pd.DataFrame:
+    """
+    Filter the signal, detect onsets and extract features of windows starting at each onset
+    :param X: 1-d signal
+    :param fs: sampling rate [Hz]
+    :param n_jobs: number of workers. Anything other than 1 uses the shared feature pool (-1 for all cores)
+    :param selected_features: features to extract, as in FeatureExtractor
+    :param onsets: precomputed onsets [s], e.g. from audiocli onsets. Detected if not given
+    :param params: filter, onset and FFT parameters
+    :return: features with onset and offset columns
+    """
+    X = frequency_filter(X, fs, lowcut=int(params.get('lowcut')), highcut=int(params.get('highcut')))
+    if onsets is None:
+        onsets = detect_onsets(X, fs, n_jobs=n_jobs, **params)
+    features, columns = extract(X, fs, onsets, n_jobs=n_jobs, selected_features=selected_features, **params)
+    return to_dataframe(features, columns, onsets, float(params.get('sample_len')))
+
+
+def get_stream(blocks: Iterable[np.ndarray], fs: int, n_jobs: int=1, selected_features='all', onsets: np.ndarray=None,
+               **params) -> Iterator[pd.DataFrame]:
+    """
+    Streaming version of get for signals that do not fit in memory. Filter and onset detector state is carried
+    across blocks and only the part of the signal still needed by pending onsets is kept.
+    :param blocks: consecutive blocks of a 1-d signal
+    :param fs: sampling rate [Hz]
+    :param n_jobs: number of workers. Anything other than 1 uses the shared feature pool (-1 for all cores)
+    :param selected_features: features to extract, as in FeatureExtractor
+    :param onsets: precomputed sorted onsets [s], e.g. from audiocli onsets. Detected if not given
+    :param params: filter, onset and FFT parameters
+    :return: features with onset and offset columns, one DataFrame per block
+    """
+    p = parse_params(params)
+    block_size = p['block_size']
+    step_size = p['step_size']
+    sample_len = p['sample_len']
+    win_len = window_length(fs, sample_len)
+    lookback = 8 * step_size  # onsets are reported a few hops after they happen
+
+    stream_filter = StreamingFilter(fs, lowcut=p['lowcut'], highcut=p['highcut'])
+    given_onsets = np.asarray(onsets) if onsets is not None else None
+    n_given_onsets = 0
+    onset_detector = _get_onset_detector(fs, p) if p['onset_threshold'] > 0 and given_onsets is None else None
+    if n_jobs == 1:
+        extractor = FeatureExtractor(fs=fs, block_size=block_size, step_size=step_size,
+                                     selected_features=selected_features)
+
+    def extract(signal, starts):
+        if n_jobs == 1:
+            return extractor.get_features_batch(sample_windows(signal, starts, win_len))
+        return get_pool(n_jobs).extract_at(signal, fs, starts, win_len, block_size=block_size, step_size=step_size,
+                                           selected_features=selected_features)
+
+    buffer = np.empty(0, dtype='float32')
+    buffer_start = 0  # position of the first buffered sample in the stream
+    n_samples = 0
+    n_grid_onsets = 0
+    pending = np.empty(0)
+    for block in blocks:
+        y = stream_filter(block)
+        buffer = np.concatenate((buffer, y))
+        n_samples += len(y)
+        if given_onsets is not None:
+            n_due = np.searchsorted(given_onsets, n_samples / fs)
+            onsets = given_onsets[n_given_onsets:n_due]
+            n_given_onsets = n_due
+        elif onset_detector:
+            onsets = onset_detector.process(y)
+        else:
+            n_grid = int(np.ceil(n_samples / fs / sample_len))
+            onsets = np.arange(n_grid_onsets, n_grid) * sample_len
+            n_grid_onsets = n_grid
+        pending = np.concatenate((pending, onsets))
+
+        starts = np.maximum((pending * fs).astype(int) - buffer_start, 0)
+        ready = starts + win_len <= len(buffer)
+        if ready.any():
+            features, columns = extract(buffer, starts[ready])
+            yield to_dataframe(features, columns, pending[ready], sample_len)
+        pending = pending[~ready]
+
+        keep_from = len(buffer) - lookback
+        if len(pending):
+            keep_from = min(keep_from, starts[~ready].min())
+        if keep_from > 0:
+            buffer = buffer[keep_from:]
+            buffer_start += keep_from
+
+    if given_onsets is not None:
+        pending = np.concatenate((pending, given_onsets[n_given_onsets:]))
+    if len(pending):
+        starts = np.maximum((pending * fs).astype(int) - buffer_start, 0)
+        features, columns = extract(buffer, starts)
+        yield to_dataframe(features, columns, pending, sample_len)
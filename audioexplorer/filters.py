@@ -17,7 +17,11 @@
 
 import numpy as np
 from typing import Optional
-from scipy.signal import butter, lfilter
+from functools import lru_cache
+from scipy.signal import butter, sosfilt, sosfiltfilt, oaconvolve
+
+MAX_IMPULSE_RESPONSE = 1 << 16  # longest impulse response considered for FFT filtering [samples]
+FFT_MIN_SAMPLES = 1 << 18  # shortest signal considered for FFT filtering [samples]
 
 
 def _butter_highpass(cutoff, fs, order=6):
@@ -41,28 +45,120 @@ def _butter_bandpass(lowcut, highcut, fs, order=6):
     return b, a
 
 
-def frequency_filter(signal: np.ndarray, fs: int, lowcut: Optional[int], highcut: Optional[int], order=6) -> np.ndarray:
+@lru_cache(maxsize=64)
+def design_sos(fs: int, lowcut: Optional[int], highcut: Optional[int], order: int = 6) -> Optional[np.ndarray]:
     """
-    Custom bandpass filter
-    :param signal: single-channel signal
+    Butterworth filter in second-order sections, cached per arguments
     :param fs: sampling rate [Hz]
-    :param lowcut: cut everything below this frequency [Hz]
-    :param highcut: cut everything above this frequency [Hz]
+    :param lowcut: cut everything below this frequency [Hz]. 0 or None for a lowpass
+    :param highcut: cut everything above this frequency [Hz]. Nyquist or None for a highpass
     :param order: order of the Butterworth filter
-    :return: flitered signal (ndarray float32)
+    :return: float32 sections, shared between callers, or None if nothing is to be filtered
     """
     if lowcut == 0:
         lowcut = None
     if highcut == fs // 2:
         highcut = None
 
+    nyq = 0.5 * fs
     if lowcut and highcut:
-        b, a = _butter_bandpass(lowcut, highcut, fs, order)
-    elif lowcut and not highcut:
-        b, a = _butter_highpass(lowcut, fs, order)
-    elif highcut and not lowcut:
-        b, a = _butter_lowpass(highcut, fs, order)
+        sos = butter(order, [lowcut / nyq, highcut / nyq], btype='band', output='sos')
+    elif lowcut:
+        sos = butter(order, lowcut / nyq, btype='highpass', output='sos')
+    elif highcut:
+        sos = butter(order, highcut / nyq, btype='lowpass', output='sos')
     else:
+        return None
+    return sos.astype('float32')
+
+
+@lru_cache(maxsize=64)
+def impulse_response(fs: int, lowcut: Optional[int], highcut: Optional[int], order: int = 6,
+                     zero_phase: bool = False) -> Optional[np.ndarray]:
+    """
+    Impulse response of the filter from design_sos, truncated once the remaining energy drops below -100 dB.
+    With zero_phase it is the symmetric response of forward-backward filtering.
+    :return: read-only float32 response or None if nothing is to be filtered
+    """
+    sos = design_sos(fs, lowcut, highcut, order)
+    if sos is None:
+        return None
+    length = MAX_IMPULSE_RESPONSE
+    impulse = np.zeros(length)
+    impulse[0] = 1
+    response = sosfilt(sos.astype('float64'), impulse)
+    tail_energy = np.cumsum(response[::-1] ** 2)[::-1]
+    below = np.flatnonzero(tail_energy < 1e-10 * tail_energy[0])
+    response = response[:below[0] if len(below) else length]
+    if zero_phase:
+        response = np.convolve(response, response[::-1])
+    response = response.astype('float32')
+    response.flags.writeable = False
+    return response
+
+
+def _choose_method(n_samples: int, zero_phase: bool, response: Optional[np.ndarray]) -> str:
+    # Recursive sections win for causal filtering. Overlap-add beats forward-backward sections on long signals
+    # as long as the impulse response is short.
+    if zero_phase and response is not None and n_samples >= FFT_MIN_SAMPLES and len(response) <= n_samples // 64:
+        return 'fft'
+    return 'sos'
+
+
+def frequency_filter(signal: np.ndarray, fs: int, lowcut: Optional[int], highcut: Optional[int], order=6,
+                     zero_phase: bool = False, method: str = 'auto') -> np.ndarray:
+    """
+    Custom bandpass filter. Works in float32 along the last axis.
+    :param signal: single-channel signal or one signal per row
+    :param fs: sampling rate [Hz]
+    :param lowcut: cut everything below this frequency [Hz]
+    :param highcut: cut everything above this frequency [Hz]
+    :param order: order of the Butterworth filter
+    :param zero_phase: filter forwards and backwards, so that there is no phase shift
+    :param method: 'sos' for second-order sections, 'fft' for overlap-add convolution with the truncated impulse
+    response or 'auto' to pick the faster one
+    :return: flitered signal (ndarray float32)
+    """
+    sos = design_sos(fs, lowcut, highcut, order)
+    if sos is None:
         return signal
-    y = lfilter(b, a, signal).astype('float32')
-    return y
+    signal = np.asarray(signal, dtype='float32')
+    if method == 'auto':
+        response = impulse_response(fs, lowcut, highcut, order, zero_phase) if zero_phase else None
+        method = _choose_method(signal.shape[-1], zero_phase, response)
+
+    if method == 'sos':
+        if zero_phase:
+            return sosfiltfilt(sos, signal).astype('float32', copy=False)
+        return sosfilt(sos, signal)
+    elif method == 'fft':
+        response = impulse_response(fs, lowcut, highcut, order, zero_phase)
+        response = response.reshape((1,) * (signal.ndim - 1) + (-1,))
+        y = oaconvolve(signal, response, axes=-1)
+        # the zero-phase response is centred on its middle sample
+        delay = (response.shape[-1] - 1) // 2 if zero_phase else 0
+        return np.ascontiguousarray(y[..., delay:delay + signal.shape[-1]], dtype='float32')
+    raise ValueError(f'Unknown filter method {method}')
+
+
+class StreamingFilter(object):
+    """
+    Bandpass filter applied block by block. Filter state is carried across blocks, so that filtering consecutive
+    blocks gives the same result as frequency_filter on the whole signal.
+    """
+
+    def __init__(self, fs: int, lowcut: Optional[int], highcut: Optional[int], order=6):
+        self.sos = design_sos(fs, lowcut, highcut, order)
+        if self.sos is not None:
+            self.zi = np.zeros((self.sos.shape[0], 2), dtype='float32')
+
+    def __call__(self, block: np.ndarray) -> np.ndarray:
+        """
+        Filter next block of the stream
+        :param block: single-channel signal
+        :return: filtered block (ndarray float32)
+        """
+        if self.sos is None:
+            return block.astype('float32')
+        y, self.zi = sosfilt(self.sos, np.asarray(block, dtype='float32'), zi=self.zi)
+        return y
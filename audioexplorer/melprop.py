@@ -17,7 +17,11 @@
 
 import numpy as np
 import pandas as pd
-import librosa
+from functools import lru_cache
+from scipy import fftpack
+from numpy.lib.stride_tricks import as_strided
+from scipy.signal import savgol_filter
+
 
 def mel_frequency_cepstral_coefficients(y: np.ndarray, fs: int, n_mfcc=13, block_size=512, step_size=128, fmin=300,
                                         fmax=6000, include_derivatives=False):
@@ -35,6 +39,8 @@ def mel_frequency_cepstral_coefficients(y: np.ndarray, fs: int, n_mfcc=13, block
     :param include_derivatives: include 1st and 2nd order derivatives
     :return: MFCCs
     """
+    import librosa
+
     prefix = 'mfcc'
     mfcc = librosa.feature.mfcc(y=y, sr=fs, n_mfcc=n_mfcc + 1, fmin=fmin, fmax=fmax, n_fft=block_size, hop_length=step_size)[1:]
     mfcc_names = [f'{prefix}_d0.{idx}' for idx in range(1, n_mfcc + 1)]
@@ -48,4 +54,114 @@ def mel_frequency_cepstral_coefficients(y: np.ndarray, fs: int, n_mfcc=13, block
     else:
         feature_vector = pd.Series(data=mfcc, index=mfcc_names)
 
-    return feature_vector
\ No newline at end of file
+    return feature_vector
+
+
+def mfcc_names(n_mfcc: int = 13, include_derivatives: bool = False) -> list:
+    """
+    Names of the MFCC columns, as in mel_frequency_cepstral_coefficients
+    :param n_mfcc: number of coefficients
+    :param include_derivatives: include names of 1st and 2nd order derivatives
+    :return: list of names
+    """
+    orders = range(3) if include_derivatives else range(1)
+    return [f'mfcc_d{order}.{idx}' for order in orders for idx in range(1, n_mfcc + 1)]
+
+
+@lru_cache(maxsize=16)
+def mel_basis(fs: int, n_fft: int, n_mels: int = 128, fmin: float = 0.0, fmax: float = None) -> np.ndarray:
+    """
+    Mel filterbank as used by librosa.feature.melspectrogram, memoised
+    :param fs: sampling frequency [Hz]
+    :param n_fft: length of the FFT window
+    :param n_mels: number of mel bands
+    :param fmin: lowest frequency [Hz]
+    :param fmax: highest frequency [Hz]. If None, use fmax = sr / 2.0
+    :return: read-only array of shape (n_mels, n_fft // 2 + 1)
+    """
+    import librosa
+
+    basis = librosa.filters.mel(sr=fs, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax)
+    basis.flags.writeable = False
+    return basis
+
+
+@lru_cache(maxsize=16)
+def dct_matrix(n_mels: int, n_mfcc: int) -> np.ndarray:
+    """
+    Orthonormal DCT-II as a matrix, memoised
+    :param n_mels: number of mel bands
+    :param n_mfcc: number of coefficients to keep
+    :return: read-only array of shape (n_mfcc, n_mels)
+    """
+    matrix = fftpack.dct(np.eye(n_mels), type=2, norm='ortho', axis=0)[:n_mfcc]
+    matrix.flags.writeable = False
+    return matrix
+
+
+def _power_spectrogram(samples: np.ndarray, n_fft: int, hop: int) -> np.ndarray:
+    # centred frames with reflect padding and a periodic Hann window, as librosa.stft up to 0.9. Frames of all rows are
+    # strided views of the padded rows and go through one batched FFT
+    padded = np.pad(np.asarray(samples, dtype='float64'), ((0, 0), (n_fft // 2, n_fft // 2)), mode='reflect')
+    n_frames = 1 + (padded.shape[1] - n_fft) // hop
+    frames = as_strided(padded, shape=(len(padded), n_frames, n_fft),
+                        strides=(padded.strides[0], hop * padded.itemsize, padded.itemsize), writeable=False)
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)
+    power = np.abs(np.fft.rfft(frames * window, axis=-1))
+    power *= power
+    return power
+
+
+def power_to_db(power: np.ndarray, amin: float = 1e-10, top_db: float = 80.0) -> np.ndarray:
+    """
+    Convert power to dB relative to 1, as librosa.power_to_db. Every window of a batch is clipped at top_db below its
+    own maximum.
+    :param power: power of shape (n_samples, ...)
+    :param amin: minimum power
+    :param top_db: dynamic range [dB]. None for no clipping
+    :return: power [dB]
+    """
+    db = 10.0 * np.log10(np.maximum(amin, power))
+    if top_db is not None:
+        peak = db.reshape(len(db), -1).max(axis=-1)
+        np.maximum(db, (peak - top_db).reshape((-1,) + (1,) * (db.ndim - 1)), out=db)
+    return db
+
+
+def mel_frequency_cepstral_coefficients_batch(samples: np.ndarray, fs: int, n_mfcc=13, block_size=512, step_size=128,
+                                              fmin=300, fmax=6000, include_derivatives=False, n_mels=128,
+                                              out: np.ndarray = None, chunk_size: int = 32) -> np.ndarray:
+    """
+    Mean MFCCs, and optionally their derivatives, of a batch of signals. Same as mel_frequency_cepstral_coefficients
+    averaged over frames, but the mel filterbank and DCT are built once and applied to all windows of a chunk as
+    matrix products, after one batched FFT over all their frames.
+
+    :param samples: 2-d array of signals, one per row
+    :param fs: sampling frequency [Hz]
+    :param n_mfcc: number of coefficients to extract
+    :param block_size: length of the FFT window
+    :param step_size: number of samples between successive frames
+    :param fmin: lowest frequency [Hz]
+    :param fmax: highest frequency [Hz]. If None, use fmax = sr / 2.0
+    :param include_derivatives: include 1st and 2nd order derivatives
+    :param n_mels: number of mel bands
+    :param out: optional array of shape (n_samples, len(mfcc_names(n_mfcc, include_derivatives))) to be filled
+    :param chunk_size: number of rows processed at once. Small chunks keep the frames in cache
+    :return: features, columns ordered as in mfcc_names
+    """
+    n_columns = len(mfcc_names(n_mfcc, include_derivatives))
+    if out is None:
+        out = np.empty((len(samples), n_columns), dtype='float32')
+    basis = mel_basis(fs, block_size, n_mels, fmin, fmax)
+    # first coefficient is dropped
+    dct = dct_matrix(n_mels, n_mfcc + 1)[1:]
+    for start in range(0, len(samples), chunk_size):
+        block = out[start:start + chunk_size]
+        mel = _power_spectrogram(samples[start:start + chunk_size], block_size, step_size) @ basis.T
+        mfcc = power_to_db(mel) @ dct.T
+        block[:, :n_mfcc] = mfcc.mean(axis=1)
+        if include_derivatives:
+            for order in (1, 2):
+                delta = savgol_filter(mfcc, window_length=9, polyorder=order, deriv=order, axis=1, mode='nearest')
+                block[:, order * n_mfcc:(order + 1) * n_mfcc] = delta.mean(axis=1)
+    return out
@@ -17,6 +17,11 @@
 
 import numpy as np
 from aubio import onset
+from scipy.signal import lfilter
+from audioexplorer import stft
+from audioexplorer.windowing import frame
+
+ONSET_BACKENDS = ['aubio', 'numpy']
 
 
 class OnsetDetector(object):
@@ -28,6 +33,7 @@ class OnsetDetector(object):
                  onset_threshold: float = 0.01,
                  onset_silence_threshold: float = -90,
                  min_duration_s: float = 0.02):
+        self.fs = fs
         self.hop = hop
         self.onset_detector = onset(onset_detector_type, nfft, hop, fs)
         if onset_threshold:
@@ -36,20 +42,255 @@ class OnsetDetector(object):
             self.onset_detector.set_silence(onset_silence_threshold)
         if min_duration_s:
             self.onset_detector.set_minioi_s(min_duration_s)
+        self._remainder = np.empty(0, dtype='float32')
+        self._skip_first = True
+        self._clock = 0  # samples fed to aubio
+        self._skips = []  # (clock, samples skipped up to it) at every run of all-zero hops, which are not fed
 
     def get(self, frame):
         if self.onset_detector(frame):
             return self.onset_detector.get_last_s()
 
-    def get_all(self, signal):
-        signal_windowed = np.array_split(signal.astype('float32'), np.arange(self.hop, len(signal), self.hop))
+    def _position(self, clock: int) -> int:
+        # aubio reports onsets on its clock, mapped back onto the signal by adding the hops skipped before them
+        for skip_clock, skipped in reversed(self._skips):
+            if skip_clock <= clock:
+                return clock + skipped
+        return clock
+
+    def _detect(self, hops) -> list:
+        """
+        Feed consecutive hops to aubio, skipping all-zero hops as aubio does not handle digital silence
+        :param hops: hops of the signal
+        :return: positions of onsets from the first hop given to the detector [samples]
+        """
         onsets = []
-        for frame in signal_windowed[:-1]:
-            if frame.any():
-                if self.onset_detector(frame):
-                    onsets.append(self.onset_detector.get_last_s())
-        return np.array(onsets[1:])
+        for hop in hops:
+            if hop.any():
+                self._clock += self.hop
+                if self.onset_detector(hop):
+                    onsets.append(self._position(self.onset_detector.get_last()))
+            elif self._skips and self._skips[-1][0] == self._clock:
+                self._skips[-1] = (self._clock, self._skips[-1][1] + self.hop)
+            else:
+                self._skips.append((self._clock, (self._skips[-1][1] if self._skips else 0) + self.hop))
+        # onsets are reported a few hops late, older skips are not needed to place them
+        while len(self._skips) > 1 and self._skips[1][0] < self._clock - 16 * self.hop:
+            self._skips.pop(0)
+        return onsets
+
+    def get_all(self, signal, skip_first: bool = True, start: int = 0):
+        """
+        Detect onsets in the whole signal
+        :param signal: 1-d signal
+        :param skip_first: drop the first onset, which aubio reports at the beginning of non-silent signals
+        :param start: position of the signal when it is a segment of a longer one [samples]
+        :return: onsets [s]
+        """
+        # hops are views on the signal, the trailing (possibly incomplete) hop is not processed
+        signal = np.asarray(signal, dtype='float32')
+        n_hops = max(0, -(-len(signal) // self.hop) - 1)
+        onsets = self._detect(frame(signal, self.hop, self.hop)[:n_hops])
+        # in float32 as aubio's get_last_s, so that segments give the same times as one pass
+        onsets = [np.float32(start + position) / np.float32(self.fs) for position in onsets]
+        return np.array(onsets[1:] if skip_first else onsets, dtype='float64')
+
+    def process(self, block):
+        """
+        Detect onsets in the next block of a stream. Detector state and samples that do not fill a complete hop are
+        carried over to the next call, so consecutive blocks give the same onsets as get_all on the whole signal.
+        :param block: next block of the signal
+        :return: onsets [s] from the beginning of the stream
+        """
+        signal = np.concatenate((self._remainder, block.astype('float32')))
+        n_hops = len(signal) // self.hop
+        self._remainder = signal[n_hops * self.hop:]
+        onsets = [np.float32(position) / np.float32(self.fs)
+                  for position in self._detect(signal[:n_hops * self.hop].reshape(n_hops, self.hop))]
+        if self._skip_first and onsets:
+            onsets = onsets[1:]
+            self._skip_first = False
+        return np.array(onsets)
+
+
+class NumpyOnsetDetector(object):
+    """
+    Onset detector with the same interface as OnsetDetector. It computes the detection function for all hops of a
+    block at once, from one batched FFT over a strided frame matrix, and then picks peaks. Detection functions and the
+    peak picker follow aubio: a biquad low-pass filtfilt over a 7-hop window, with threshold
+    filtered - median - mean * onset_threshold, a silence gate on the new hop, and a minimum inter-onset interval.
+    Aubio's adaptive whitening and log compression are not applied. Unlike aubio, the beginning of the stream is not
+    reported as an onset, and silent hops advance the clock.
+    """
+
+    # biquad low-pass used by aubio peak picker
+    _b = [0.15998789, 0.31997577, 0.15998789]
+    _a = [1.0, -0.59488894, 0.23484048]
+    _win_post = 5
+    _win_pre = 1
+
+    def __init__(self, fs,
+                 nfft: int = 512,
+                 hop: int = 256,
+                 onset_detector_type: str = 'hfc',
+                 onset_threshold: float = 0.01,
+                 onset_silence_threshold: float = -90,
+                 min_duration_s: float = 0.02):
+        if onset_detector_type not in ('hfc', 'energy', 'specflux', 'complex'):
+            raise ValueError(f'Onset detector {onset_detector_type} is not available in the numpy backend')
+        self.fs = fs
+        self.nfft = nfft
+        self.hop = hop
+        self.onset_detector_type = onset_detector_type
+        self.threshold = onset_threshold if onset_threshold else 0.058
+        self.silence = onset_silence_threshold if onset_silence_threshold else -70
+        self.minioi = int(round((min_duration_s if min_duration_s else 0.02) * fs))
+        self.delay = 4.3 * hop
+        self.window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(nfft) / nfft)
+        self._weights = np.arange(1, nfft // 2 + 2)
+
+        n_bins = nfft // 2 + 1
+        self._remainder = np.empty(0, dtype='float32')
+        self._history = np.zeros(max(nfft - hop, 0), dtype='float32')
+        self._previous_magnitude = np.zeros(n_bins)
+        self._previous_phases = np.zeros((2, n_bins))
+        self._odf_history = np.zeros(self._win_post + self._win_pre)
+        self._peek = np.zeros(2)
+        self._n_hops = 0
+        self._start = 0
+        self._last_onset = -np.inf
+
+    def _detection_function(self, spectrum: np.ndarray) -> np.ndarray:
+        magnitude = np.abs(spectrum)
+        if self.onset_detector_type == 'hfc':
+            return magnitude @ self._weights
+        elif self.onset_detector_type == 'energy':
+            return np.sum(magnitude ** 2, axis=1)
+
+        previous = np.concatenate((self._previous_magnitude[np.newaxis], magnitude[:-1]))
+        self._previous_magnitude = magnitude[-1]
+        if self.onset_detector_type == 'specflux':
+            return np.sum(np.maximum(magnitude - previous, 0), axis=1)
+
+        phase = np.angle(spectrum)
+        phases = np.concatenate((self._previous_phases, phase))
+        self._previous_phases = phases[-2:]
+        deviation = phase - 2 * phases[1:-1] + phases[:-2]
+        distance = previous ** 2 + magnitude ** 2 - 2 * previous * magnitude * np.cos(deviation)
+        return np.sum(np.sqrt(np.abs(distance)), axis=1)
+
+    def _thresholded(self, odf: np.ndarray) -> np.ndarray:
+        odf = np.concatenate((self._odf_history, odf))
+        self._odf_history = odf[-len(self._odf_history):]
+        keep = frame(odf, self._win_post + self._win_pre + 1, 1)
+        filtered = lfilter(self._b, self._a, keep, axis=1)
+        filtered = lfilter(self._b, self._a, filtered[:, ::-1], axis=1)[:, ::-1]
+        return filtered[:, self._win_post] - np.median(filtered, axis=1) - np.mean(filtered, axis=1) * self.threshold
+
+    def process(self, block):
+        """
+        Detect onsets in the next block of a stream. Detector state and samples that do not fill a complete hop are
+        carried over to the next call, so consecutive blocks give the same onsets as get_all on the whole signal.
+        :param block: next block of the signal
+        :return: onsets [s] from the beginning of the stream
+        """
+        signal = np.concatenate((self._remainder, block.astype('float32')))
+        n_hops = len(signal) // self.hop
+        self._remainder = signal[n_hops * self.hop:]
+        if n_hops == 0:
+            return np.empty(0)
+        new = signal[:n_hops * self.hop]
+        buffer = np.concatenate((self._history, new))
+        self._history = buffer[len(buffer) - len(self._history):]
+
+        frames = frame(buffer, self.nfft, self.hop)
+        spectrum = np.fft.rfft(frames * self.window, axis=1)
+        return self._onsets(spectrum, new)
+
+    def _onsets(self, spectrum: np.ndarray, new: np.ndarray) -> np.ndarray:
+        n_hops = len(spectrum)
+        thresholded = self._thresholded(self._detection_function(spectrum))
+
+        # peaks are confirmed one hop later, as in aubio
+        peek = np.concatenate((self._peek, thresholded))
+        self._peek = peek[-2:]
+        before, peak, after = peek[:-2], peek[1:-1], peek[2:]
+        idx = np.flatnonzero((peak > before) & (peak > after) & (peak > 0))
+
+        hops = new.reshape(n_hops, self.hop)[idx]
+        with np.errstate(divide='ignore'):
+            level = 10 * np.log10(np.mean(hops.astype('float64') ** 2, axis=1))
+        idx = idx[level >= self.silence]
+
+        curvature = before[idx] - 2 * peak[idx] + after[idx]
+        position = 1 + 0.5 * (before[idx] - after[idx]) / curvature
+        candidates = self._start + (self._n_hops + idx) * self.hop + np.round(position * self.hop)
+        self._n_hops += n_hops
+
+        onsets = []
+        for candidate in candidates:
+            if candidate > self._last_onset + self.minioi:
+                self._last_onset = candidate
+                onsets.append(max(candidate - self.delay, 0) / self.fs)
+        return np.array(onsets)
+
+    def get_all(self, signal, skip_first: bool = True, start: int = 0):
+        """
+        Detect onsets in the whole signal. A fresh detector takes the spectrogram from the shared STFT cache, so that
+        detecting again with other thresholds does not repeat the FFTs.
+        :param signal: 1-d signal
+        :param skip_first: kept for compatibility with OnsetDetector, the beginning of the signal is never reported
+        :param start: position of the signal when it is a segment of a longer one [samples], used by a fresh detector
+        :return: onsets [s]
+        """
+        if self._n_hops or len(self._remainder):
+            return self.process(signal)
+        self._start = start
+        signal = np.asarray(signal, dtype='float32')
+        n_hops = len(signal) // self.hop
+        if n_hops == 0:
+            return self.process(signal)
+        kind = 'complex' if self.onset_detector_type == 'complex' else 'magnitude'
+        spectrum = stft.spectrogram(signal, self.nfft, self.hop, kind=kind, pad_start=len(self._history))
+        new = signal[:n_hops * self.hop]
+        self._remainder = signal[n_hops * self.hop:]
+        self._history = np.concatenate((self._history, new))[n_hops * self.hop:]
+        return self._onsets(spectrum, new)
+
+
+def drop_close_onsets(onsets: np.ndarray, min_duration_s: float) -> np.ndarray:
+    """
+    Greedily drop onsets closer than min_duration_s to the previous kept onset
+    :param onsets: sorted onsets [s]
+    :param min_duration_s: minimum inter-onset interval [s]
+    :return: kept onsets [s]
+    """
+    if not min_duration_s or len(onsets) < 2 or np.all(np.diff(onsets) > min_duration_s):
+        return onsets
+    kept = [onsets[0]]
+    for onset_s in onsets[1:]:
+        if onset_s - kept[-1] > min_duration_s:
+            kept.append(onset_s)
+    return np.array(kept)
+
 
+def get_onset_detector(fs, nfft: int = 512, hop: int = 256, onset_detector_type: str = 'hfc',
+                       onset_threshold: float = 0.01, onset_silence_threshold: float = -90,
+                       min_duration_s: float = 0.02, backend: str = 'aubio'):
+    """
+    Get onset detector with given backend. See OnsetDetector for the parameters.
+    :param backend: 'aubio' or 'numpy'
+    :return: OnsetDetector or NumpyOnsetDetector
+    """
+    if backend == 'aubio':
+        detector_class = OnsetDetector
+    elif backend == 'numpy':
+        detector_class = NumpyOnsetDetector
+    else:
+        raise ValueError(f'Unknown onset backend {backend}, use one of {ONSET_BACKENDS}')
+    return detector_class(fs, nfft=nfft, hop=hop, onset_detector_type=onset_detector_type,
+                          onset_threshold=onset_threshold, onset_silence_threshold=onset_silence_threshold,
+                          min_duration_s=min_duration_s)
 
 
 def get_onsets(signal, fs, nfft, hop, onset_detector_type, onset_threshold=None,
@@ -16,8 +16,31 @@
 #      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
 
 import aubio
+import threading
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import as_strided
+from scipy import fft
+from settings import PITCH_BACKEND
+from audioexplorer import windowing
+
+
+PITCH_STATISTICS = ['pitch_median', 'pitch_mean', 'pitch_Q25', 'pitch_Q75', 'pitch_IQR', 'pitch_min', 'pitch_max']
+
+
+_detectors = threading.local()
+
+
+def _get_pitch_detector(algorithm: str, block_size: int, hop: int, fs: int, tolerance: float) -> aubio.pitch:
+    # one detector per thread and settings, so that workers do not set up aubio for every signal
+    detectors = _detectors.__dict__.setdefault('detectors', {})
+    key = (algorithm, block_size, hop, fs, tolerance)
+    if key not in detectors:
+        pitch_o = aubio.pitch(algorithm, block_size, hop, fs)
+        pitch_o.set_unit('Hz')
+        pitch_o.set_tolerance(tolerance)
+        detectors[key] = pitch_o
+    return detectors[key]
 
 
 def get_pitch_stats(signal: np.ndarray, fs: int, block_size: int, hop: int, tolerance: float = 0.8,
@@ -31,13 +54,17 @@ def get_pitch_stats(signal: np.ndarray, fs: int, block_size: int, hop: int, tole
     :param tolerance:  tolerance for the pitch detection algorithm (for aubio)
     :return:
     """
-    pitch_o = aubio.pitch(algorithm, block_size, hop, fs)
-    pitch_o.set_unit('Hz')
-    pitch_o.set_tolerance(tolerance)
-    signal_win = np.array_split(signal, np.arange(hop, len(signal), hop))
+    pitch_o = _get_pitch_detector(algorithm, block_size, hop, fs, tolerance)
+    # zeros push the previous signal out of the part of the buffer that is kept, so that it starts as a new one
+    silence = np.zeros(hop, dtype='float32')
+    for _ in range(-(-(block_size - hop) // hop)):
+        pitch_o(silence)
 
+    # hops are views on the signal, the trailing (possibly incomplete) hop is not processed
+    signal = np.asarray(signal, dtype='float32')
+    n_hops = max(0, -(-len(signal) // hop) - 1)
     pitch_array = []
-    for frame in signal_win[:-1]:
+    for frame in windowing.frame(signal, hop, hop)[:n_hops]:
         pitch = pitch_o(frame)[0]
         if pitch > 0:
             pitch_array.append(pitch)
@@ -46,20 +73,18 @@ def get_pitch_stats(signal: np.ndarray, fs: int, block_size: int, hop: int, tole
         pitch_array = np.array(pitch_array)
         Q25, Q50, Q75 = np.quantile(pitch_array, [0.25, 0.50, 0.75])
         IQR = Q75 - Q25
-        median = np.median(pitch_array)
         pitch_min = pitch_array.min()
         pitch_max = pitch_array.max()
     else:
         Q25 = 0
         Q50 = 0
         Q75 = 0
-        median = 0
         IQR = 0
         pitch_min = 0
         pitch_max = 0
 
     pitchstats = {
-        'pitch_median': median,
+        'pitch_median': Q50,
         'pitch_mean': Q50,
         'pitch_Q25': Q25,
         'pitch_Q75': Q75,
@@ -84,3 +109,197 @@ def get_pitch_stats_series(signal: np.ndarray, fs: int, block_size: int, hop: in
     pitchstats = get_pitch_stats(signal, fs, block_size, hop, tolerance)
     return pd.Series(pitchstats)
 
+
+# Frequency weighting applied by aubio yinfft [Hz], [dB]
+_YINFFT_FREQS = [0., 20., 25., 31.5, 40., 50., 63., 80., 100., 125., 160., 200., 250., 315., 400., 500., 630., 800.,
+                 1000., 1250., 1600., 2000., 2500., 3150., 4000., 5000., 6300., 8000., 9000., 10000., 12500., 15000.,
+                 20000., 25100.]
+_YINFFT_WEIGHTS = [-75.8, -70.1, -60.8, -52.1, -44.2, -37.5, -31.3, -25.6, -20.9, -16.5, -12.6, -9.6, -7.0, -4.7, -3.0,
+                   -1.8, -0.8, -0.2, -0.0, 0.5, 1.6, 3.2, 5.4, 7.8, 8.1, 5.3, -2.4, -11.1, -12.8, -12.2, -7.4, -17.8,
+                   -17.8, -17.8]
+
+
+def _hop_buffers(samples: np.ndarray, block_size: int, hop: int) -> np.ndarray:
+    """
+    Buffers seen by aubio.pitch when each row is fed hop by hop: every buffer ends with the latest hop and starts with
+    zeros until block_size samples have been fed. The incomplete (or last) hop is dropped, as in get_pitch_stats.
+    :return: read-only array of shape (n_samples, n_hops, block_size)
+    """
+    n_samples, length = samples.shape
+    n_hops = max(0, int(np.ceil(length / hop)) - 1)
+    padded = np.zeros((n_samples, block_size - hop + n_hops * hop), dtype='float32')
+    padded[:, block_size - hop:] = samples[:, :n_hops * hop]
+    return as_strided(padded, shape=(n_samples, n_hops, block_size),
+                      strides=(padded.strides[0], hop * padded.itemsize, padded.itemsize), writeable=False)
+
+
+def _quadratic_peak_pos(x: np.ndarray, pos: np.ndarray) -> np.ndarray:
+    # vectorised fvec_quadratic_peak_pos of aubio: parabola through neighbours of pos along the last axis
+    last = x.shape[-1] - 1
+    prev_pos = np.maximum(pos - 1, 0)
+    next_pos = np.minimum(pos + 1, last)
+    s0 = np.take_along_axis(x, prev_pos[..., None], axis=-1)[..., 0]
+    s1 = np.take_along_axis(x, pos[..., None], axis=-1)[..., 0]
+    s2 = np.take_along_axis(x, next_pos[..., None], axis=-1)[..., 0]
+    curvature = s0 - 2 * s1 + s2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        interpolated = pos + 0.5 * (s0 - s2) / curvature
+    at_edge = (pos == 0) | (pos == last) | (curvature == 0)
+    return np.where(at_edge, pos, interpolated)
+
+
+def _cumulative_mean_normalise(diff: np.ndarray) -> np.ndarray:
+    # yin[tau] = diff[tau] * tau / sum(diff[1:tau + 1]), computed in place
+    tau = np.arange(1, diff.shape[-1], dtype=diff.dtype)
+    running = np.cumsum(diff[..., 1:], axis=-1)
+    yin = np.empty_like(diff)
+    yin[..., 0] = 1.0
+    np.multiply(diff[..., 1:], tau, out=yin[..., 1:])
+    zero = running == 0
+    running[zero] = 1.0
+    np.divide(yin[..., 1:], running, out=yin[..., 1:])
+    yin[..., 1:][zero] = 1.0
+    return yin
+
+
+def _yinfft_weights(fs: int, block_size: int) -> np.ndarray:
+    freqs = np.arange(block_size // 2 + 1) * fs / block_size
+    return 10 ** (0.05 * np.interp(freqs, _YINFFT_FREQS, _YINFFT_WEIGHTS))
+
+
+def yinfft_periods(buffers: np.ndarray, fs: int, tolerance: float) -> np.ndarray:
+    """
+    Vectorised YIN in the spectral domain, after aubio yinfft
+    :param buffers: array of shape (..., block_size)
+    :param fs: sampling frequency
+    :param tolerance: threshold on the normalised difference function
+    :return: period of every buffer [samples], 0 where no pitch was found
+    """
+    block_size = buffers.shape[-1]
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(block_size) / block_size)).astype('float32')
+    spectrum = fft.rfft(buffers * window, axis=-1, workers=-1)
+    power = spectrum.real ** 2
+    power += spectrum.imag ** 2
+    power *= _yinfft_weights(fs, block_size).astype('float32')
+    # autocorrelation of the weighted spectrum, irfft mirrors the spectrum like aubio does
+    autocorrelation = fft.irfft(power, n=block_size, axis=-1, workers=-1)[..., :block_size // 2 + 1] * block_size
+    total = 2 * power.sum(axis=-1)
+    np.subtract(total[..., None], autocorrelation, out=autocorrelation)
+    yin = _cumulative_mean_normalise(autocorrelation)
+
+    tau = np.argmin(yin, axis=-1)
+    found = np.take_along_axis(yin, tau[..., None], axis=-1)[..., 0] < tolerance
+    # check for octave errors on short periods
+    half = np.floor(tau / 2 + 0.5).astype(int)
+    half_found = np.take_along_axis(yin, half[..., None], axis=-1)[..., 0] < tolerance
+    short_period = int(np.floor(fs / 1300.0))
+    peak = np.where((tau <= short_period) & half_found, half, tau)
+    return np.where(found, _quadratic_peak_pos(yin, peak), 0.0)
+
+
+def yin_periods(buffers: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Vectorised YIN, after aubio yin. The difference function is computed over half of the buffer. Unlike aubio, buffers
+    that are still mostly zero at the start of a signal give no pitch.
+    :param buffers: array of shape (..., block_size)
+    :param tolerance: threshold on the normalised difference function
+    :return: period of every buffer [samples]
+    """
+    block_size = buffers.shape[-1]
+    half = block_size // 2
+    head = buffers[..., :half]
+    n_fft = 2 ** int(np.ceil(np.log2(block_size + half)))
+    cross = fft.irfft(np.conj(fft.rfft(head, n=n_fft, axis=-1, workers=-1)) * fft.rfft(buffers, n=n_fft, axis=-1,
+                                                                                      workers=-1),
+                      n=n_fft, axis=-1, workers=-1)[..., :half]
+    squares = np.cumsum(np.concatenate((np.zeros(buffers.shape[:-1] + (1,)), buffers ** 2), axis=-1), axis=-1)
+    shifted_energy = squares[..., half:half + half] - squares[..., :half]
+    diff = squares[..., half:half + 1] + shifted_energy - 2 * cross
+    yin = _cumulative_mean_normalise(diff)
+
+    # first local minimum under the tolerance, otherwise the global minimum
+    period = np.arange(2, half - 3)
+    candidate = (yin[..., period] < tolerance) & (yin[..., period] < yin[..., period + 1])
+    first = period[np.argmax(candidate, axis=-1)] if len(period) else np.zeros(yin.shape[:-1], dtype=int)
+    tau = np.where(candidate.any(axis=-1), first, np.argmin(yin, axis=-1))
+    return _quadratic_peak_pos(yin, tau)
+
+
+def pitch_statistics(pitch: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    Statistics of positive pitch values of every row
+    :param pitch: 2-d array of pitch per frame, non-positive values are ignored
+    :param out: optional array of shape (n_rows, len(PITCH_STATISTICS)) to be filled
+    :return: statistics, columns ordered as in PITCH_STATISTICS. Rows without pitch are all zeros.
+    """
+    if out is None:
+        out = np.empty((len(pitch), len(PITCH_STATISTICS)), dtype='float32')
+    valid = pitch > 0
+    count = valid.sum(axis=1)
+    if pitch.shape[1] == 0:
+        out[:] = 0
+        return out
+    # invalid values are sorted to the end of every row
+    ordered = np.sort(np.where(valid, pitch, np.inf), axis=1)
+    ordered[~valid.any(axis=1)] = 0
+    last = np.maximum(count - 1, 0)
+
+    def quantile(q):
+        # linear interpolation between closest ranks, as np.quantile
+        position = q * last
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, last)
+        lower_value = np.take_along_axis(ordered, lower[:, None], axis=1)[:, 0]
+        upper_value = np.take_along_axis(ordered, upper[:, None], axis=1)[:, 0]
+        return lower_value + (upper_value - lower_value) * (position - lower)
+
+    q25, q50, q75 = quantile(0.25), quantile(0.5), quantile(0.75)
+    stats = np.column_stack((q50, q50, q25, q75, q75 - q25, ordered[:, 0], quantile(1.0)))
+    stats[count == 0] = 0
+    out[:] = stats
+    return out
+
+
+def get_pitch_stats_batch(samples: np.ndarray, fs: int, block_size: int, hop: int, tolerance: float = 0.5,
+                          out: np.ndarray = None, algorithm: str = 'yinfft', backend: str = PITCH_BACKEND,
+                          silence: float = -50, chunk_size: int = 256) -> np.ndarray:
+    """
+    Get basic statistic on pitch for a batch of signals
+    :param samples: 2-d array of signals, one per row
+    :param fs: sampling frequency
+    :param block_size: window size
+    :param hop: size of a hop between frames
+    :param tolerance:  tolerance for the pitch detection algorithm (for aubio)
+    :param out: optional array of shape (n_samples, len(PITCH_STATISTICS)) to be filled
+    :param algorithm: yinfft or yin
+    :param backend: 'aubio' feeds every sample through one reused aubio.pitch, 'numpy' computes pitch of all frames at
+    once
+    :param silence: frames with the new hop quieter than this are unvoiced [dB], as in aubio (numpy backend)
+    :param chunk_size: number of samples processed at once (numpy backend)
+    :return: pitch statistics, columns ordered as in PITCH_STATISTICS
+    """
+    if out is None:
+        out = np.empty((len(samples), len(PITCH_STATISTICS)), dtype='float32')
+    if backend == 'aubio':
+        for idx, signal in enumerate(samples):
+            pitchstats = get_pitch_stats(signal, fs, block_size, hop, tolerance, algorithm=algorithm)
+            out[idx] = [pitchstats[name] for name in PITCH_STATISTICS]
+        return out
+    elif backend != 'numpy':
+        raise ValueError(f'Unknown pitch backend {backend}')
+
+    for start in range(0, len(samples), chunk_size):
+        buffers = _hop_buffers(np.asarray(samples[start:start + chunk_size]), block_size, hop)
+        if algorithm == 'yinfft':
+            periods = yinfft_periods(buffers, fs, tolerance)
+        elif algorithm == 'yin':
+            periods = yin_periods(buffers, tolerance)
+        else:
+            raise ValueError(f'Pitch algorithm {algorithm} is not available in the numpy backend')
+        hops = buffers[..., -hop:]
+        with np.errstate(divide='ignore'):
+            level = 10 * np.log10(np.mean(hops ** 2, axis=-1))
+        with np.errstate(divide='ignore'):
+            pitch = np.where((periods > 0) & (level >= silence), fs / periods, 0.0)
+        pitch_statistics(pitch, out=out[start:start + len(buffers)])
+    return out
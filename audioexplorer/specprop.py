@@ -17,7 +17,11 @@
 
 import numpy as np
 import pandas as pd
-from scipy import signal
+from scipy import signal, ndimage
+
+
+SPECTRAL_STATISTICS = ['freq_mean', 'freq_median', 'freq_mode', 'freq_Q25', 'freq_Q75', 'freq_IQR',
+                       'freq_peak.1', 'freq_peak.2', 'freq_peak.3']
 
 
 def spectral_statistics(y: np.ndarray, fs: int, lowcut: int = 0) -> dict:
@@ -84,4 +88,51 @@ def spectral_statistics_series(y: np.ndarray, fs: int, lowcut: int = 0) -> pd.Se
     return pd.Series(spec)
 
 
+def _quantile_freqs(freq: np.ndarray, amp_cumsum: np.ndarray, q: float) -> np.ndarray:
+    # as in spectral_statistics: the bin after the last one with cumulative power <= q. The cumulative sum is
+    # monotonic, so the count equals a per-row searchsorted
+    idx = np.count_nonzero(amp_cumsum <= q, axis=-1) + 1
+    return freq[np.minimum(idx, len(freq) - 1)]
+
+
+def _top_peaks(freq: np.ndarray, amp_smooth: np.ndarray, out: np.ndarray, n_peaks: int = 3,
+               distance: int = 100, height: float = 0.002):
+    out[:] = 0
+    # only rows that reach the height can have peaks
+    for row in np.flatnonzero(amp_smooth.max(axis=-1) >= height):
+        peaks, height_d = signal.find_peaks(amp_smooth[row], distance=distance, height=height)
+        top = peaks[height_d['peak_heights'].argsort()[-n_peaks:][::-1]]
+        out[row, :len(top)] = freq[top]
+
 
+def spectral_statistics_batch(samples: np.ndarray, fs: int, lowcut: int = 0, out: np.ndarray = None,
+                              chunk_size: int = 256) -> np.ndarray:
+    """
+    Compute selected statistical properties of spectrum for a batch of signals, as in spectral_statistics. Welch
+    spectra, quantiles and median filtering run over all rows of a chunk at once; only the peak picking is per row.
+
+    :param samples: 2-d array of signals, one per row
+    :param fs: sampling frequency [Hz]
+    :param lowcut: lowest frequency [Hz]
+    :param out: optional array of shape (n_samples, len(SPECTRAL_STATISTICS)) to be filled
+    :param chunk_size: number of rows processed at once, bounds the memory of Welch segments
+    :return: spectral features, columns ordered as in SPECTRAL_STATISTICS
+    """
+    if out is None:
+        out = np.empty((len(samples), len(SPECTRAL_STATISTICS)), dtype='float32')
+    for start in range(0, len(samples), chunk_size):
+        chunk = np.asarray(samples[start:start + chunk_size])
+        block = out[start:start + len(chunk)]
+        freq, spec = signal.welch(chunk, fs=fs, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            amp = spec / spec.sum(axis=-1, keepdims=True)
+        amp_cumsum = np.cumsum(amp, axis=-1)
+        block[:, 0] = (freq * amp).sum(axis=-1)
+        block[:, 1] = _quantile_freqs(freq, amp_cumsum, 0.5)
+        block[:, 2] = freq[amp.argmax(axis=-1)]
+        block[:, 3] = _quantile_freqs(freq, amp_cumsum, 0.25)
+        block[:, 4] = _quantile_freqs(freq, amp_cumsum, 0.75)
+        block[:, 5] = block[:, 4] - block[:, 3]
+        amp_smooth = ndimage.median_filter(amp, size=(1, 15), mode='constant')
+        _top_peaks(freq, amp_smooth, block[:, 6:9])
+    return out
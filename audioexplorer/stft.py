@@ -0,0 +1,210 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
+from scipy import fft
+from scipy import signal as sps
+from settings import STFT_CACHE_MB
+from audioexplorer.windowing import frame
+
+STFT_KINDS = ['complex', 'magnitude', 'power']
+
+
+def content_hash(signal: np.ndarray) -> str:
+    """
+    Hash of the samples of a signal, so that equal signals share spectrograms whatever array holds them
+    :param signal: 1-d signal
+    :return: hex digest
+    """
+    signal = np.ascontiguousarray(signal)
+    blake = hashlib.blake2b(digest_size=16)
+    blake.update(f'{signal.dtype.str}{signal.shape}'.encode())
+    blake.update(memoryview(signal).cast('B'))
+    return blake.hexdigest()
+
+
+@lru_cache(maxsize=32)
+def get_fft_window(window: str, block_size: int, periodic: bool = True) -> np.ndarray:
+    """
+    Analysis window, memoised
+    :param window: name of the window, see scipy.signal.get_window
+    :param block_size: length of the window [samples]
+    :param periodic: periodic window as used for spectral analysis. False for a symmetric one, e.g. numpy.hanning
+    :return: read-only window
+    """
+    values = sps.get_window(window, block_size, fftbins=periodic)
+    values.flags.writeable = False
+    return values
+
+
+class STFTCache(object):
+    """
+    Memory-bounded cache of spectrograms, least recently used first out. Spectrograms larger than the cap are computed
+    but not kept.
+    """
+
+    def __init__(self, max_mb: float = STFT_CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            spectrogram = self._entries.get(key)
+            if spectrogram is not None:
+                self._entries.move_to_end(key)
+            return spectrogram
+
+    def put(self, key: tuple, spectrogram: np.ndarray):
+        if spectrogram.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = spectrogram
+            self.nbytes += spectrogram.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+_cache = STFTCache()
+
+
+def get_cache() -> STFTCache:
+    return _cache
+
+
+def _front_pad(block_size: int, step_size: int, residue: int) -> int:
+    # the largest padding shorter than a block on the grid of the residue: earlier frames hold no sample of the signal
+    return residue + step_size * ((block_size - 1 - residue) // step_size)
+
+
+def _compute(signal: np.ndarray, block_size: int, step_size: int, window: np.ndarray, pad_start: int,
+             chunk_size: int = 4096) -> np.ndarray:
+    # every frame on the grid that holds a sample of the signal
+    length = pad_start + len(signal)
+    n_frames = max(1, -(-length // step_size))
+    padded = np.zeros((n_frames - 1) * step_size + block_size, dtype=signal.dtype)
+    padded[pad_start:length] = signal
+    frames = frame(padded, block_size, step_size)
+    spectrogram = np.empty((len(frames), block_size // 2 + 1), dtype='complex64')
+    # chunks bound the memory of the windowed frames
+    for start in range(0, len(frames), chunk_size):
+        spectrogram[start:start + chunk_size] = fft.rfft(frames[start:start + chunk_size] * window, axis=-1,
+                                                         workers=-1)
+    return spectrogram
+
+
+def spectrogram(signal: np.ndarray, block_size: int, step_size: int, window: str = 'hann', periodic: bool = True,
+                kind: str = 'magnitude', pad_start: int = 0, pad_end: bool = False,
+                cache: STFTCache = None) -> np.ndarray:
+    """
+    Short-time Fourier transform of a signal. Frame i starts at sample i * step_size of the (padded) signal,
+    incomplete trailing frames are dropped. One complex spectrogram holding every frame of the signal is cached per
+    signal content, FFT parameters and window, and shared by all kinds and paddings on the same frame grid: padding
+    only selects its frames, magnitude and power are computed from it.
+    :param signal: 1-d signal
+    :param block_size: FFT size
+    :param step_size: number of samples between starts of consecutive frames
+    :param window: name of the window, see scipy.signal.get_window
+    :param periodic: periodic or symmetric window
+    :param kind: complex spectrum, magnitude or power. Returned as complex64 or float32
+    :param pad_start: number of zeros to put in front of the signal
+    :param pad_end: zero-pad the end, so that ceil(length / step_size) frames cover the signal as in YAAFE
+    :param cache: cache to use. Defaults to the process-wide cache
+    :return: read-only spectrogram of shape (n_frames, block_size // 2 + 1)
+    """
+    if kind not in STFT_KINDS:
+        raise ValueError(f'Unknown spectrogram kind {kind}, use one of {STFT_KINDS}')
+    if cache is None:
+        cache = _cache
+    residue = pad_start % step_size
+    front = _front_pad(block_size, step_size, residue)
+    key = (content_hash(signal), block_size, step_size, window, periodic, residue)
+    complex_spectrogram = cache.get(key)
+    if complex_spectrogram is None:
+        logging.debug(f'Computing spectrogram of {len(signal)} samples with block size {block_size}')
+        complex_spectrogram = _compute(np.asarray(signal), block_size, step_size,
+                                       get_fft_window(window, block_size, periodic), front)
+        complex_spectrogram.flags.writeable = False
+        cache.put(key, complex_spectrogram)
+
+    length = pad_start + len(signal)
+    if pad_end:
+        n_frames = max(1, -(-length // step_size))
+    else:
+        n_frames = max(0, 1 + (length - block_size) // step_size)
+    first = (front - pad_start) // step_size  # negative when padded with more all-zero frames than cached
+    if 0 <= first and first + n_frames <= len(complex_spectrogram):
+        result = complex_spectrogram[first:first + n_frames]
+    else:
+        result = np.zeros((n_frames, complex_spectrogram.shape[1]), dtype='complex64')
+        lo, hi = max(first, 0), min(first + n_frames, len(complex_spectrogram))
+        if lo < hi:
+            result[lo - first:hi - first] = complex_spectrogram[lo:hi]
+
+    if kind == 'magnitude':
+        result = np.abs(result)
+    elif kind == 'power':
+        result = np.square(result.real) + np.square(result.imag)
+    result.flags.writeable = False
+    return result
+
+
+def welch(signal: np.ndarray, fs: int, block_size: int, step_size: int = None, window: str = 'hann',
+          scaling: str = 'density', cache: STFTCache = None) -> (np.ndarray, np.ndarray):
+    """
+    Welch estimate of the power spectrum from the cached power spectrogram. Same as scipy.signal.welch with
+    detrend=False and nfft=nperseg=block_size.
+    :param signal: 1-d signal
+    :param fs: sampling rate [Hz]
+    :param block_size: FFT size
+    :param step_size: step between segments. Defaults to half of the block size
+    :param window: name of the window
+    :param scaling: density [V**2/Hz] or spectrum [V**2]
+    :param cache: cache to use. Defaults to the process-wide cache
+    :return: frequencies and power spectrum
+    """
+    if step_size is None:
+        step_size = block_size // 2
+    if len(signal) < block_size:
+        return sps.welch(signal, fs, window=window, nperseg=block_size, nfft=block_size,
+                         noverlap=block_size - step_size, detrend=False, scaling=scaling)
+    power = spectrogram(signal, block_size, step_size, window=window, kind='power', cache=cache)
+    weights = get_fft_window(window, block_size)
+    if scaling == 'density':
+        scale = 1.0 / (fs * (weights ** 2).sum())
+    elif scaling == 'spectrum':
+        scale = 1.0 / weights.sum() ** 2
+    else:
+        raise ValueError(f'Unknown scaling {scaling}')
+    spec = power.mean(axis=0, dtype='float64') * scale
+    # one-sided spectrum: double all but DC and, for even block sizes, Nyquist
+    spec[1:-1 if block_size % 2 == 0 else None] *= 2
+    return np.fft.rfftfreq(block_size, d=1 / fs), spec
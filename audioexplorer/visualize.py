@@ -29,7 +29,7 @@ from io import BytesIO
 from collections import OrderedDict
 from scipy import signal
 from numpy.lib.stride_tricks import as_strided
-from audioexplorer import yaafe_wrapper
+from audioexplorer import yaafe_wrapper, stft
 
 import plotly.io as pio
 pio.templates.default = "none"
@@ -98,8 +98,7 @@ def power_spectrum(y: np.ndarray, fs: int, block_size: int=512, scaling: str='sp
     :param cutoff: cut all signal below this strength
     :return: plotly Figure
     """
-    f, spec = signal.welch(y, fs, scaling=scaling, nperseg=block_size, nfft=block_size, noverlap=block_size // 2,
-                           detrend=False)
+    f, spec = stft.welch(y, fs, block_size=block_size, step_size=block_size - block_size // 2, scaling=scaling)
     spec = 10 * np.log10(spec)
     trace = go.Scatter(x=f, y=spec, fill='tozerox')
 
@@ -0,0 +1,134 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def frame(signal: np.ndarray, frame_len: int, hop: int) -> np.ndarray:
+    """
+    Split signal into overlapping frames without copying. Incomplete trailing frame is dropped.
+    :param signal: 1-d signal
+    :param frame_len: length of a frame [samples]
+    :param hop: number of samples between starts of consecutive frames
+    :return: read-only view of shape (n_frames, frame_len)
+    """
+    signal = np.ascontiguousarray(signal)
+    n_frames = max(0, 1 + (len(signal) - frame_len) // hop)
+    frames = as_strided(signal, shape=(n_frames, frame_len), strides=(hop * signal.itemsize, signal.itemsize),
+                        writeable=False)
+    return frames
+
+
+def window_length(fs: int, sample_len: float) -> int:
+    """
+    Number of samples in a window of given duration
+    :param fs: sampling rate [Hz]
+    :param sample_len: duration of the window [s]
+    :return: window length [samples]
+    """
+    return int(round(sample_len * fs))
+
+
+def onset_windows(signal: np.ndarray, fs: int, onsets: np.ndarray, sample_len: float) -> np.ndarray:
+    """
+    Cut fixed-length windows starting at each onset. Evenly spaced onsets produce a strided view on the signal, other
+    onsets are gathered into one contiguous buffer. Windows running past the end of the signal are zero-padded.
+    :param signal: 1-d signal
+    :param fs: sampling rate [Hz]
+    :param onsets: window starts [s]
+    :param sample_len: duration of each window [s]
+    :return: read-only array of shape (len(onsets), window length)
+    """
+    starts = (np.asarray(onsets) * fs).astype(int)
+    return sample_windows(signal, starts, window_length(fs, sample_len))
+
+
+def sample_windows(signal: np.ndarray, starts: np.ndarray, win_len: int) -> np.ndarray:
+    """
+    Cut fixed-length windows at given sample positions, see onset_windows
+    :param signal: 1-d signal
+    :param starts: sorted window starts [samples]
+    :param win_len: window length [samples]
+    :return: read-only array of shape (len(starts), win_len)
+    """
+    signal = np.ascontiguousarray(signal)
+    if not np.all(np.diff(starts) >= 0):
+        raise ValueError('Onsets must be sorted')
+    n_complete = np.searchsorted(starts, len(signal) - win_len, side='right') if len(signal) >= win_len else 0
+
+    if n_complete == len(starts):
+        windows = _windows_at(signal, starts, win_len)
+    else:
+        windows = np.zeros((len(starts), win_len), dtype=signal.dtype)
+        windows[:n_complete] = _windows_at(signal, starts[:n_complete], win_len)
+        for idx, start in enumerate(starts[n_complete:], start=n_complete):
+            tail = signal[start:]
+            windows[idx, :len(tail)] = tail
+        windows.flags.writeable = False
+    return windows
+
+
+def _windows_at(signal: np.ndarray, starts: np.ndarray, win_len: int) -> np.ndarray:
+    if len(starts) == 0:
+        return np.empty((0, win_len), dtype=signal.dtype)
+    hops = np.diff(starts)
+    if len(starts) == 1 or (hops[0] > 0 and np.all(hops == hops[0])):
+        hop = hops[0] if len(hops) else win_len
+        return frame(signal[starts[0]:starts[-1] + win_len], win_len, hop)
+    windows = frame(signal, win_len, 1)[starts]
+    windows.flags.writeable = False
+    return windows
+
+
+def gather_ranges(signal: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Concatenate ranges of a signal, in the given order. Ranges are sorted and merged first, so that every sample of a
+    memory-mapped signal is read at most once and in file order, then copied into one preallocated buffer.
+    :param signal: signal, indexed along the first axis
+    :param starts: range starts [samples]
+    :param ends: range ends (exclusive) [samples]. Ranges are clipped to the signal
+    :return: concatenated ranges and offsets of each range in them, of length len(starts) + 1
+    """
+    starts = np.clip(np.asarray(starts, dtype=int), 0, len(signal))
+    ends = np.maximum(np.clip(np.asarray(ends, dtype=int), 0, len(signal)), starts)
+    lengths = ends - starts
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    out = np.empty((offsets[-1],) + signal.shape[1:], dtype=signal.dtype)
+    if offsets[-1] == 0:
+        return out, offsets
+
+    # merge overlapping and touching ranges into spans and read each span once
+    used = np.flatnonzero(lengths)
+    order = used[np.argsort(starts[used], kind='stable')]
+    sorted_starts = starts[order]
+    running_end = np.maximum.accumulate(ends[order])
+    first_in_span = np.concatenate(([True], sorted_starts[1:] > running_end[:-1]))
+    span_ids = np.cumsum(first_in_span) - 1
+    span_starts = sorted_starts[first_in_span]
+    span_ends = running_end[np.append(np.flatnonzero(first_in_span)[1:] - 1, len(order) - 1)]
+    span_offsets = np.concatenate(([0], np.cumsum(span_ends - span_starts)))
+    buffer = np.empty((span_offsets[-1],) + signal.shape[1:], dtype=signal.dtype)
+    for span_start, span_end, span_offset in zip(span_starts, span_ends, span_offsets):
+        buffer[span_offset:span_offset + span_end - span_start] = signal[span_start:span_end]
+
+    # copy every range from its span, in the requested order
+    buffer_starts = np.zeros(len(starts), dtype=int)
+    buffer_starts[order] = span_offsets[span_ids] + sorted_starts - span_starts[span_ids]
+    for offset, length, buffer_start in zip(offsets[used], lengths[used], buffer_starts[used]):
+        out[offset:offset + length] = buffer[buffer_start:buffer_start + length]
+    return out, offsets
@@ -0,0 +1,214 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import uuid
+import atexit
+import logging
+import multiprocessing
+import numpy as np
+from settings import TEMP_STORAGE
+from audioexplorer.windowing import sample_windows, window_length
+from audioexplorer.onsets import drop_close_onsets
+
+# State kept alive in each worker process between tasks
+_worker_extractors = {}
+_worker_signal = {}
+
+
+def _get_worker_extractor(fs: int, block_size: int, step_size: int, selected_features):
+    # imported here to avoid a circular import with features
+    from audioexplorer.features import FeatureExtractor
+
+    key = (fs, block_size, step_size, tuple(selected_features) if selected_features != 'all' else 'all')
+    if key not in _worker_extractors:
+        _worker_extractors[key] = FeatureExtractor(fs=fs, block_size=block_size, step_size=step_size,
+                                                   selected_features=selected_features)
+    return _worker_extractors[key]
+
+
+def _get_worker_signal(path: str, length: int) -> np.ndarray:
+    key = (path, length)
+    if key not in _worker_signal:
+        _worker_signal.clear()
+        _worker_signal[key] = np.memmap(path, dtype='float32', mode='r', shape=(length,))
+    return _worker_signal[key]
+
+
+def _extract_task(task: tuple) -> (np.ndarray, list):
+    path, length, starts, win_len, fs, block_size, step_size, selected_features = task
+    signal = _get_worker_signal(path, length)
+    extractor = _get_worker_extractor(fs, block_size, step_size, selected_features)
+    windows = sample_windows(signal, starts, win_len)
+    return extractor.get_features_batch(windows)
+
+
+def _onset_task(task: tuple) -> np.ndarray:
+    # imported here to avoid a circular import with features
+    from audioexplorer.features import _get_onset_detector
+
+    path, length, segment_start, segment_stop, own_start_s, own_stop_s, fs, params = task
+    signal = _get_worker_signal(path, length)
+    detector = _get_onset_detector(fs, params)
+    # aubio reports the start of a segment as an onset. Past the first segment it falls into the overlap, unowned
+    onsets = detector.get_all(np.asarray(signal[segment_start:segment_stop]), skip_first=segment_start == 0,
+                              start=segment_start)
+    return onsets[(onsets >= own_start_s) & (onsets < own_stop_s)]
+
+
+def _is_whole_float32_memmap(signal: np.ndarray) -> bool:
+    return isinstance(signal, np.memmap) and signal.filename is not None and signal.dtype == np.float32 \
+        and signal.offset == 0 and signal.flags.c_contiguous and os.path.getsize(signal.filename) == signal.nbytes
+
+
+class SharedSignal(object):
+    """
+    Float32 signal backed by a file in TEMP_STORAGE, so that worker processes can map it instead of receiving
+    pickled copies. Signals that are already float32 memmaps are shared as they are.
+    """
+
+    def __init__(self, signal: np.ndarray):
+        self.length = len(signal)
+        self.owner = False
+        if _is_whole_float32_memmap(signal):
+            self.path = signal.filename
+        else:
+            self.path = os.path.join(TEMP_STORAGE, f'shared_{uuid.uuid4().hex}.f32')
+            self.owner = True
+            mm = np.memmap(self.path, dtype='float32', mode='w+', shape=(self.length,))
+            mm[:] = signal
+            mm.flush()
+            del mm
+
+    def close(self):
+        if self.owner and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FeaturePool(object):
+    """
+    Persistent pool of feature extraction workers. Every worker keeps its FeatureExtractor (and YAAFE engine) warm
+    across calls and maps the filtered signal from disk, so that only onsets travel between processes.
+    """
+
+    def __init__(self, n_jobs: int = -1, tasks_per_job: int = 4):
+        if n_jobs < 1:
+            n_jobs = multiprocessing.cpu_count()
+        self.n_jobs = n_jobs
+        self.tasks_per_job = tasks_per_job
+        self.pool = multiprocessing.Pool(processes=n_jobs)
+
+    def extract(self, X: np.ndarray, fs: int, onsets: np.ndarray, sample_len: float, block_size: int,
+                step_size: int = None, selected_features='all') -> (np.ndarray, list):
+        """
+        Extract features for windows starting at onsets
+        :param X: filtered 1-d signal
+        :param fs: sampling rate [Hz]
+        :param onsets: window starts [s]
+        :param sample_len: duration of each window [s]
+        :param block_size: FFT size
+        :param step_size: FFT step
+        :param selected_features: features to extract, as in FeatureExtractor
+        :return: feature matrix (float32) and list of column names
+        """
+        starts = (np.asarray(onsets) * fs).astype(int)
+        return self.extract_at(X, fs, starts, window_length(fs, sample_len), block_size=block_size,
+                               step_size=step_size, selected_features=selected_features)
+
+    def extract_at(self, X: np.ndarray, fs: int, starts: np.ndarray, win_len: int, block_size: int,
+                   step_size: int = None, selected_features='all') -> (np.ndarray, list):
+        """
+        Same as extract, with window starts and length given in samples
+        """
+        n_tasks = max(1, min(len(starts), self.n_jobs * self.tasks_per_job))
+        with SharedSignal(X) as shared:
+            tasks = [(shared.path, shared.length, chunk, win_len, fs, block_size, step_size, selected_features)
+                     for chunk in np.array_split(starts, n_tasks)]
+            results = self.pool.map(_extract_task, tasks)
+        columns = results[0][1]
+        features = np.concatenate([block for block, _ in results])
+        return features, columns
+
+    def detect_onsets(self, X: np.ndarray, fs: int, params: dict, segment_s: float = 60.0,
+                      overlap_s: float = 2.0) -> np.ndarray:
+        """
+        Detect onsets in segments of the signal in parallel. Every segment owns the onsets that fall into it, and is
+        extended on both sides by an overlap in which the detector warms up and confirms late onsets. Onsets closer
+        than min_duration_s across the seams are dropped, as the serial detector would do.
+        :param X: filtered 1-d signal
+        :param fs: sampling rate [Hz]
+        :param params: parsed onset and FFT parameters, see features.parse_params
+        :param segment_s: duration of the part of the signal owned by a segment [s]
+        :param overlap_s: overlap added on each side of a segment [s]
+        :return: onsets [s]
+        """
+        from audioexplorer.features import _get_onset_detector
+
+        hop = params['step_size']
+        segment = max(1, int(segment_s * fs) // hop) * hop  # keep segments aligned with the serial hops
+        overlap = int(np.ceil(overlap_s * fs / hop)) * hop
+        own_starts = np.arange(0, len(X), segment)
+        if len(own_starts) < 2:
+            return _get_onset_detector(fs, params).get_all(X)
+
+        own_stops = np.append(own_starts[1:], len(X))
+        segment_starts = np.maximum(0, own_starts - overlap)
+        segment_stops = np.minimum(len(X), own_stops + overlap)
+        # bounds in the float32 arithmetic of the onset times, so that an onset on a seam has exactly one owner
+        own_bounds = np.append(own_starts.astype('float32') / np.float32(fs), np.inf)
+        with SharedSignal(X) as shared:
+            tasks = [(shared.path, shared.length, int(segment_starts[idx]), int(segment_stops[idx]),
+                      own_bounds[idx], own_bounds[idx + 1], fs, params)
+                     for idx in range(len(own_starts))]
+            results = self.pool.map(_onset_task, tasks)
+        return drop_close_onsets(np.concatenate(results), params['min_duration_s'])
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+_pool = None
+
+
+def get_pool(n_jobs: int = -1) -> FeaturePool:
+    """
+    Get process-wide feature pool, so that the CLI and the app reuse the same warm workers
+    :param n_jobs: number of workers. -1 for all cores
+    :return: FeaturePool
+    """
+    global _pool
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    if _pool is None or _pool.n_jobs != n_jobs:
+        if _pool is not None:
+            _pool.close()
+        logging.info(f'Starting feature pool with {n_jobs} workers')
+        _pool = FeaturePool(n_jobs=n_jobs)
+    return _pool
+
+
+@atexit.register
+def _close_pool():
+    if _pool is not None:
+        _pool.close()
@@ -0,0 +1,358 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Experimental NumPy implementation of the YAAFE feature set used by YaafeWrapper. Features are computed for a batch of
+windows at once from a (window, frame, sample) tensor, following the definitions from the YAAFE documentation with the
+settings used in YaafeWrapper: OBSI from a triangular octave filter bank, crest factors over the MPEG-7 quarter-octave
+bands and Chroma2 folded from a constant-Q transform. It is not validated against yaafelib until
+benchmarks/yaafe_backends.py passes against a reference recorded with yaafelib.
+"""
+
+import numpy as np
+from functools import lru_cache
+from numpy.lib.stride_tricks import as_strided
+from scipy.fftpack import dct
+
+EPS = np.finfo(float).eps
+
+MFCC_MIN_FREQ = 400.0
+MFCC_MAX_FREQ = 6000.0
+MFCC_N_FILTERS = 40
+MFCC_N_COEFFS = 13
+LPC_N_COEFFS = 1
+LSF_N_COEFFS = 10
+OBSI_MIN_FREQ = 27.5
+CQT_MIN_FREQ = 27.5  # A0, in tune with A4 at 440 Hz
+CQT_BINS_PER_OCTAVE = 48
+CQT_N_OCTAVES = 7
+CHROMA_BINS_PER_SEMITONE = CQT_BINS_PER_OCTAVE // 12
+CREST_MIN_FREQ = 250.0
+ROLLOFF = 0.99
+
+NUMPY_FEATURES = ['Chroma', 'LPC', 'LSF', 'MFCC', 'OBSI', 'SpectralCrestFactorPerBand', 'SpectralDecrease',
+                  'SpectralFlatness', 'SpectralFlux', 'SpectralRolloff', 'SpectralVariation', 'ZCR']
+
+
+def frame_rows(samples: np.ndarray, block_size: int, step_size: int) -> np.ndarray:
+    """
+    Split every row into frames. Rows are zero-padded at the end so that ceil(length / step_size) frames cover them.
+    :param samples: 2-d array of signals, one per row
+    :param block_size: frame length [samples]
+    :param step_size: number of samples between starts of consecutive frames
+    :return: read-only float64 array of shape (n_samples, n_frames, block_size)
+    """
+    n_samples, length = samples.shape
+    n_frames = max(1, int(np.ceil(length / step_size)))
+    padded = np.zeros((n_samples, (n_frames - 1) * step_size + block_size), dtype='float64')
+    padded[:, :length] = samples[:, :padded.shape[1]]
+    return as_strided(padded, shape=(n_samples, n_frames, block_size),
+                      strides=(padded.strides[0], step_size * padded.itemsize, padded.itemsize), writeable=False)
+
+
+def hz_to_mel(freq):
+    return 2595.0 * np.log10(1.0 + np.asarray(freq) / 700.0)
+
+
+def mel_to_hz(mel):
+    return 700.0 * (10.0 ** (np.asarray(mel) / 2595.0) - 1.0)
+
+
+def mel_filter_bank(fs: int, block_size: int, min_freq: float = MFCC_MIN_FREQ, max_freq: float = MFCC_MAX_FREQ,
+                    n_filters: int = MFCC_N_FILTERS) -> np.ndarray:
+    """
+    Triangular filters equally spaced on the mel scale
+    :return: matrix of shape (n_filters, block_size // 2 + 1)
+    """
+    freqs = np.fft.rfftfreq(block_size, 1.0 / fs)
+    edges = mel_to_hz(np.linspace(hz_to_mel(min_freq), hz_to_mel(max_freq), n_filters + 2))
+    low, center, high = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (freqs - low) / (center - low)
+    falling = (high - freqs) / (high - center)
+    return np.maximum(0, np.minimum(rising, falling))
+
+
+def band_matrix(fs: int, block_size: int, edges: np.ndarray) -> np.ndarray:
+    """
+    Rectangular bands given as rows of [low, high) frequency edges
+    :return: boolean matrix of shape (n_bands, block_size // 2 + 1)
+    """
+    freqs = np.fft.rfftfreq(block_size, 1.0 / fs)
+    return (freqs >= edges[:, :1]) & (freqs < edges[:, 1:])
+
+
+def octave_filter_bank(fs: int, block_size: int, min_freq: float = OBSI_MIN_FREQ) -> np.ndarray:
+    """
+    Triangular filters with octave spacing: each one rises from the centre of the previous filter and falls to the
+    centre of the next one. Centres start an octave above min_freq, the last filter ends below Nyquist.
+    :return: matrix of shape (n_filters, block_size // 2 + 1)
+    """
+    edges = min_freq * 2.0 ** np.arange(max(2, int(np.floor(np.log2(fs / 2.0 / min_freq))) + 1))
+    freqs = np.fft.rfftfreq(block_size, 1.0 / fs)
+    low, center, high = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (freqs - low) / (center - low)
+    falling = (high - freqs) / (high - center)
+    return np.maximum(0, np.minimum(rising, falling))
+
+
+def crest_bands(fs: int, min_freq: float = CREST_MIN_FREQ) -> np.ndarray:
+    # quarter-octave bands with 5% overlap, as in MPEG-7 AudioSpectrumFlatness
+    bands = []
+    low = min_freq
+    while low * 2 ** 0.25 * 1.05 < fs / 2.0:
+        bands.append((low * 0.95, low * 2 ** 0.25 * 1.05))
+        low *= 2 ** 0.25
+    return np.array(bands).reshape(-1, 2)
+
+
+@lru_cache(maxsize=8)
+def cqt_kernels(fs: int, length: int, min_freq: float = CQT_MIN_FREQ, bins_per_octave: int = CQT_BINS_PER_OCTAVE,
+                n_octaves: int = CQT_N_OCTAVES) -> np.ndarray:
+    """
+    Constant-Q kernels, Hamming-windowed and centred on their frame, as a table of offsets from the frame centre.
+    Kernels of low bins are longer than the signal, only the offsets a signal of the given length can reach are kept.
+    Row length + d holds the kernels at offset d, so frames centred at c use rows length - c to 2 * length - c.
+    :param fs: sampling rate [Hz]
+    :param length: length of the signals [samples]
+    :return: read-only matrix of shape (2 * length, 2 * n_bins), real parts followed by imaginary parts
+    """
+    n_bins = bins_per_octave * n_octaves
+    q = 1.0 / (2 ** (1.0 / bins_per_octave) - 1)
+    offsets = np.arange(-length, length)
+    kernels = np.zeros((2 * length, n_bins), dtype='complex128')
+    for k in range(n_bins):
+        n_k = int(np.ceil(q * fs / (min_freq * 2 ** (k / bins_per_octave))))
+        n = offsets + n_k // 2
+        valid = (n >= 0) & (n < n_k)
+        n = n[valid]
+        kernels[valid, k] = (0.54 - 0.46 * np.cos(2 * np.pi * n / (n_k - 1))) / n_k * np.exp(-2j * np.pi * q * n / n_k)
+    kernels = np.concatenate((kernels.real, kernels.imag), axis=1)
+    kernels.flags.writeable = False
+    return kernels
+
+
+def chroma_fold(n_bins: int = CQT_BINS_PER_OCTAVE * CQT_N_OCTAVES,
+                bins_per_semitone: int = CHROMA_BINS_PER_SEMITONE) -> np.ndarray:
+    """
+    Sum of constant-Q bins into 12 pitch classes. Every semitone aggregates the bins centred on it, the first pitch
+    class is that of the lowest bin.
+    :return: matrix of shape (n_bins, 12)
+    """
+    semitone = (np.arange(n_bins) + bins_per_semitone // 2) // bins_per_semitone
+    fold = np.zeros((n_bins, 12))
+    fold[np.arange(n_bins), semitone % 12] = 1.0
+    return fold
+
+
+def chroma(samples: np.ndarray, fs: int, step_size: int) -> np.ndarray:
+    """
+    Chromagram of signals from the magnitude of their constant-Q transform, with frames centred every step_size
+    samples from the start of each signal
+    :param samples: 2-d array of signals, one per row
+    :return: array of shape (n_samples, n_frames, 12)
+    """
+    length = samples.shape[1]
+    kernels = cqt_kernels(fs, length)
+    n_bins = kernels.shape[1] // 2
+    fold = chroma_fold(n_bins)
+    # in float64, so that rounding does not depend on how many windows are in a batch
+    samples = np.asarray(samples, dtype='float64')
+    centers = np.arange(0, max(length, 1), step_size)
+    out = np.empty((len(samples), len(centers), 12))
+    for idx, center in enumerate(centers):
+        cqt = samples @ kernels[length - center:2 * length - center]
+        out[:, idx] = np.hypot(cqt[:, :n_bins], cqt[:, n_bins:]) @ fold
+    return out
+
+
+def autocorrelation(frames: np.ndarray, order: int) -> np.ndarray:
+    length = frames.shape[-1]
+    return np.stack([np.sum(frames[..., :length - lag] * frames[..., lag:], axis=-1) for lag in range(order + 1)],
+                    axis=-1)
+
+
+def levinson(r: np.ndarray, order: int) -> np.ndarray:
+    """
+    Levinson-Durbin recursion over the last axis of r
+    :param r: autocorrelation of shape (..., order + 1)
+    :param order: prediction order
+    :return: polynomial coefficients [1, a_1, ..., a_order] of shape (..., order + 1)
+    """
+    a = np.zeros(r.shape[:-1] + (order + 1,))
+    a[..., 0] = 1.0
+    error = r[..., 0].copy()
+    for i in range(1, order + 1):
+        acc = r[..., i] + np.sum(a[..., 1:i] * r[..., i - 1:0:-1], axis=-1)
+        k = -acc / np.where(error > 0, error, 1.0)
+        k = np.where(error > 0, k, 0.0)
+        a[..., 1:i] = a[..., 1:i] + k[..., None] * a[..., i - 1:0:-1]
+        a[..., i] = k
+        error = error * (1.0 - k ** 2)
+    return a
+
+
+def lpc(frames: np.ndarray, order: int = LPC_N_COEFFS) -> np.ndarray:
+    return levinson(autocorrelation(frames, order), order)[..., 1:]
+
+
+def _polynomial_roots(coeffs: np.ndarray) -> np.ndarray:
+    # eigenvalues of companion matrices of monic polynomials given by highest power first
+    degree = coeffs.shape[-1] - 1
+    companion = np.zeros(coeffs.shape[:-1] + (degree, degree))
+    companion[..., 0, :] = -coeffs[..., 1:] / coeffs[..., :1]
+    companion[..., np.arange(1, degree), np.arange(degree - 1)] = 1.0
+    return np.linalg.eigvals(companion)
+
+
+def lsf(frames: np.ndarray, order: int = LSF_N_COEFFS) -> np.ndarray:
+    """
+    Line spectral frequencies [rad] of the LPC polynomial
+    :return: array of shape (..., order)
+    """
+    a = levinson(autocorrelation(frames, order), order)
+    a = np.concatenate((a, np.zeros(a.shape[:-1] + (1,))), axis=-1)
+    p = a + a[..., ::-1]
+    q = a - a[..., ::-1]
+    angles = np.abs(np.angle(np.concatenate((_polynomial_roots(p), _polynomial_roots(q)), axis=-1)))
+    # roots come in conjugate pairs, plus the trivial ones at 0 and pi
+    return np.sort(angles, axis=-1)[..., 1:-1:2]
+
+
+def spectral_flatness(magnitude: np.ndarray) -> np.ndarray:
+    geometric = np.exp(np.mean(np.log(magnitude + EPS), axis=-1))
+    return geometric / (np.mean(magnitude, axis=-1) + EPS)
+
+
+def spectral_crest_factor(power: np.ndarray, bands: np.ndarray) -> np.ndarray:
+    crest = np.empty(power.shape[:-1] + (len(bands),))
+    for idx, band in enumerate(bands):
+        values = power[..., band]
+        crest[..., idx] = values.max(axis=-1) / (values.mean(axis=-1) + EPS)
+    return crest
+
+
+def spectral_decrease(magnitude: np.ndarray) -> np.ndarray:
+    k = np.arange(1, magnitude.shape[-1])
+    num = np.sum((magnitude[..., 1:] - magnitude[..., :1]) / k, axis=-1)
+    return num / (np.sum(magnitude[..., 1:], axis=-1) + EPS)
+
+
+def _previous_frame(magnitude: np.ndarray) -> np.ndarray:
+    previous = np.zeros_like(magnitude)
+    previous[:, 1:] = magnitude[:, :-1]
+    return previous
+
+
+def spectral_flux(magnitude: np.ndarray) -> np.ndarray:
+    return np.sqrt(np.sum((magnitude - _previous_frame(magnitude)) ** 2, axis=-1))
+
+
+def spectral_variation(magnitude: np.ndarray) -> np.ndarray:
+    previous = _previous_frame(magnitude)
+    den = np.linalg.norm(magnitude, axis=-1) * np.linalg.norm(previous, axis=-1)
+    num = np.sum(magnitude * previous, axis=-1)
+    return np.where(den > 0, 1.0 - num / np.where(den > 0, den, 1.0), 0.0)
+
+
+def spectral_rolloff(power: np.ndarray, fs: int, block_size: int, rolloff: float = ROLLOFF) -> np.ndarray:
+    cumulative = np.cumsum(power, axis=-1)
+    idx = np.argmax(cumulative >= rolloff * cumulative[..., -1:], axis=-1)
+    return idx * fs / block_size
+
+
+def zero_crossing_rate(frames: np.ndarray) -> np.ndarray:
+    signs = np.signbit(frames)
+    return np.count_nonzero(signs[..., 1:] != signs[..., :-1], axis=-1) / frames.shape[-1]
+
+
+class NumpyYaafe(object):
+    """
+    Experimental replacement of YaafeWrapper that does not need yaafelib. Columns follow the naming of YaafeWrapper,
+    values and column counts are checked against yaafelib only by benchmarks/yaafe_backends.py.
+    """
+
+    def __init__(self, fs: int, block_size=1024, step_size=None, selected_features='all', chunk_size: int = 64):
+        # imported here, yaafe_wrapper picks the backend
+        from audioexplorer.yaafe_wrapper import output_columns
+
+        if not step_size:
+            step_size = block_size // 2
+        if selected_features == 'all':
+            selected_features = NUMPY_FEATURES
+        self.fs = fs
+        self.block_size = block_size
+        self.step_size = step_size
+        self.chunk_size = chunk_size
+        self.window = np.hanning(block_size)
+
+        self.mel_filters = mel_filter_bank(fs, block_size)
+        self.obsi_filters = octave_filter_bank(fs, block_size)
+        self.crest_bands = band_matrix(fs, block_size, crest_bands(fs))
+
+        sizes = {'Chroma': 12, 'LPC': LPC_N_COEFFS, 'LSF': LSF_N_COEFFS, 'MFCC': MFCC_N_COEFFS,
+                 'OBSI': len(self.obsi_filters), 'SpectralCrestFactorPerBand': len(self.crest_bands)}
+        self.outputs = [(name, sizes.get(name, 1)) for name in NUMPY_FEATURES if name in selected_features]
+        self.columns, self._output_slices = output_columns(self.outputs)
+
+    def _compute(self, name: str, chunk: np.ndarray, frames: np.ndarray, magnitude: np.ndarray,
+                 power: np.ndarray) -> np.ndarray:
+        if name == 'Chroma':
+            return chroma(chunk, self.fs, self.step_size) + EPS
+        elif name == 'LPC':
+            return lpc(frames, LPC_N_COEFFS)
+        elif name == 'LSF':
+            return lsf(frames, LSF_N_COEFFS)
+        elif name == 'MFCC':
+            mel = np.log(np.maximum(magnitude @ self.mel_filters.T, 1e-10))
+            return dct(mel, type=2, norm='ortho', axis=-1)[..., 1:MFCC_N_COEFFS + 1]
+        elif name == 'OBSI':
+            return np.log(np.maximum(power @ self.obsi_filters.T, 1e-10))
+        elif name == 'SpectralCrestFactorPerBand':
+            return spectral_crest_factor(power, self.crest_bands)
+        elif name == 'SpectralDecrease':
+            return spectral_decrease(magnitude)
+        elif name == 'SpectralFlatness':
+            return spectral_flatness(magnitude)
+        elif name == 'SpectralFlux':
+            return spectral_flux(magnitude)
+        elif name == 'SpectralRolloff':
+            return spectral_rolloff(power, self.fs, self.block_size)
+        elif name == 'SpectralVariation':
+            return spectral_variation(magnitude)
+        elif name == 'ZCR':
+            return zero_crossing_rate(frames)
+        raise ValueError(f'Unknown feature {name}')
+
+    def get_mean_features_batch(self, samples: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Compute mean of each feature over frames for a batch of signals
+        :param samples: 2-d array of signals, one per row
+        :param out: optional array of shape (n_samples, len(self.columns)) to be filled
+        :return: mean features, columns ordered as in self.columns
+        """
+        if out is None:
+            out = np.empty((len(samples), len(self.columns)), dtype='float32')
+        for start in range(0, len(samples), self.chunk_size):
+            chunk = np.asarray(samples[start:start + self.chunk_size], dtype='float64')
+            frames = frame_rows(chunk, self.block_size, self.step_size)
+            magnitude = np.abs(np.fft.rfft(frames * self.window, axis=-1))
+            power = magnitude ** 2
+            for name, cols, in_db in self._output_slices:
+                values = self._compute(name, chunk, frames, magnitude, power)
+                values = values.reshape(values.shape[:2] + (-1,)).mean(axis=1)
+                out[start:start + len(chunk), cols] = 10 * np.log10(values) if in_db else values
+        return out
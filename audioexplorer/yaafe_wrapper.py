@@ -15,9 +15,16 @@
 #      You should have received a copy of the GNU General Public License
 #      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
 
+import logging
 import numpy as np
 import pandas as pd
-import yaafelib
+from settings import YAAFE_BACKEND
+from audioexplorer import stft
+
+try:
+    import yaafelib
+except ImportError:
+    yaafelib = None
 
 
 YAAFE_FEATURES = \
@@ -32,9 +39,65 @@ YAAFE_FEATURES = \
      'SpectralRolloff': 'Rolloff',
      'SpectralVariation': 'Variation'}
 
+# features whose frames depend only on their own samples, so that windows can be processed one after another in one pass
+FRAME_FEATURES = ['LPC', 'LSF', 'MFCC', 'OBSI', 'SpectralCrestFactorPerBand', 'SpectralDecrease', 'SpectralFlatness',
+                  'SpectralRolloff', 'ZCR']
+
+
+def output_columns(outputs: list) -> (list, list):
+    """
+    Column names and column slices of engine outputs
+    :param outputs: list of (feature name, output size)
+    :return: list of column names and list of (feature name, column slice, whether mean is reported in dB)
+    """
+    columns = []
+    for name, size in outputs:
+        if size == 1:
+            columns.append(f'yaafe_{name}')
+        else:
+            columns.extend(f'yaafe_{name}.{idx}' for idx in range(size))
+    bounds = np.cumsum([0] + [size for _, size in outputs])
+    slices = [(name, slice(start, stop), name == 'Chroma' and size > 1)
+              for (name, size), start, stop in zip(outputs, bounds[:-1], bounds[1:])]
+    return columns, slices
+
+
+def yaafe_backend(backend: str = YAAFE_BACKEND) -> str:
+    """
+    Resolve the YAAFE backend
+    :param backend: 'yaafe', 'numpy' or 'auto' for yaafelib when installed and numpy otherwise
+    :return: 'yaafe' or 'numpy'
+    """
+    if backend == 'auto':
+        return 'yaafe' if yaafelib is not None else 'numpy'
+    if backend not in ['yaafe', 'numpy']:
+        raise ValueError(f'Unknown YAAFE backend {backend}')
+    return backend
+
+
+def get_yaafe(fs: int, block_size=1024, step_size=None, selected_features='all', backend: str = YAAFE_BACKEND):
+    """
+    Get YAAFE feature extractor
+    :param fs: sampling rate [Hz]
+    :param block_size: FFT size
+    :param step_size: FFT step
+    :param selected_features: YAAFE features to extract
+    :param backend: 'yaafe' for yaafelib, 'numpy' for the experimental NumPy implementation or 'auto' to use yaafelib
+    when installed
+    :return: YaafeWrapper or NumpyYaafe
+    """
+    if yaafe_backend(backend) == 'yaafe':
+        return YaafeWrapper(fs, block_size, step_size, selected_features=selected_features)
+    from audioexplorer.yaafe_numpy import NumpyYaafe
+    logging.warning('Using the experimental NumPy YAAFE backend, its features are not validated against yaafelib')
+    return NumpyYaafe(fs, block_size, step_size, selected_features=selected_features)
+
+
 class YaafeWrapper(object):
 
     def __init__(self, fs: int, block_size=1024, step_size=None, selected_features='all'):
+        if yaafelib is None:
+            raise ImportError('yaafelib is not installed, set YAAFE_BACKEND=numpy for the experimental NumPy backend')
         if not step_size:
             step_size = block_size // 2
 
@@ -54,15 +117,31 @@ class YaafeWrapper(object):
         }
 
         self.fs = fs
+        self.block_size = block_size
+        self.step_size = step_size
         if selected_features == 'all':
             selected_features = features_config.keys()
+        selected = [name for name in features_config if name in selected_features]
+        self.engine = self._load_engine(fs, [features_config[name] for name in selected], selected)
+        self.outputs = [(name, infos['size']) for name, infos in self.engine.getOutputs().items()]
+        self.columns, self._output_slices = output_columns(self.outputs)
+
+        frame_features = [name for name in selected if name in FRAME_FEATURES]
+        context_features = [name for name in selected if name not in FRAME_FEATURES]
+        self._frame_engine = self._load_engine(fs, [features_config[name] for name in frame_features],
+                                               frame_features) if frame_features else None
+        self._context_engine = self._load_engine(fs, [features_config[name] for name in context_features],
+                                                 context_features) if context_features else None
+        self._frame_counts = {}  # window length: frames of every frame feature, None if windows cannot be batched
+
+    @staticmethod
+    def _load_engine(fs: int, settings: list, names: list):
         feature_plan = yaafelib.FeaturePlan(sample_rate=fs, normalize=True)
-        for feature_name, setting in features_config.items():
-            if feature_name in selected_features:
-                feature_plan.addFeature(feature_name + ': ' + setting)
-        data_flow = feature_plan.getDataFlow()
-        self.engine = yaafelib.Engine()
-        self.engine.load(data_flow)
+        for feature_name, setting in zip(names, settings):
+            feature_plan.addFeature(feature_name + ': ' + setting)
+        engine = yaafelib.Engine()
+        engine.load(feature_plan.getDataFlow())
+        return engine
 
     def get_features(self, audio_data: np.ndarray) -> dict:
         features = self.engine.processAudio(audio_data.reshape(1, -1).astype('float64'))
@@ -87,20 +166,126 @@ class YaafeWrapper(object):
         flat_dict = self.get_mean_features(audio_data)
         return pd.Series(flat_dict)
 
+    def get_mean_features_batch(self, samples: np.ndarray, out: np.ndarray = None, chunk_size: int = 256) -> np.ndarray:
+        """
+        Compute mean of each feature over frames for a batch of signals, with output means written straight into the
+        matrix. Features whose frames depend only on their own samples are computed for a chunk of windows in one
+        engine pass: windows are laid one after another, each padded with zeros to a whole number of steps that
+        leaves room for its last frame, and the output frames are split by the frame count of a single window. The
+        first and last window of every batch are checked against the same windows processed alone, and windows are
+        processed one by one if they differ. Features that depend on neighbouring frames (Chroma, flux and variation) are always
+        computed one window at a time.
+        :param samples: 2-d array of signals, one per row
+        :param out: optional array of shape (n_samples, len(self.columns)) to be filled
+        :param chunk_size: number of windows cast to float64 and processed in one pass at once
+        :return: mean features, columns ordered as in self.columns
+        """
+        if out is None:
+            out = np.empty((len(samples), len(self.columns)), dtype='float32')
+        for chunk_start in range(0, len(samples), chunk_size):
+            chunk = np.ascontiguousarray(samples[chunk_start:chunk_start + chunk_size], dtype='float64')
+            rows = out[chunk_start:chunk_start + len(chunk)]
+            if self._frame_engine is not None and not self._batch_means(chunk, rows):
+                self._window_means(self._frame_engine, chunk, rows)
+            if self._context_engine is not None:
+                self._window_means(self._context_engine, chunk, rows)
+        return out
 
-def calculate_spectrogram(y, fs, block_size=1024, step_size=None):
+    def _process(self, engine, signal: np.ndarray) -> dict:
+        engine.reset()
+        engine.writeInput('audio', signal.reshape(1, -1))
+        engine.process()
+        engine.flush()
+        return {name: engine.readOutput(name) for name in engine.getOutputs()}
+
+    def _write_means(self, outputs: dict, rows: np.ndarray):
+        # rows: one row per window, means over frames already taken
+        for name, cols, in_db in self._output_slices:
+            if name in outputs:
+                rows[:, cols] = 10 * np.log10(outputs[name]) if in_db else outputs[name]
+
+    def _window_means(self, engine, chunk: np.ndarray, rows: np.ndarray):
+        for sample, row in zip(chunk, rows):
+            outputs = self._process(engine, sample)
+            means = {name: values.mean(axis=0) if values is not None and len(values) else np.nan
+                     for name, values in outputs.items()}
+            self._write_means(means, row[np.newaxis])
+
+    def _batch_means(self, chunk: np.ndarray, rows: np.ndarray) -> bool:
+        n_windows, length = chunk.shape
+        steps_per_window = -(-length // self.step_size) + -(-self.block_size // self.step_size)
+        if self._frame_counts.get(length, {}) is None:
+            return False
+        probes = [self._process(self._frame_engine, chunk[idx]) for idx in sorted({0, n_windows - 1})]
+        counts = {name: len(values) if values is not None else 0 for name, values in probes[0].items()}
+        if length not in self._frame_counts:
+            self._frame_counts[length] = counts if 0 < min(counts.values()) and \
+                max(counts.values()) <= steps_per_window else None
+        if self._frame_counts[length] != counts:
+            return False
+
+        signal = np.zeros((n_windows, steps_per_window * self.step_size))
+        signal[:, :length] = chunk
+        outputs = self._process(self._frame_engine, signal)
+        means = {}
+        for name, values in outputs.items():
+            frames = np.arange(n_windows)[:, np.newaxis] * steps_per_window + np.arange(counts[name])
+            if values is None or len(values) <= frames[-1, -1] or \
+                    not all(np.allclose(values[window_frames], probe[name], rtol=1e-5, atol=1e-8, equal_nan=True)
+                            for window_frames, probe in zip(frames[[0, -1]], probes)):
+                logging.warning(f'Batched YAAFE {name} frames differ from a single window, windows are processed '
+                                f'one by one')
+                self._frame_counts[length] = None
+                return False
+            means[name] = values[frames].mean(axis=1)
+        self._write_means(means, rows)
+        return True
+
+
+def calculate_spectrogram(y, fs, block_size=1024, step_size=None, chunk_s: float = 60.0):
+    """
+    Magnitude spectrogram of a signal. yaafelib needs float64 input, so the signal is fed to the engine in chunks
+    instead of being cast as a whole.
+    :param y: 1-d signal
+    :param fs: sampling rate [Hz]
+    :param block_size: FFT size
+    :param step_size: FFT step. Defaults to half of the block size
+    :param chunk_s: duration of a chunk cast to float64 at once [s]
+    :return: frequencies, times and spectrogram of shape (n_frames, n_bins)
+    """
     if step_size is None:
         step_size = block_size // 2
+    if yaafelib is None:
+        logging.debug('yaafelib is not installed, computing spectrogram with numpy')
+        return _calculate_spectrogram_numpy(y, fs, block_size, step_size)
     feature_plan = yaafelib.FeaturePlan(sample_rate=fs, normalize=True)
     feature_plan.addFeature(f'MagnitudeSpectrum: MagnitudeSpectrum blockSize={block_size} stepSize={step_size}')
     data_flow = feature_plan.getDataFlow()
     engine = yaafelib.Engine()
     engine.load(data_flow)
-    features = engine.processAudio(y.reshape(1, -1).astype('float64'))
+    chunk_len = max(1, int(chunk_s * fs))
+    blocks = []
+    for start in range(0, len(y), chunk_len):
+        engine.writeInput('audio', np.asarray(y[start:start + chunk_len], dtype='float64').reshape(1, -1))
+        engine.process()
+        blocks.append(engine.readOutput('MagnitudeSpectrum'))
+    engine.flush()
+    blocks.append(engine.readOutput('MagnitudeSpectrum'))
+    blocks = [block for block in blocks if block is not None and len(block)]
+    spectrum = np.concatenate(blocks) if blocks else np.empty((0, block_size // 2 + 1))
 
     noverlap = block_size // 2
-    spectrum = features['MagnitudeSpectrum']
     time=np.linspace(noverlap / fs, (len(y) - noverlap) / fs, spectrum.shape[0])
     freq = np.linspace(0, fs // 2, num=spectrum.shape[-1])
 
-    return freq, time, spectrum
\ No newline at end of file
+    return freq, time, spectrum
+
+
+def _calculate_spectrogram_numpy(y, fs, block_size, step_size):
+    # symmetric Hanning window, as numpy.hanning
+    spectrum = stft.spectrogram(y, block_size, step_size, window='hann', periodic=False,
+                                kind='magnitude', pad_end=True)
+    noverlap = block_size // 2
+    time = np.linspace(noverlap / fs, (len(y) - noverlap) / fs, spectrum.shape[0])
+    freq = np.linspace(0, fs // 2, num=spectrum.shape[-1])
+    return freq, time, spectrum
@@ -0,0 +1,85 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Check that a feature cache with a small size cap never evicts entries in use: a filtered signal larger than the cap
+is served without being cached, and features computed from a cached signal keep it until its memmap is closed.
+Exits with status 1 on any failure. Run from the repository root:
+
+    python -m benchmarks.cache_eviction
+"""
+
+import os
+import sys
+import tempfile
+import numpy as np
+from settings import TEMP_STORAGE
+from audioexplorer import cache
+from benchmarks.memory import PARAMS, synthetic_wav
+
+
+def cached_files(feature_cache: cache.FeatureCache, prefix: str) -> list:
+    return [name for name in os.listdir(feature_cache.root) if name.startswith(prefix)]
+
+
+def check() -> bool:
+    ok = True
+    large = synthetic_wav(150)  # 9.2 MB of float32 samples
+    small = synthetic_wav(20)
+
+    feature_cache = cache.FeatureCache(root=tempfile.mkdtemp(dir=TEMP_STORAGE), max_mb=5)
+    fs, X = cache.filtered_signal(large, PARAMS['lowcut'], PARAMS['highcut'], cache=feature_cache)
+    if len(X) != 150 * fs or cached_files(feature_cache, 'signal_'):
+        print('Signal larger than the cap was cached or read wrong')
+        ok = False
+    tmp_path = X.filename
+    del X
+    if os.path.exists(tmp_path):
+        print('Temporary file of an uncached signal was not removed')
+        ok = False
+
+    feature_cache = cache.FeatureCache(root=tempfile.mkdtemp(dir=TEMP_STORAGE), max_mb=1.5)
+    _, X = cache.filtered_signal(small, PARAMS['lowcut'], PARAMS['highcut'], cache=feature_cache)
+    for lowcut in [600, 700]:
+        # each signal takes 1.2 MB, so writing another one would evict X if it were not in use
+        cache.filtered_signal(small, lowcut, PARAMS['highcut'], cache=feature_cache)
+    if not os.path.exists(X.filename):
+        print('Signal with an open memmap was evicted')
+        ok = False
+    feature_cache.save('features', 'a', features=np.zeros(10 ** 6, dtype='float32'))
+    if not cached_files(feature_cache, 'features_a'):
+        print('Entry just written was evicted')
+        ok = False
+    del X
+    feature_cache.evict()
+    size = sum(os.path.getsize(os.path.join(feature_cache.root, name)) for name in os.listdir(feature_cache.root))
+    if size > feature_cache.max_bytes:
+        print(f'Cache holds {size} bytes over its cap of {feature_cache.max_bytes} once nothing is in use')
+        ok = False
+
+    features = cache.get_features(small, selected_features=['freq'], cache=feature_cache, **PARAMS)
+    if not len(features):
+        print('No features computed with a small cache')
+        ok = False
+
+    if ok:
+        print('Cache eviction keeps entries in use')
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check() else 1)
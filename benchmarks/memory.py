@@ -0,0 +1,92 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Peak Python heap memory of the steps of a session: reading an upload, filtering it, detecting onsets and extracting
+features. Memory-mapped data is not counted, which is the point of keeping the audio as int16 at rest. The legacy
+row reads with wavfile and filters a float64 copy, as the app used to. Run from the repository root:
+
+    python -m benchmarks.memory path/to/file.wav
+    python -m benchmarks.memory --seconds 3600
+
+Without a path, a synthetic 16 kHz recording of the given duration is written to TEMP_STORAGE.
+"""
+
+import os
+import sys
+import tempfile
+import tracemalloc
+import numpy as np
+from scipy.io import wavfile
+from settings import TEMP_STORAGE
+from audioexplorer import audio_io, cache, features, filters
+
+PARAMS = dict(lowcut=500, highcut=6000, block_size=512, step_size=256, onset_detector_type='hfc',
+              onset_threshold=0.01, onset_silence_threshold=-90, min_duration_s=0.15, sample_len=0.2)
+
+
+def measure(name: str, func, reference_mb: float):
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_mb = peak / 2 ** 20
+    print(f'{name:<28}{peak_mb:>10.1f} MB{peak_mb / reference_mb:>10.1f}x')
+    return result
+
+
+def synthetic_wav(seconds: float, fs: int = 16000, silence_s: float = 0) -> str:
+    path = os.path.join(TEMP_STORAGE, f'benchmark_{int(seconds)}s{"_silence" if silence_s else ""}.wav')
+    if not os.path.exists(path):
+        rng = np.random.RandomState(0)
+        pcm = (rng.randn(int(seconds * fs)) * 300).astype('int16')
+        t = np.arange(int(0.1 * fs)) / fs
+        for start in rng.randint(0, len(pcm) - len(t), int(seconds)):
+            pcm[start:start + len(t)] += (8000 * np.sin(2 * np.pi * 3000 * t)).astype('int16')
+        pcm[:int(silence_s * fs)] = 0
+        wavfile.write(path, fs, pcm)
+    return path
+
+
+def run(path: str):
+    fs = audio_io.open_wav(path).fs
+    int16_mb = os.path.getsize(path) / 2 ** 20
+    print(f'{path}: {int16_mb:.1f} MB of int16 audio')
+    print(f'{"step":<28}{"peak":>13}{"of int16":>11}')
+
+    def legacy():
+        _, wav = wavfile.read(path)
+        X = wav / (2 ** 15 - 1)
+        return filters.frequency_filter(X, fs, PARAMS['lowcut'], PARAMS['highcut'])
+
+    measure('legacy read and filter', legacy, int16_mb)
+    measure('read as float32', lambda: audio_io.read_wave_local(path, as_float=True), int16_mb)
+
+    feature_cache = cache.FeatureCache(root=tempfile.mkdtemp(dir=TEMP_STORAGE))
+    _, X = measure('filter into cache', lambda: cache.filtered_signal(path, PARAMS['lowcut'], PARAMS['highcut'],
+                                                                      cache=feature_cache), int16_mb)
+    onsets = measure('detect onsets', lambda: features.detect_onsets(X, fs, **PARAMS), int16_mb)
+    measure('extract freq and pitch', lambda: features.extract(X, fs, onsets, selected_features=['freq', 'pitch'],
+                                                               **PARAMS), int16_mb)
+    print(f'{len(onsets)} onsets')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--seconds':
+        run(synthetic_wav(float(sys.argv[2])))
+    else:
+        run(sys.argv[1])
@@ -0,0 +1,66 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Check that onsets and features computed by the worker pool in overlapping segments equal the serial run, as audiocli
+a2f -j 4 against a2f -j 1, and time both. Exits with status 1 on any difference. Run from the repository root:
+
+    python -m benchmarks.parallel_onsets path/to/file.wav
+    python -m benchmarks.parallel_onsets --seconds 150
+
+Without a path, a synthetic 16 kHz recording of the given duration is written to TEMP_STORAGE, starting with digital
+silence that aubio does not see.
+"""
+
+import sys
+import time
+import numpy as np
+from audioexplorer import features
+from benchmarks.memory import PARAMS, synthetic_wav
+from audioexplorer.audio_io import read_wave_local
+from audioexplorer.filters import frequency_filter
+
+
+def check(path: str, n_jobs: int = 4, selected_features=('freq', 'pitch')) -> bool:
+    fs, y = read_wave_local(path, as_float=True)
+    X = frequency_filter(y, fs, lowcut=PARAMS['lowcut'], highcut=PARAMS['highcut'])
+    results = {}
+    for jobs in [1, n_jobs]:
+        start = time.perf_counter()
+        onsets = features.detect_onsets(X, fs, n_jobs=jobs, **PARAMS)
+        feats = features.get(y, fs, n_jobs=jobs, selected_features=list(selected_features), onsets=onsets, **PARAMS)
+        print(f'-j {jobs}: {len(onsets)} onsets in {time.perf_counter() - start:.2f} s')
+        results[jobs] = onsets, feats
+
+    (serial_onsets, serial), (parallel_onsets, parallel) = results[1], results[n_jobs]
+    same_onsets = len(serial_onsets) == len(parallel_onsets) and np.array_equal(serial_onsets, parallel_onsets)
+    same_features = serial.equals(parallel)
+    if not same_onsets:
+        print(f'Onsets differ: {len(np.setxor1d(serial_onsets, parallel_onsets))} not shared')
+    if not same_features:
+        print('Features differ')
+    if same_onsets and same_features:
+        print('Serial and parallel results are identical')
+    return same_onsets and same_features
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--seconds':
+        path = synthetic_wav(float(sys.argv[2]), silence_s=1.0)
+    else:
+        path = sys.argv[1]
+    sys.exit(0 if check(path) else 1)
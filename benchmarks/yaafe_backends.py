@@ -0,0 +1,93 @@
+#      Copyright (c) 2019  Lukasz Tracewski
+#
+#      This file is part of Audio Explorer.
+#
+#      Audio Explorer is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      Audio Explorer is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with Audio Explorer.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Parity check of the experimental NumPy backend of the YAAFE features against yaafelib. The reference is recorded once
+where yaafelib is installed: onset windows of a recording and their yaafelib features and columns are stored in an npz
+file. The check needs only NumPy: it computes the features of the stored windows with the NumPy backend and exits with
+status 1 if the columns are not identical, in name and order, or any column is off by more than the tolerances below.
+Run from the repository root:
+
+    python -m benchmarks.yaafe_backends record path/to/file.wav [reference.npz]
+    python -m benchmarks.yaafe_backends check [reference.npz]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from audioexplorer import audio_io
+from audioexplorer.windowing import onset_windows
+from audioexplorer.yaafe_wrapper import get_yaafe
+
+REFERENCE = os.path.join(os.path.dirname(__file__), 'data', 'yaafe_reference.npz')
+MIN_CORRELATION = 0.99
+MAX_MEDIAN_REL_ERROR = 0.05
+
+
+def extract(backend: str, samples: np.ndarray, fs: int, block_size: int) -> (list, np.ndarray):
+    extractor = get_yaafe(fs, block_size, selected_features='all', backend=backend)
+    start = time.perf_counter()
+    features = extractor.get_mean_features_batch(samples)
+    elapsed = time.perf_counter() - start
+    print(f'{backend:>6}: {len(samples)} windows in {elapsed:.2f} s ({1e3 * elapsed / len(samples):.3f} ms/window)')
+    return list(extractor.columns), features
+
+
+def record(path: str, reference: str = REFERENCE, block_size: int = 512, sample_len: float = 0.2,
+           max_windows: int = 500):
+    fs, X = audio_io.read_wave_local(path, as_float=True)
+    onsets = np.arange(0, len(X) / fs - sample_len, sample_len)[:max_windows]
+    samples = onset_windows(X, fs, onsets, sample_len)
+    columns, features = extract('yaafe', samples, fs, block_size)
+    os.makedirs(os.path.dirname(os.path.abspath(reference)), exist_ok=True)
+    np.savez_compressed(reference, samples=samples, fs=fs, block_size=block_size, columns=np.array(columns),
+                        features=features)
+    print(f'{len(columns)} columns of {len(samples)} windows stored in {reference}')
+
+
+def check(reference: str = REFERENCE) -> bool:
+    if not os.path.exists(reference):
+        print(f'No yaafelib reference in {reference}, record one where yaafelib is installed')
+        return False
+    with np.load(reference) as data:
+        samples, fs, block_size = data['samples'], int(data['fs']), int(data['block_size'])
+        expected_columns, expected = list(data['columns']), data['features']
+    columns, features = extract('numpy', samples, fs, block_size)
+    if columns != expected_columns:
+        print(f'Columns differ, yaafelib: {expected_columns}, numpy: {columns}')
+        return False
+
+    failed = []
+    print(f'{"column":<34}{"corr":>8}{"median rel. err":>18}')
+    for column, reference_values, candidate in zip(columns, expected.T, features.T):
+        finite = np.isfinite(reference_values) & np.isfinite(candidate)
+        corr = np.corrcoef(reference_values[finite], candidate[finite])[0, 1]
+        rel_err = np.median(np.abs(candidate[finite] - reference_values[finite]) /
+                            (np.abs(reference_values[finite]) + 1e-12))
+        print(f'{column:<34}{corr:>8.3f}{rel_err:>18.3g}')
+        if not corr >= MIN_CORRELATION or not rel_err <= MAX_MEDIAN_REL_ERROR:
+            failed.append(column)
+    print(f'Parity failed for {len(failed)} of {len(columns)} columns' if failed else 'Parity OK')
+    return not failed
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'record':
+        record(*sys.argv[2:])
+    else:
+        sys.exit(0 if check(*sys.argv[2:]) else 1)
@@ -21,4 +21,11 @@ SERVE_LOCAL = strtobool(os.getenv('LOCAL', 'False'))
 SAMPLING_RATE = 16000 # All audio will be resampled to this frequency
 AUDIO_MARGIN = 0.05 # Margin applied to start and end of the audio to make it longer and improve UX. Not applied to any calculations.
 TEMP_STORAGE = '/tmp/' # Temporary storage location
-AUDIO_DB = -1 # Normalise input audio to this value
\ No newline at end of file
+AUDIO_DB = -1 # Normalise input audio to this value
+FEATURE_JOBS = int(os.getenv('FEATURE_JOBS', 1)) # Feature extraction workers. Anything but 1 keeps a persistent pool
+FEATURE_CACHE_MB = int(os.getenv('FEATURE_CACHE_MB', 1024)) # Size cap of the onset and feature cache in TEMP_STORAGE
+STFT_CACHE_MB = int(os.getenv('STFT_CACHE_MB', 256)) # Size cap of the in-memory spectrogram cache shared by onsets and plots
+S3_CACHE_MB = int(os.getenv('S3_CACHE_MB', 64)) # Size cap of the in-memory cache of audio blocks read from S3
+YAAFE_BACKEND = os.getenv('YAAFE_BACKEND', 'yaafe') # yaafe, numpy (experimental, not validated against yaafelib) or auto (numpy without yaafelib)
+ONSET_BACKEND = os.getenv('ONSET_BACKEND', 'aubio') # aubio or numpy (vectorised detection function and peak picking)
+PITCH_BACKEND = os.getenv('PITCH_BACKEND', 'aubio') # aubio or numpy (vectorised YIN over all frames)
\ No newline at end of file